@@ -5,9 +5,10 @@ Handles voice calls, payment prediction, and intelligent escalation
 """
 
 import os
+import sys
 import json
 import asyncio
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
@@ -16,8 +17,6 @@ import openai
 from twilio.rest import Client
 from twilio.twiml.voice_response import VoiceResponse, Gather
 import redis.asyncio as redis
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 import joblib
@@ -26,6 +25,23 @@ from celery import Celery
 from pydantic import BaseModel
 import logging
 
+# The tree compiler and model registry are shared with the ML service.
+# Docker images copy them next to this file; checkouts import them from the
+# ML service's directory (or ML_SERVICE_DIR).
+ML_SERVICE_DIR = os.environ.get(
+    'ML_SERVICE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recoup', 'python-backend'),
+)
+if os.path.isdir(ML_SERVICE_DIR) and ML_SERVICE_DIR not in sys.path:
+    sys.path.append(ML_SERVICE_DIR)
+
+from forest_inference import compile_model
+from model_registry import ModelRegistry, ModelSet
+from tier_resolver import TierResolver
+from invoice_cache import InvoiceDetailCache
+from rate_limiter_py import RateLimiter
+from database import get_database
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -39,15 +55,53 @@ twilio_client = Client(
 redis_client = redis.from_url(os.environ.get('REDIS_URL'))
 celery_app = Celery('recoup', broker=os.environ.get('CELERY_BROKER_URL'))
 
-# Database connection
-def get_db():
-    return psycopg2.connect(
-        host=os.environ.get('DB_HOST'),
-        database=os.environ.get('DB_NAME'),
-        user=os.environ.get('DB_USER'),
-        password=os.environ.get('DB_PASSWORD'),
-        cursor_factory=RealDictCursor
-    )
+# Number of invoices scored per batch during the escalation run
+ESCALATION_CHUNK_SIZE = int(os.environ.get('ESCALATION_CHUNK_SIZE', 500))
+# Number of user_id hash shards the escalation run is split into
+ESCALATION_SHARDS = int(os.environ.get('ESCALATION_SHARDS', 8))
+# How long per-shard progress checkpoints are kept
+ESCALATION_CHECKPOINT_TTL = 2 * 24 * 60 * 60
+# How long an action refused for quota is retried on later runs
+ESCALATION_PENDING_TTL = int(os.environ.get('ESCALATION_PENDING_TTL', 14 * 24 * 60 * 60))
+# Versioned payment model store shared by the API and Celery workers
+MODEL_REGISTRY_DIR = os.environ.get('MODEL_REGISTRY_DIR', 'models/registry')
+# Pre-registry single-pickle location, imported as the first version
+LEGACY_MODEL_PATH = 'models/payment_predictor.pkl'
+# Seconds between checks of the registry's active version pointer
+MODEL_POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', 30))
+
+# Process-wide connection pools, shared with app.py when both run in one process
+database = get_database()
+
+def get_db(caller: str = 'collections'):
+    """Pooled psycopg2 connection for blocking code: `with get_db('caller') as conn:`"""
+    return database.connection(caller)
+
+async def load_user_tier(user_id: str) -> Optional[str]:
+    async with database.open('tier_resolver') as db:
+        user = (await db.execute("SELECT tier FROM users WHERE id = :id", {'id': user_id})).fetchone()
+        return user['tier'] if user else None
+
+# Cached user tiers for the call and cost limits
+default_tier_resolver = TierResolver(load_user_tier, redis_client=redis_client)
+# Cached invoice details, invalidated when a call is logged
+default_invoice_cache = InvoiceDetailCache(redis_client=redis_client)
+# Quotas for the actions the escalation run queues
+rate_limiter = RateLimiter(tier_resolver=default_tier_resolver)
+
+# Rate limiter action each escalation action counts against
+ACTION_QUOTAS = {
+    'gentle_email': 'emails',
+    'firm_email': 'emails',
+    'second_reminder': 'emails',
+    'final_notice': 'emails',
+    'first_sms': 'sms',
+    'first_ai_call': 'ai_calls',
+    'second_ai_call': 'ai_calls',
+    'final_ai_call': 'ai_calls',
+    'immediate_ai_call': 'ai_calls',
+    'physical_letter': 'letters',
+}
 
 class CollectionStage(Enum):
     """Collection escalation stages"""
@@ -83,7 +137,10 @@ class Invoice:
 class AIVoiceCallHandler:
     """Handles AI-powered collection calls using Twilio and OpenAI"""
     
-    def __init__(self):
+    def __init__(self, tier_resolver: Optional[TierResolver] = None,
+                 invoice_cache: Optional[InvoiceDetailCache] = None):
+        self.tier_resolver = tier_resolver or default_tier_resolver
+        self.invoice_cache = invoice_cache or default_invoice_cache
         self.twilio_phone = os.environ.get('TWILIO_PHONE_NUMBER')
         self.webhook_base = os.environ.get('API_BASE_URL')
         self.max_call_duration = 120  # 2 minutes max
@@ -158,11 +215,7 @@ class AIVoiceCallHandler:
         current_spend = float(await redis_client.get(day_key) or 0)
         
         # Get user tier for limit
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT tier FROM users WHERE id = %s", (user_id,))
-                user = cur.fetchone()
-                tier = user['tier'] if user else 'starter'
+        tier = await self.tier_resolver.resolve(user_id)
         
         daily_limits = {'starter': 5.0, 'growth': 25.0, 'pro': 100.0}
         limit = daily_limits.get(tier, 5.0)
@@ -180,7 +233,8 @@ class AIVoiceCallHandler:
         """Initiate an AI collection call"""
         
         # Check limits
-        can_call, reason = await self.check_call_limits(invoice.user_id, 'pro')  # Get actual tier
+        tier = await self.tier_resolver.resolve(invoice.user_id)
+        can_call, reason = await self.check_call_limits(invoice.user_id, tier)
         if not can_call:
             logger.error(f"Cannot initiate call for invoice {invoice.id}: {reason}")
             return {'success': False, 'error': reason}
@@ -342,21 +396,20 @@ class AIVoiceCallHandler:
             commitment = json.loads(extraction.choices[0].message.content)
             
             if commitment and commitment.get('confidence', 0) > 0.7:
-                with get_db() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("""
-                            INSERT INTO payment_commitments 
-                            (invoice_id, amount, payment_date, type, source, confidence, transcript, created_at)
-                            VALUES (%s, %s, %s, %s, 'ai_call', %s, %s, NOW())
-                        """, (
-                            invoice_id,
-                            commitment['amount'],
-                            commitment['date'],
-                            commitment['type'],
-                            commitment['confidence'],
-                            json.dumps({'customer': customer_speech, 'agent': ai_response})
-                        ))
-                        conn.commit()
+                async with database.open('ai_calls') as db:
+                    await db.execute("""
+                        INSERT INTO payment_commitments 
+                        (invoice_id, amount, payment_date, type, source, confidence, transcript, created_at)
+                        VALUES (:invoice_id, :amount, :payment_date, :type, 'ai_call', :confidence, :transcript, NOW())
+                    """, {
+                        'invoice_id': invoice_id,
+                        'amount': commitment['amount'],
+                        'payment_date': date.fromisoformat(commitment['date']),
+                        'type': commitment['type'],
+                        'confidence': commitment['confidence'],
+                        'transcript': json.dumps({'customer': customer_speech, 'agent': ai_response})
+                    })
+                    await db.commit()
                 
                 # Send confirmation SMS
                 await self.send_commitment_sms(invoice_id, commitment)
@@ -385,41 +438,40 @@ class AIVoiceCallHandler:
     async def log_call_attempt(self, invoice_id: str, call_sid: str, status: str):
         """Log call attempt to database"""
         
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO collection_events 
-                    (invoice_id, event_type, event_status, call_sid, cost, created_at)
-                    VALUES (%s, 'ai_call', %s, %s, %s, NOW())
-                """, (invoice_id, status, call_sid, self.cost_per_minute * 2))
-                conn.commit()
+        async with database.open('ai_calls') as db:
+            await db.execute("""
+                INSERT INTO collection_events 
+                (invoice_id, event_type, event_status, call_sid, cost, created_at)
+                VALUES (:invoice_id, 'ai_call', :status, :call_sid, :cost, NOW())
+            """, {'invoice_id': invoice_id, 'status': status, 'call_sid': call_sid,
+                  'cost': self.cost_per_minute * 2})
+            await db.commit()
+        # The event shows in the invoice's detail
+        await self.invoice_cache.invalidate(invoice_id)
     
     async def log_conversation(self, call_sid: str, customer_speech: str, ai_response: str):
         """Log conversation turn to database"""
         
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO call_transcripts 
-                    (call_sid, speaker, text, timestamp)
-                    VALUES 
-                    (%s, 'customer', %s, NOW()),
-                    (%s, 'ai', %s, NOW())
-                """, (call_sid, customer_speech, call_sid, ai_response))
-                conn.commit()
+        async with database.open('ai_calls') as db:
+            await db.execute("""
+                INSERT INTO call_transcripts 
+                (call_sid, speaker, text, timestamp)
+                VALUES 
+                (:call_sid, 'customer', :customer_speech, NOW()),
+                (:call_sid, 'ai', :ai_response, NOW())
+            """, {'call_sid': call_sid, 'customer_speech': customer_speech, 'ai_response': ai_response})
+            await db.commit()
     
     async def send_commitment_sms(self, invoice_id: str, commitment: Dict):
         """Send SMS confirmation of payment commitment"""
         
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT i.*, c.phone 
-                    FROM invoices i
-                    JOIN clients c ON i.client_id = c.id
-                    WHERE i.id = %s
-                """, (invoice_id,))
-                invoice = cur.fetchone()
+        async with database.open('ai_calls') as db:
+            invoice = (await db.execute("""
+                SELECT i.*, c.phone 
+                FROM invoices i
+                JOIN clients c ON i.client_id = c.id
+                WHERE i.id = :id
+            """, {'id': invoice_id})).fetchone()
         
         if invoice and invoice['phone']:
             message = f"""Payment confirmation:
@@ -438,8 +490,11 @@ Reply STOP to opt out"""
 class PaymentPredictor:
     """ML model to predict payment likelihood and optimize collection strategy"""
     
-    def __init__(self):
-        self.model = None
+    def __init__(self, allow_training: bool = True):
+        self.registry = ModelRegistry(MODEL_REGISTRY_DIR, poll_interval=MODEL_POLL_INTERVAL)
+        # Live model version; replaced as a whole when a new version is activated
+        self.models = ModelSet(version=None)
+        self.allow_training = allow_training
         self.feature_names = [
             'amount', 'days_overdue', 'previous_late_payments',
             'client_age_days', 'industry_code', 'collection_stage',
@@ -448,16 +503,32 @@ class PaymentPredictor:
         ]
         self.load_or_train_model()
     
+    @property
+    def model(self):
+        return self.models.get('payment_predictor')
+    
+    @property
+    def engine(self):
+        """Flattened copy of self.model for fast inference"""
+        return self.models.engines.get('payment_predictor')
+    
     def load_or_train_model(self):
-        """Load existing model or train new one"""
+        """Load the active model version or train a new one"""
         
-        model_path = 'models/payment_predictor.pkl'
+        model_set = self.registry.load_active()
         
-        if os.path.exists(model_path):
-            self.model = joblib.load(model_path)
-            logger.info("Loaded existing payment prediction model")
-        else:
+        if model_set is None and os.path.exists(LEGACY_MODEL_PATH):
+            # Pre-registry deployments kept a single pickle; publish it as the first version
+            self.registry.publish({'payment_predictor': joblib.load(LEGACY_MODEL_PATH)}, {})
+            model_set = self.registry.load_active()
+        
+        if model_set is not None:
+            self.swap_models(model_set)
+            logger.info(f"Loaded payment prediction model version {model_set.version}")
+        elif self.allow_training:
             self.train_model()
+        else:
+            logger.warning("No payment prediction model found, using rule-based predictions")
     
     def train_model(self):
         """Train payment prediction model on historical data"""
@@ -467,54 +538,76 @@ class PaymentPredictor:
             X, y = self.prepare_training_data()
             
             # Train Random Forest
-            self.model = RandomForestClassifier(
+            model = RandomForestClassifier(
                 n_estimators=100,
                 max_depth=10,
                 min_samples_split=5,
                 random_state=42
             )
             
-            self.model.fit(X, y)
+            model.fit(X, y)
             
-            # Save model
-            os.makedirs('models', exist_ok=True)
-            joblib.dump(self.model, 'models/payment_predictor.pkl')
+            # Publish as a new immutable version; every worker swaps to it on its next poll
+            version = self.registry.publish(
+                {'payment_predictor': model},
+                {'trainedAt': datetime.utcnow().isoformat(), 'sampleCount': len(X)},
+                engines={'payment_predictor': compile_model(model)}
+            )
+            self.swap_models(self.registry.load(version))
             
-            logger.info(f"Trained payment prediction model with {len(X)} samples")
+            logger.info(f"Trained payment prediction model version {version} with {len(X)} samples")
             
         except Exception as e:
             logger.error(f"Failed to train model: {e}")
-            # Use simple rule-based fallback
-            self.model = None
+            # Keep serving the current version (or the rule-based fallback)
+    
+    def swap_models(self, model_set: ModelSet):
+        """Make a loaded version live in one assignment"""
+        
+        # Versions published with an engine are served from its memory-mapped
+        # arrays; older ones are unpickled and compiled here
+        if 'payment_predictor' not in model_set.engines and model_set.has('payment_predictor'):
+            model = model_set.get('payment_predictor')
+            try:
+                # Flatten the forest into node arrays so scoring skips sklearn overhead
+                model_set.engines['payment_predictor'] = compile_model(model)
+            except Exception as e:
+                logger.warning(f"Could not compile payment model, using sklearn predict: {e}")
+        
+        self.models = model_set
+    
+    def refresh_models(self):
+        """Pick up a newly activated registry version, if any"""
+        
+        model_set = self.registry.poll(self.models.version)
+        if model_set is not None:
+            self.swap_models(model_set)
+            logger.info(f"Switched payment prediction model to version {model_set.version}")
     
     def prepare_training_data(self) -> Tuple[np.ndarray, np.ndarray]:
         """Prepare features and labels from historical data"""
         
-        with get_db() as conn:
+        with get_db('predictor') as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT 
                         i.amount,
                         i.days_overdue,
-                        COUNT(DISTINCT p.id) as previous_late_payments,
+                        COALESCE(cf.late_payments, 0) as previous_late_payments,
                         EXTRACT(DAY FROM NOW() - c.created_at) as client_age_days,
                         COALESCE(c.industry_code, 0) as industry_code,
                         i.collection_stage,
-                        COUNT(DISTINCT d.id) as previous_disputes,
+                        COALESCE(cf.disputes, 0) as previous_disputes,
                         CASE WHEN c.payment_method_id IS NOT NULL THEN 1 ELSE 0 END as payment_method_on_file,
-                        COUNT(DISTINCT e.id) FILTER (WHERE e.opened = true) as email_opens,
-                        COUNT(DISTINCT s.id) FILTER (WHERE s.responded = true) as sms_responses,
-                        COUNT(DISTINCT pp.id) as partial_payments,
+                        COALESCE(inf.email_opens, 0) as email_opens,
+                        COALESCE(inf.sms_responses, 0) as sms_responses,
+                        COALESCE(inf.partial_payments, 0) as partial_payments,
                         CASE WHEN i.paid_date IS NOT NULL THEN 1 ELSE 0 END as was_paid
                     FROM invoices i
                     LEFT JOIN clients c ON i.client_id = c.id
-                    LEFT JOIN payments p ON p.client_id = c.id AND p.late = true
-                    LEFT JOIN disputes d ON d.client_id = c.id
-                    LEFT JOIN email_events e ON e.invoice_id = i.id
-                    LEFT JOIN sms_events s ON s.invoice_id = i.id
-                    LEFT JOIN partial_payments pp ON pp.invoice_id = i.id
+                    LEFT JOIN client_feature_counters cf ON cf.client_id = i.client_id::text
+                    LEFT JOIN invoice_feature_counters inf ON inf.invoice_id = i.id::text
                     WHERE i.due_date < NOW() - INTERVAL '60 days'
-                    GROUP BY i.id, c.id
                     LIMIT 10000
                 """)
                 
@@ -549,64 +642,87 @@ class PaymentPredictor:
     def predict_payment_probability(self, invoice: Invoice) -> float:
         """Predict probability of payment for an invoice"""
         
-        if self.model is None:
+        return float(self.predict_payment_probabilities([invoice])[0])
+    
+    def predict_payment_probabilities(self, invoices: List[Invoice]) -> np.ndarray:
+        """Predict payment probabilities for a batch of invoices in one pass"""
+        
+        if not invoices:
+            return np.zeros(0)
+        
+        # Snapshot the live version so a concurrent swap cannot change models mid-batch
+        self.refresh_models()
+        models = self.models
+        model = models.engines.get('payment_predictor') or models.get('payment_predictor')
+        
+        if model is None:
             # Fallback to rule-based prediction
-            return self.rule_based_prediction(invoice)
+            return np.array([self.rule_based_prediction(invoice) for invoice in invoices])
         
         try:
-            # Prepare features
-            features = self.extract_features(invoice)
-            
-            # Predict probability
-            prob = self.model.predict_proba([features])[0][1]
-            
-            return float(prob)
+            # One feature query and one predict_proba call for the whole batch
+            features = self.extract_features_batch(invoices)
+            return model.predict_proba(features)[:, 1]
             
         except Exception as e:
-            logger.error(f"Prediction failed: {e}")
-            return self.rule_based_prediction(invoice)
+            logger.error(f"Batch prediction failed: {e}")
+            return np.array([self.rule_based_prediction(invoice) for invoice in invoices])
     
     def extract_features(self, invoice: Invoice) -> List[float]:
         """Extract features from invoice for prediction"""
         
-        # Get additional data
-        with get_db() as conn:
+        return self.extract_features_batch([invoice])[0].tolist()
+    
+    def extract_features_batch(self, invoices: List[Invoice]) -> np.ndarray:
+        """Extract the feature matrix for a batch of invoices with a single query
+        
+        Behavioural aggregates are keyed reads from the feature counter
+        tables maintained by feature_store.FeatureStore.
+        """
+        
+        invoice_ids = tuple(invoice.id for invoice in invoices)
+        
+        with get_db('predictor') as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT 
-                        COUNT(DISTINCT p.id) as previous_late_payments,
+                        i.id as invoice_id,
+                        COALESCE(cf.late_payments, 0) as previous_late_payments,
                         EXTRACT(DAY FROM NOW() - c.created_at) as client_age_days,
                         COALESCE(c.industry_code, 0) as industry_code,
-                        COUNT(DISTINCT d.id) as previous_disputes,
+                        COALESCE(cf.disputes, 0) as previous_disputes,
                         CASE WHEN c.payment_method_id IS NOT NULL THEN 1 ELSE 0 END as payment_method_on_file,
-                        COUNT(DISTINCT e.id) FILTER (WHERE e.opened = true) as email_opens,
-                        COUNT(DISTINCT s.id) FILTER (WHERE s.responded = true) as sms_responses,
-                        COUNT(DISTINCT pp.id) as partial_payments
-                    FROM clients c
-                    LEFT JOIN payments p ON p.client_id = c.id AND p.late = true
-                    LEFT JOIN disputes d ON d.client_id = c.id
-                    LEFT JOIN email_events e ON e.invoice_id = %s
-                    LEFT JOIN sms_events s ON s.invoice_id = %s
-                    LEFT JOIN partial_payments pp ON pp.invoice_id = %s
-                    WHERE c.id = %s
-                    GROUP BY c.id
-                """, (invoice.id, invoice.id, invoice.id, invoice.client_id))
+                        COALESCE(inf.email_opens, 0) as email_opens,
+                        COALESCE(inf.sms_responses, 0) as sms_responses,
+                        COALESCE(inf.partial_payments, 0) as partial_payments
+                    FROM invoices i
+                    LEFT JOIN clients c ON c.id = i.client_id
+                    LEFT JOIN client_feature_counters cf ON cf.client_id = i.client_id::text
+                    LEFT JOIN invoice_feature_counters inf ON inf.invoice_id = i.id::text
+                    WHERE i.id IN %(invoice_ids)s
+                """, {'invoice_ids': invoice_ids})
                 
-                data = cur.fetchone()
+                rows = {str(row['invoice_id']): row for row in cur.fetchall()}
         
-        return [
-            invoice.amount,
-            invoice.days_overdue,
-            data['previous_late_payments'] if data else 0,
-            data['client_age_days'] if data else 0,
-            data['industry_code'] if data else 0,
-            invoice.collection_stage,
-            data['previous_disputes'] if data else 0,
-            data['payment_method_on_file'] if data else 0,
-            data['email_opens'] if data else 0,
-            data['sms_responses'] if data else 0,
-            data['partial_payments'] if data else 0
-        ]
+        features = np.zeros((len(invoices), len(self.feature_names)))
+        
+        for idx, invoice in enumerate(invoices):
+            data = rows.get(str(invoice.id))
+            features[idx] = [
+                invoice.amount,
+                invoice.days_overdue,
+                data['previous_late_payments'] if data else 0,
+                (data['client_age_days'] or 0) if data else 0,
+                data['industry_code'] if data else 0,
+                invoice.collection_stage,
+                data['previous_disputes'] if data else 0,
+                data['payment_method_on_file'] if data else 0,
+                data['email_opens'] if data else 0,
+                data['sms_responses'] if data else 0,
+                data['partial_payments'] if data else 0
+            ]
+        
+        return features
     
     def rule_based_prediction(self, invoice: Invoice) -> float:
         """Simple rule-based fallback prediction"""
@@ -639,6 +755,21 @@ class PaymentPredictor:
         
         payment_prob = self.predict_payment_probability(invoice)
         
+        return self.build_strategy(invoice, payment_prob)
+    
+    def recommend_collection_strategies(self, invoices: List[Invoice]) -> List[Dict]:
+        """Recommend collection strategies for a batch of invoices"""
+        
+        payment_probs = self.predict_payment_probabilities(invoices)
+        
+        return [
+            self.build_strategy(invoice, float(payment_prob))
+            for invoice, payment_prob in zip(invoices, payment_probs)
+        ]
+    
+    def build_strategy(self, invoice: Invoice, payment_prob: float) -> Dict:
+        """Map a payment probability to a collection strategy"""
+        
         strategy = {
             'payment_probability': payment_prob,
             'recommended_action': None,
@@ -703,14 +834,124 @@ class PaymentPredictor:
         return estimated_cost
 
 
+def invoice_from_row(invoice_data: Dict) -> Invoice:
+    """Build an Invoice from an escalation query row"""
+    
+    return Invoice(
+        id=invoice_data['id'],
+        user_id=invoice_data['user_id'],
+        client_id=invoice_data['client_id'],
+        amount=invoice_data['amount'],
+        currency=invoice_data['currency'],
+        due_date=invoice_data['due_date'],
+        days_overdue=int(invoice_data['days_overdue']),
+        client_name=invoice_data['client_name'],
+        client_email=invoice_data['client_email'],
+        client_phone=invoice_data['client_phone'],
+        collection_stage=invoice_data.get('collection_stage', 0),
+        payment_history=[],
+        dispute_status=invoice_data.get('dispute_status')
+    )
+
+
 # Celery Tasks for async processing
 @celery_app.task
-def process_collection_escalation():
-    """Daily task to process collection escalations"""
+def process_collection_escalation(run_id: Optional[str] = None):
+    """Daily task to process collection escalations
+    
+    Fans the run out into one subtask per user_id hash shard. Calling it
+    again for the same run_id resumes unfinished shards from their
+    checkpoints and skips completed ones.
+    """
+    
+    run_id = run_id or datetime.now().strftime('%Y-%m-%d')
+    
+    for shard in range(ESCALATION_SHARDS):
+        process_escalation_shard.delay(run_id, shard, ESCALATION_SHARDS)
+    
+    logger.info(f"Dispatched escalation run {run_id} across {ESCALATION_SHARDS} shards")
+
+
+@celery_app.task(acks_late=True, reject_on_worker_lost=True)
+def process_escalation_shard(run_id: str, shard: int, num_shards: int):
+    """Process one user_id hash shard of an escalation run"""
+    
+    asyncio.run(run_escalation_shard(run_id, shard, num_shards))
+
+
+# Per-worker predictor, loaded once and reused across shard tasks
+_predictor: Optional[PaymentPredictor] = None
+
+
+def get_predictor() -> PaymentPredictor:
+    """Return the worker's shared predictor without triggering a retrain"""
+    
+    global _predictor
+    if _predictor is None:
+        _predictor = PaymentPredictor(allow_training=False)
+    return _predictor
+
+
+async def run_escalation_shard(run_id: str, shard: int, num_shards: int):
+    """Run a shard, resuming from its checkpoint if a previous attempt died"""
+    
+    try:
+        await stream_collection_escalation(get_predictor(), run_id, shard, num_shards)
+    finally:
+        # Connections are bound to this event loop; drop them so the next
+        # task run in this worker starts with a clean pool
+        await redis_client.connection_pool.disconnect()
+        await rate_limiter.redis.connection_pool.disconnect()
+        await database.close(sync=False)
+
+
+def checkpoint_key(run_id: str, shard: int, num_shards: int) -> str:
+    return f"escalation_run:{run_id}:{num_shards}:{shard}"
+
+
+def action_claim_key(invoice_id: str) -> str:
+    return f"collection_action:{invoice_id}:{datetime.now().strftime('%Y-%m-%d')}"
+
+
+def pending_action_key(invoice_id: str) -> str:
+    return f"collection_pending:{invoice_id}"
+
+
+async def stream_collection_escalation(predictor: PaymentPredictor, run_id: str,
+                                       shard: int, num_shards: int):
+    """Stream a shard's overdue invoices from a server-side cursor chunk by chunk
+    
+    Invoices are read in (due_date, id) order and the last processed key is
+    checkpointed after every chunk, so a redelivered task continues where
+    the previous attempt stopped.
+    """
     
-    with get_db() as conn:
-        with conn.cursor() as cur:
-            # Get all overdue invoices
+    key = checkpoint_key(run_id, shard, num_shards)
+    checkpoint = {k.decode(): v.decode() for k, v in (await redis_client.hgetall(key)).items()}
+    
+    if checkpoint.get('done') == '1':
+        logger.info(f"Escalation shard {shard}/{num_shards} of run {run_id} already complete")
+        return
+    
+    params = {
+        'num_shards': num_shards,
+        'shard': shard,
+        'after_due_date': checkpoint.get('due_date'),
+        'after_id': checkpoint.get('invoice_id'),
+    }
+    processed = int(checkpoint.get('processed', 0))
+    queued = int(checkpoint.get('queued', 0))
+    
+    if params['after_id']:
+        logger.info(f"Resuming escalation shard {shard}/{num_shards} of run {run_id} after {processed} invoices")
+    
+    with get_db('escalation') as conn:
+        # Named (server-side) cursor so rows are streamed rather than
+        # materialised in memory all at once
+        with conn.cursor(name=f'collection_escalation_{shard}') as cur:
+            cur.itersize = ESCALATION_CHUNK_SIZE
+            
+            # Get this shard's overdue invoices
             cur.execute("""
                 SELECT i.*, c.name as client_name, c.email as client_email, 
                        c.phone as client_phone, u.tier as user_tier,
@@ -721,39 +962,94 @@ def process_collection_escalation():
                 WHERE i.status = 'overdue' 
                   AND i.collection_status = 'active'
                   AND i.paid_date IS NULL
-                ORDER BY i.due_date ASC
-            """)
+                  -- Shifted into [0, 2^32) as bigint: ABS() of the int4 minimum overflows
+                  AND MOD(HASHTEXT(i.user_id::text)::bigint + 2147483648, %(num_shards)s) = %(shard)s
+                  AND (%(after_id)s IS NULL
+                       OR (i.due_date, i.id::text) > (%(after_due_date)s, %(after_id)s))
+                ORDER BY i.due_date ASC, i.id::text ASC
+            """, params)
             
-            invoices = cur.fetchall()
-    
-    handler = AIVoiceCallHandler()
-    predictor = PaymentPredictor()
-    
-    for invoice_data in invoices:
-        invoice = Invoice(
-            id=invoice_data['id'],
-            user_id=invoice_data['user_id'],
-            client_id=invoice_data['client_id'],
-            amount=invoice_data['amount'],
-            currency=invoice_data['currency'],
-            due_date=invoice_data['due_date'],
-            days_overdue=int(invoice_data['days_overdue']),
-            client_name=invoice_data['client_name'],
-            client_email=invoice_data['client_email'],
-            client_phone=invoice_data['client_phone'],
-            collection_stage=invoice_data.get('collection_stage', 0),
-            payment_history=[],
-            dispute_status=invoice_data.get('dispute_status')
-        )
-        
-        # Get collection strategy
-        strategy = predictor.recommend_collection_strategy(invoice)
-        
-        # Determine action based on days overdue and strategy
-        action = determine_collection_action(invoice, strategy, invoice_data['user_tier'])
-        
-        if action:
+            while True:
+                rows = cur.fetchmany(ESCALATION_CHUNK_SIZE)
+                if not rows:
+                    break
+                
+                queued += await process_escalation_chunk(rows, predictor)
+                processed += len(rows)
+                
+                last = rows[-1]
+                await redis_client.hset(key, mapping={
+                    'due_date': str(last['due_date']),
+                    'invoice_id': str(last['id']),
+                    'processed': processed,
+                    'queued': queued,
+                })
+                await redis_client.expire(key, ESCALATION_CHECKPOINT_TTL)
+    
+    await redis_client.hset(key, 'done', 1)
+    await redis_client.expire(key, ESCALATION_CHECKPOINT_TTL)
+    
+    logger.info(f"Escalation shard {shard}/{num_shards} of run {run_id}: {processed} invoices, {queued} actions queued")
+
+
+async def process_escalation_chunk(rows: List[Dict], predictor: PaymentPredictor) -> int:
+    """Score a chunk of invoices in one pass and queue any due actions"""
+    
+    invoices = [invoice_from_row(row) for row in rows]
+    
+    # Get collection strategies for the whole chunk
+    strategies = predictor.recommend_collection_strategies(invoices)
+    
+    # Actions refused for quota on earlier runs, read for the chunk in one round trip
+    pending = [
+        value.decode() if isinstance(value, bytes) else value
+        for value in await redis_client.mget([pending_action_key(invoice.id) for invoice in invoices])
+    ]
+    
+    # Determine action based on days overdue and strategy
+    actions = await asyncio.gather(*[
+        determine_collection_action(invoice, strategy, row['user_tier'], pending_action)
+        for invoice, strategy, row, pending_action in zip(invoices, strategies, rows, pending)
+    ])
+    
+    # The rows already carry each user's tier, so quota checks need no lookups
+    for row in rows:
+        default_tier_resolver.prime(row['user_id'], row['user_tier'])
+    
+    # Check every due action's quota in one round trip; actions for the same
+    # user share that user's remaining budget
+    due = [(invoice, action) for invoice, action in zip(invoices, actions) if action]
+    metered = [(invoice, action) for invoice, action in due if ACTION_QUOTAS.get(action)]
+    checks = await rate_limiter.check_limits_many(
+        (invoice.user_id, ACTION_QUOTAS[action], 1) for invoice, action in metered
+    )
+    refused = {invoice.id for (invoice, _), check in zip(metered, checks) if not check['allowed']}
+    await rate_limiter.consume_limits_many(
+        (invoice.user_id, ACTION_QUOTAS[action], 1) for invoice, action in metered if invoice.id not in refused
+    )
+    
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for invoice, action in due:
+            if invoice.id in refused:
+                # Release the day's action slot and keep the action pending:
+                # the stage's day has passed by the next run, so without this
+                # the action would never be retried
+                pipe.delete(action_claim_key(invoice.id))
+                pipe.set(pending_action_key(invoice.id), action, ex=ESCALATION_PENDING_TTL)
+            else:
+                pipe.delete(pending_action_key(invoice.id))
+        await pipe.execute()
+    
+    if refused:
+        logger.info(f"Deferred {len(refused)} collection actions over their users' quota")
+    
+    queued = 0
+    for invoice, action in due:
+        if invoice.id not in refused:
             execute_collection_action.delay(invoice.id, action)
+            queued += 1
+    
+    return queued
 
 
 @celery_app.task
@@ -765,14 +1061,14 @@ def execute_collection_action(invoice_id: str, action: str):
     pass
 
 
-async def determine_collection_action(invoice: Invoice, strategy: Dict, user_tier: str) -> Optional[str]:
-    """Determine which collection action to take"""
-
-    # Check what actions have already been taken today
-    action_key = f"collection_action:{invoice.id}:{datetime.now().strftime('%Y-%m-%d')}"
-    if await redis_client.exists(action_key):
-        return None  # Already acted today
+async def determine_collection_action(invoice: Invoice, strategy: Dict, user_tier: str,
+                                      pending_action: Optional[str] = None) -> Optional[str]:
+    """Determine which collection action to take
     
+    `pending_action` is an action an earlier run refused for quota; it is
+    retried unless today's stage brings a newer action.
+    """
+
     # Map days overdue to actions based on tier
     action_map = {
         7: 'gentle_email',
@@ -788,13 +1084,21 @@ async def determine_collection_action(invoice: Invoice, strategy: Dict, user_tie
     }
     
     # Check if we should act today
-    action = action_map.get(invoice.days_overdue)
+    action = action_map.get(invoice.days_overdue) or pending_action
     
     # Override with strategy recommendation if urgent
     if strategy['urgency'] in ['high', 'critical'] and strategy['payment_probability'] < 0.3:
         if invoice.days_overdue >= 20 and user_tier in ['growth', 'pro']:
             action = 'immediate_ai_call'
     
+    if not action:
+        return None
+    
+    # Claim today's action slot atomically so a resumed or duplicated shard
+    # never queues a second action for the same invoice
+    if not await redis_client.set(action_claim_key(invoice.id), action, nx=True, ex=24 * 60 * 60):
+        return None  # Already acted today
+    
     return action
 
 
@@ -6,30 +6,40 @@ Combines Node.js/Express patterns with Python/FastAPI for optimal performance
 
 from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from fastapi.staticfiles import StaticFiles
 import uvicorn
 from typing import Optional, Dict, List
 from datetime import datetime, timedelta
 import stripe
 import sendgrid
-from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Mail, CustomArg, Personalization, To
+from sendgrid.helpers.eventwebhook import EventWebhook, EventWebhookHeader
 from twilio.twiml.voice_response import VoiceResponse
+from twilio.request_validator import RequestValidator
 import redis.asyncio as redis
 import asyncio
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 import os
 import json
 import hashlib
 import hmac
+import base64
+import time
 from pydantic import BaseModel, Field
 import logging
 
 # Import our modules
 from ai_collection_system import AIVoiceCallHandler, PaymentPredictor, Invoice
+from tier_resolver import TierResolver
 from collection_templates import CollectionTemplates
 from rate_limiter_py import RateLimiter
-from idempotency_py import IdempotencyHandler
+from idempotency_py import IdempotencyHandler, IdempotencyKeyMiddleware
+from feature_store import FeatureStore
+from invoice_numbers import InvoiceNumberAllocator
+from invoice_pdf import InvoicePdfRenderer
+from invoice_cache import InvoiceDetailCache
+from database import get_database, AsyncDB
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -70,25 +80,54 @@ stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 sg = sendgrid.SendGridAPIClient(api_key=os.environ.get('SENDGRID_API_KEY'))
 redis_client = redis.from_url(os.environ.get('REDIS_URL'))
 
-# Database setup
-DATABASE_URL = os.environ.get('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Database setup: the process-wide pools, shared with ai_collection_system
+database = get_database()
+
+async def load_user_tier(user_id: str) -> Optional[str]:
+    async with database.open('tier_resolver') as db:
+        user = (await db.execute("SELECT tier FROM users WHERE id = :id", {'id': user_id})).fetchone()
+        return user['tier'] if user else None
 
 # Initialize our custom handlers
-rate_limiter = RateLimiter()
+tier_resolver = TierResolver(load_user_tier, redis_client=redis_client)
+rate_limiter = RateLimiter(tier_resolver=tier_resolver)
 idempotency_handler = IdempotencyHandler()
-ai_handler = AIVoiceCallHandler()
+invoice_cache = InvoiceDetailCache(redis_client=redis_client)
+ai_handler = AIVoiceCallHandler(tier_resolver=tier_resolver, invoice_cache=invoice_cache)
 predictor = PaymentPredictor()
 templates = CollectionTemplates()
+feature_store = FeatureStore()
+invoice_numbers = InvoiceNumberAllocator(database)
+pdf_renderer = InvoicePdfRenderer()
+
+# Invoices accepted by one POST /api/invoices/bulk request
+BULK_INVOICE_LIMIT = int(os.environ.get('BULK_INVOICE_LIMIT', 5000))
+
+async def idempotency_user(headers: Dict[str, str]) -> Optional[str]:
+    """Firebase uid that scopes Idempotency-Key replays; None passes the request through"""
+    authorization = headers.get('authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    try:
+        # Verification can fetch Google's signing keys; keep it off the event loop
+        decoded_token = await asyncio.to_thread(firebase_auth.verify_id_token, authorization.split('Bearer ')[1])
+        return decoded_token['uid']
+    except Exception:
+        return None
+
+# Retried POSTs carrying an Idempotency-Key get the first response back
+app.add_middleware(IdempotencyKeyMiddleware, handler=idempotency_handler, identify=idempotency_user)
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+get_db = database.session
+
+# Rendered invoice PDFs, linked from API responses and invoice emails
+os.makedirs(pdf_renderer.output_dir, exist_ok=True)
+app.mount("/invoices/pdf", StaticFiles(directory=pdf_renderer.output_dir), name="invoice_pdfs")
+
+def pdf_base_url(request: Request) -> str:
+    """Where this app serves invoice PDFs, as the client reached it"""
+    return str(request.url_for('invoice_pdfs', path=''))
 
 # Pydantic models
 class InvoiceCreate(BaseModel):
@@ -101,6 +140,9 @@ class InvoiceCreate(BaseModel):
     tax_rate: float = 0.20
     send_immediately: bool = True
 
+class BulkInvoiceCreate(BaseModel):
+    invoices: List[InvoiceCreate]
+
 class PaymentPlan(BaseModel):
     invoice_id: str
     initial_payment: float
@@ -119,6 +161,22 @@ class CollectionAction(BaseModel):
     force: bool = False
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    # Hand unspent leased API quota back to other workers
+    await rate_limiter.close()
+    await tier_resolver.close()
+    await idempotency_handler.close()
+    await database.close()
+    pdf_renderer.close()
+
+
+@app.exception_handler(PoolTimeoutError)
+async def database_pool_exhausted(request: Request, exc: PoolTimeoutError):
+    # Every connection stayed busy for DB_POOL_TIMEOUT; shed load instead of queueing
+    return JSONResponse(status_code=503, content={"detail": "Database busy"}, headers={"Retry-After": "1"})
+
+
 # Health check
 @app.get("/health")
 async def health_check():
@@ -134,9 +192,8 @@ async def health_check():
 
 async def check_database():
     try:
-        db = SessionLocal()
-        db.execute("SELECT 1")
-        db.close()
+        async with database.open('health') as db:
+            await db.execute("SELECT 1")
         return "connected"
     except:
         return "disconnected"
@@ -160,120 +217,235 @@ async def check_stripe():
 @app.post("/api/invoices")
 async def create_invoice(
     invoice: InvoiceCreate,
+    request: Request,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
     """Create a new invoice with automatic sending"""
     
-    # Check rate limits
-    limit_check = await rate_limiter.check_limit(user_id, 'invoices', 1)
+    # Reserve rate limit quota (checked and consumed atomically)
+    limit_check = await rate_limiter.reserve(user_id, 'invoices', 1)
     if not limit_check['allowed']:
         raise HTTPException(status_code=429, detail=limit_check['reason'])
     
-    # Generate invoice number
-    invoice_number = generate_invoice_number(user_id, db)
-    
-    # Calculate totals
-    subtotal = sum(item['quantity'] * item['price'] for item in invoice.line_items)
-    tax_amount = subtotal * invoice.tax_rate
-    total = subtotal + tax_amount
-    
-    # Create invoice in database
-    db_invoice = {
-        'id': generate_uuid(),
-        'user_id': user_id,
-        'client_id': invoice.client_id,
-        'invoice_number': invoice_number,
-        'amount': total,
-        'subtotal': subtotal,
-        'tax_amount': tax_amount,
-        'currency': invoice.currency,
-        'description': invoice.description,
-        'due_date': invoice.due_date,
-        'line_items': json.dumps(invoice.line_items),
-        'status': 'draft',
-        'created_at': datetime.utcnow()
-    }
-    
-    db.execute(
-        """INSERT INTO invoices 
-           (id, user_id, client_id, invoice_number, amount, subtotal, 
-            tax_amount, currency, description, due_date, line_items, status, created_at)
-           VALUES (:id, :user_id, :client_id, :invoice_number, :amount, :subtotal,
-                   :tax_amount, :currency, :description, :due_date, :line_items, :status, :created_at)""",
-        db_invoice
-    )
-    db.commit()
-    
-    # Generate PDF
-    pdf_url = await generate_invoice_pdf(db_invoice, db)
+    try:
+        # Allocate the next invoice number (rolls back with the insert below)
+        invoice_number = await invoice_numbers.next_number(user_id, db)
+        
+        # Calculate totals
+        subtotal, tax_amount, total = invoice_totals(invoice)
+        
+        # Create invoice in database
+        db_invoice = {
+            'id': generate_uuid(),
+            'user_id': user_id,
+            'client_id': invoice.client_id,
+            'invoice_number': invoice_number,
+            'amount': total,
+            'subtotal': subtotal,
+            'tax_amount': tax_amount,
+            'currency': invoice.currency,
+            'description': invoice.description,
+            'due_date': invoice.due_date,
+            'line_items': json.dumps(invoice.line_items),
+            'status': 'draft',
+            'created_at': datetime.utcnow()
+        }
+        
+        await db.execute(INSERT_INVOICE, db_invoice)
+        await db.commit()
+    except Exception:
+        # No invoice was created; give the reserved quota back
+        await rate_limiter.release(user_id, 'invoices', 1)
+        raise
+    
+    # Generate PDF; the invoice is already committed, so a failure leaves it a draft
+    try:
+        pdf_url = await generate_invoice_pdf(db_invoice, db, pdf_base_url(request))
+        error = None
+    except Exception as e:
+        logger.error(f"PDF rendering failed for invoice {db_invoice['id']}: {e}")
+        pdf_url = None
+        error = f"PDF rendering failed: {e}"
     
-    # Send immediately if requested
-    if invoice.send_immediately:
-        background_tasks.add_task(send_invoice_email, db_invoice['id'], user_id)
+    # Send immediately if requested, but never without its PDF
+    if invoice.send_immediately and pdf_url:
+        background_tasks.add_task(send_invoice_email, db_invoice['id'], user_id, pdf_base_url(request))
         db_invoice['status'] = 'sent'
-        db.execute(
+        await db.execute(
             "UPDATE invoices SET status = 'sent', sent_date = NOW() WHERE id = :id",
             {'id': db_invoice['id']}
         )
-        db.commit()
+        await db.commit()
+        await invoice_cache.invalidate(db_invoice['id'])
     
-    # Consume rate limit
-    await rate_limiter.consume_limit(user_id, 'invoices', 1)
-    
-    return {
+    response = {
         'invoice_id': db_invoice['id'],
         'invoice_number': invoice_number,
         'amount': total,
         'pdf_url': pdf_url,
         'status': db_invoice['status']
     }
+    if error:
+        response['error'] = error
+    return response
+
+
+@app.post("/api/invoices/bulk")
+async def create_invoices_bulk(
+    bulk: BulkInvoiceCreate,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncDB = Depends(get_db),
+    user_id: str = Depends(get_current_user)
+):
+    """Create many invoices at once, e.g. a spreadsheet import
+    
+    Returns one result per submitted invoice, in order. Rows with invalid
+    line items or an unknown client are reported and skipped; the rest are
+    numbered, inserted in one transaction, and rendered across the PDF pool.
+    """
+    
+    if len(bulk.invoices) > BULK_INVOICE_LIMIT:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_INVOICE_LIMIT} invoices per request")
+    
+    results = [None] * len(bulk.invoices)
+    
+    def fail(index, error):
+        results[index] = {'index': index, 'status': 'failed', 'error': error}
+    
+    known_clients = {row['id'] for row in (await db.execute(
+        "SELECT id FROM clients WHERE id = ANY(:ids)",
+        {'ids': list({invoice.client_id for invoice in bulk.invoices})}
+    )).fetchall()}
+    
+    accepted = []
+    for index, invoice in enumerate(bulk.invoices):
+        if invoice.client_id not in known_clients:
+            fail(index, f"Unknown client {invoice.client_id}")
+            continue
+        try:
+            accepted.append((index, invoice, invoice_totals(invoice)))
+        except (KeyError, TypeError) as e:
+            fail(index, f"Invalid line items: {e}")
+    
+    if accepted:
+        # One reservation for the whole batch: it is imported entirely or not at all
+        limit_check = await rate_limiter.reserve(user_id, 'invoices', len(accepted))
+        if not limit_check['allowed']:
+            raise HTTPException(status_code=429, detail=limit_check['reason'])
+        
+        try:
+            # One consecutive run of numbers, rolled back with the rows if the insert fails
+            numbers = await invoice_numbers.next_numbers(user_id, len(accepted), db)
+            created_at = datetime.utcnow()
+            db_invoices = [{
+                'id': generate_uuid(),
+                'user_id': user_id,
+                'client_id': invoice.client_id,
+                'invoice_number': number,
+                'amount': total,
+                'subtotal': subtotal,
+                'tax_amount': tax_amount,
+                'currency': invoice.currency,
+                'description': invoice.description,
+                'due_date': invoice.due_date,
+                'line_items': json.dumps(invoice.line_items),
+                'status': 'draft',
+                'created_at': created_at
+            } for (_, invoice, (subtotal, tax_amount, total)), number in zip(accepted, numbers)]
+            
+            # A parameter list runs as one pipelined batch on asyncpg, in one transaction
+            await db.execute(INSERT_INVOICE, db_invoices)
+            await db.commit()
+        except Exception:
+            # Nothing was imported; give the batch's reserved quota back
+            await rate_limiter.release(user_id, 'invoices', len(accepted))
+            raise
+        
+        pdf_urls = await pdf_renderer.render_many(db_invoices, pdf_base_url(request))
+        
+        to_send = []
+        for (index, invoice, _), db_invoice, pdf_url in zip(accepted, db_invoices, pdf_urls):
+            result = {
+                'index': index,
+                'invoice_id': db_invoice['id'],
+                'invoice_number': db_invoice['invoice_number'],
+                'amount': db_invoice['amount'],
+                'pdf_url': None,
+                'status': 'draft'
+            }
+            if isinstance(pdf_url, Exception):
+                # Created, but left as a draft rather than sent without its PDF
+                result['error'] = f"PDF rendering failed: {pdf_url}"
+            else:
+                result['pdf_url'] = pdf_url
+                if invoice.send_immediately:
+                    result['status'] = 'sent'
+                    to_send.append(db_invoice['id'])
+            results[index] = result
+        
+        if to_send:
+            await db.execute(
+                "UPDATE invoices SET status = 'sent', sent_date = NOW() WHERE id = ANY(:ids)",
+                {'ids': to_send}
+            )
+            await db.commit()
+            await invoice_cache.invalidate(*to_send)
+            background_tasks.add_task(send_invoice_emails, to_send, user_id, pdf_base_url(request))
+    
+    return {
+        'created': len(accepted),
+        'failed': len(bulk.invoices) - len(accepted),
+        'results': results
+    }
 
 
 @app.get("/api/invoices/{invoice_id}")
 async def get_invoice(
     invoice_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
-    """Get invoice details"""
+    """Get invoice details, with payment history and collection events"""
     
-    invoice = db.execute(
-        """SELECT i.*, c.name as client_name, c.email as client_email
-           FROM invoices i
-           JOIN clients c ON i.client_id = c.id
-           WHERE i.id = :id AND i.user_id = :user_id""",
-        {'id': invoice_id, 'user_id': user_id}
-    ).fetchone()
+    # Served from Redis when cached; a hit never checks out a connection
+    detail = await invoice_cache.get(invoice_id, user_id, lambda: load_invoice_detail(invoice_id, db))
     
-    if not invoice:
+    if detail is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    # Get payment history
-    payments = db.execute(
-        "SELECT * FROM payments WHERE invoice_id = :id ORDER BY created_at DESC",
-        {'id': invoice_id}
-    ).fetchall()
+    # Already JSON, as Postgres built it
+    return Response(content=detail, media_type="application/json")
+
+
+async def load_invoice_detail(invoice_id: str, db: AsyncDB):
+    """(owner user_id, detail JSON) for the invoice, or None if it does not exist"""
     
-    # Get collection events
-    collection_events = db.execute(
-        "SELECT * FROM collection_events WHERE invoice_id = :id ORDER BY created_at DESC",
+    # One round trip: payments and events are aggregated next to the invoice row
+    row = (await db.execute(
+        """SELECT i.user_id, json_build_object(
+               'invoice', to_jsonb(i) || jsonb_build_object('client_name', c.name, 'client_email', c.email),
+               'payments', COALESCE((SELECT json_agg(p ORDER BY p.created_at DESC)
+                                     FROM payments p WHERE p.invoice_id = i.id), '[]'),
+               'collection_events', COALESCE((SELECT json_agg(e ORDER BY e.created_at DESC)
+                                              FROM collection_events e WHERE e.invoice_id = i.id), '[]')
+           )::text as detail
+           FROM invoices i
+           JOIN clients c ON i.client_id = c.id
+           WHERE i.id = :id""",
         {'id': invoice_id}
-    ).fetchall()
+    )).fetchone()
     
-    return {
-        'invoice': dict(invoice),
-        'payments': [dict(p) for p in payments],
-        'collection_events': [dict(e) for e in collection_events]
-    }
+    return (row['user_id'], row['detail']) if row else None
 
 
 # Payment endpoints
 @app.post("/api/payments/stripe")
 async def process_stripe_payment(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncDB = Depends(get_db)
 ):
     """Process Stripe payment with idempotency"""
     
@@ -295,7 +467,7 @@ async def process_stripe_payment(
     return {"received": True, "processed": result}
 
 
-async def process_stripe_event(event: Dict, db: Session):
+async def process_stripe_event(event: Dict, db: AsyncDB):
     """Process individual Stripe events"""
     
     if event['type'] == 'payment_intent.succeeded':
@@ -307,8 +479,14 @@ async def process_stripe_event(event: Dict, db: Session):
             logger.error(f"No invoice_id in payment intent {payment_intent['id']}")
             return False
         
+        invoice = (await db.execute(
+            """SELECT client_id, amount, due_date < NOW() as late
+               FROM invoices WHERE id = :id""",
+            {'id': invoice_id}
+        )).fetchone()
+        
         # Record payment
-        db.execute(
+        await db.execute(
             """INSERT INTO payments 
                (id, invoice_id, amount, currency, stripe_payment_intent_id, 
                 status, created_at)
@@ -324,7 +502,7 @@ async def process_stripe_event(event: Dict, db: Session):
         )
         
         # Update invoice status
-        db.execute(
+        await db.execute(
             """UPDATE invoices 
                SET status = 'paid', paid_date = NOW(), 
                    collection_status = 'recovered'
@@ -332,7 +510,16 @@ async def process_stripe_event(event: Dict, db: Session):
             {'id': invoice_id}
         )
         
-        db.commit()
+        # Update prediction feature counters in the same transaction; the
+        # predicates match the ones FeatureStore.rebuild() derives from payments
+        if invoice:
+            if invoice['late']:
+                await feature_store.record_late_payment(db, invoice['client_id'])
+            if payment_intent['amount'] / 100 < float(invoice['amount']):
+                await feature_store.record_partial_payment(db, invoice_id)
+        
+        await db.commit()
+        await invoice_cache.invalidate(invoice_id)
         
         # Stop any active collections
         await stop_collections(invoice_id)
@@ -348,7 +535,7 @@ async def process_stripe_event(event: Dict, db: Session):
         invoice_id = payment_intent['metadata'].get('invoice_id')
         
         if invoice_id:
-            db.execute(
+            await db.execute(
                 """INSERT INTO payment_attempts 
                    (invoice_id, amount, status, error_message, created_at)
                    VALUES (:invoice_id, :amount, 'failed', :error, NOW())""",
@@ -358,34 +545,263 @@ async def process_stripe_event(event: Dict, db: Session):
                     'error': payment_intent.get('last_payment_error', {}).get('message')
                 }
             )
-            db.commit()
+            await db.commit()
+    
+    elif event['type'] in ('customer.subscription.created', 'customer.subscription.updated',
+                           'customer.subscription.deleted'):
+        subscription = event['data']['object']
+        
+        # Checkout sets clerkUserId on the customer, not the subscription
+        user_id = subscription.get('metadata', {}).get('userId')
+        if not user_id:
+            # The Stripe client blocks; keep it off the event loop
+            customer = await asyncio.to_thread(stripe.Customer.retrieve, subscription['customer'])
+            user_id = customer.get('metadata', {}).get('clerkUserId')
+        if not user_id:
+            logger.error(f"No user for subscription {subscription['id']}")
+            return False
+        
+        # Tier limits apply from the next request on every worker
+        await tier_resolver.invalidate(user_id)
+    
+    elif event['type'] == 'charge.dispute.created':
+        dispute = event['data']['object']
+        
+        # Find the invoice through the disputed payment
+        invoice = (await db.execute(
+            """SELECT i.id, i.client_id
+               FROM payments p
+               JOIN invoices i ON p.invoice_id = i.id
+               WHERE p.stripe_payment_intent_id = :stripe_id""",
+            {'stripe_id': dispute.get('payment_intent')}
+        )).fetchone()
+        
+        if not invoice:
+            logger.error(f"No payment found for dispute {dispute['id']}")
+            return False
+        
+        await db.execute(
+            """INSERT INTO disputes 
+               (id, client_id, invoice_id, reason, created_at)
+               VALUES (:id, :client_id, :invoice_id, :reason, NOW())""",
+            {
+                'id': generate_uuid(),
+                'client_id': invoice['client_id'],
+                'invoice_id': invoice['id'],
+                'reason': dispute.get('reason')
+            }
+        )
+        await feature_store.record_dispute(db, invoice['client_id'])
+        await db.commit()
     
     return True
 
 
+# Clerk user and subscription events that can change a user's tier
+CLERK_TIER_EVENTS = (
+    'user.created', 'user.updated', 'user.deleted',
+    'subscription.created', 'subscription.updated', 'subscription.active',
+    'subscription.pastDue',
+)
+
+@app.post("/webhooks/clerk")
+async def handle_clerk_webhook(request: Request):
+    """Drop cached tiers when Clerk reports a user or subscription change"""
+    
+    payload = await request.body()
+    svix_id = request.headers.get('svix-id')
+    if not verify_svix_signature(payload, request.headers, os.environ.get('CLERK_WEBHOOK_SECRET', '')):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
+    event = json.loads(payload)
+    result = await idempotency_handler.handle_webhook('clerk', svix_id,
+        lambda: process_clerk_event(event))
+    
+    return {"received": True, "processed": result}
+
+
+async def process_clerk_event(event: Dict):
+    if event.get('type') not in CLERK_TIER_EVENTS:
+        return False
+    
+    data = event.get('data', {})
+    if event['type'].startswith('user.'):
+        user_id = data.get('id')
+    else:
+        user_id = (data.get('payer') or {}).get('user_id')
+    if not user_id:
+        logger.error(f"No user in Clerk event {event['type']}")
+        return False
+    
+    await tier_resolver.invalidate(user_id)
+    return True
+
+
+def verify_svix_signature(payload: bytes, headers, secret: str, tolerance: int = 300) -> bool:
+    """Check a Svix-signed (Clerk) webhook: HMAC-SHA256 over id.timestamp.body"""
+    
+    svix_id = headers.get('svix-id')
+    timestamp = headers.get('svix-timestamp')
+    signatures = headers.get('svix-signature')
+    if not (secret and svix_id and timestamp and signatures):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+        key = base64.b64decode(secret.split('_', 1)[-1])
+    except ValueError:
+        return False
+    
+    signed = f"{svix_id}.{timestamp}.".encode() + payload
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    
+    # Header holds space-separated "v1,<signature>" entries (several during key rotation)
+    return any(
+        hmac.compare_digest(expected, signature.split(',', 1)[-1])
+        for signature in signatures.split()
+    )
+
+
+def verify_sendgrid_signature(payload: bytes, headers, public_key: str, tolerance: int = 300) -> bool:
+    """Check a SendGrid signed event webhook: ECDSA over timestamp + body"""
+    
+    signature = headers.get(EventWebhookHeader.SIGNATURE)
+    timestamp = headers.get(EventWebhookHeader.TIMESTAMP)
+    if not (public_key and signature and timestamp):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+        return EventWebhook(public_key).verify_signature(payload.decode(), signature, timestamp)
+    except Exception:
+        # Malformed key, signature or body
+        return False
+
+
+def verify_twilio_signature(url: str, params: Dict, headers, auth_token: str) -> bool:
+    """Check X-Twilio-Signature: HMAC-SHA1 over the webhook URL and POST params"""
+    
+    signature = headers.get('x-twilio-signature')
+    if not (auth_token and signature):
+        return False
+    return RequestValidator(auth_token).validate(url, params, signature)
+
+
+def twilio_webhook_url(request: Request) -> str:
+    """The URL Twilio signed: the public one configured for the number, not the proxied one"""
+    base = os.environ.get('API_BASE_URL')
+    if not base:
+        return str(request.url)
+    query = f"?{request.url.query}" if request.url.query else ''
+    return f"{base.rstrip('/')}{request.url.path}{query}"
+
+
+@app.post("/webhooks/sendgrid/events")
+async def handle_sendgrid_events(request: Request, db: AsyncDB = Depends(get_db)):
+    """Record email opens from the SendGrid event webhook"""
+    
+    payload = await request.body()
+    if not verify_sendgrid_signature(payload, request.headers,
+                                     os.environ.get('SENDGRID_WEBHOOK_PUBLIC_KEY', '')):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
+    for event in json.loads(payload):
+        invoice_id = event.get('invoice_id')  # custom_arg set when sending
+        event_id = event.get('sg_event_id')
+        if event.get('event') != 'open' or not invoice_id or not event_id:
+            continue
+        
+        await idempotency_handler.handle_webhook('sendgrid', event_id,
+            lambda: record_email_open(invoice_id, db))
+    
+    return {"received": True}
+
+
+async def record_email_open(invoice_id: str, db: AsyncDB):
+    """Store an email open and bump the invoice's open counter"""
+    
+    await db.execute(
+        """INSERT INTO email_events (id, invoice_id, opened, created_at)
+           VALUES (:id, :invoice_id, true, NOW())""",
+        {'id': generate_uuid(), 'invoice_id': invoice_id}
+    )
+    await feature_store.record_email_open(db, invoice_id)
+    await db.commit()
+    return True
+
+
+@app.post("/webhooks/twilio/sms")
+async def handle_twilio_sms(request: Request, db: AsyncDB = Depends(get_db)):
+    """Record inbound SMS replies to collection messages"""
+    
+    form_data = await request.form()
+    if not verify_twilio_signature(twilio_webhook_url(request), dict(form_data), request.headers,
+                                   os.environ.get('TWILIO_AUTH_TOKEN', '')):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
+    message_sid = form_data.get('MessageSid')
+    if not message_sid:
+        raise HTTPException(status_code=400, detail="Missing MessageSid")
+    
+    await idempotency_handler.handle_webhook('twilio', message_sid,
+        lambda: record_sms_response(form_data.get('From'), form_data.get('Body', ''), db))
+    
+    # Empty TwiML - no auto-reply
+    return Response(content=str(VoiceResponse()), media_type='text/xml')
+
+
+async def record_sms_response(phone: str, body: str, db: AsyncDB):
+    """Store an SMS reply against the client's oldest active invoice"""
+    
+    invoice = (await db.execute(
+        """SELECT i.id
+           FROM invoices i
+           JOIN clients c ON i.client_id = c.id
+           WHERE c.phone = :phone AND i.collection_status = 'active'
+           ORDER BY i.due_date ASC
+           LIMIT 1""",
+        {'phone': phone}
+    )).fetchone()
+    
+    if not invoice:
+        return False
+    
+    await db.execute(
+        """INSERT INTO sms_events (id, invoice_id, responded, body, created_at)
+           VALUES (:id, :invoice_id, true, :body, NOW())""",
+        {'id': generate_uuid(), 'invoice_id': invoice['id'], 'body': body}
+    )
+    await feature_store.record_sms_response(db, invoice['id'])
+    await db.commit()
+    return True
+
+
 # Collection endpoints
 @app.post("/api/collections/escalate")
 async def escalate_collection(
     action: CollectionAction,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
     """Manually escalate a collection"""
     
     # Get invoice and check ownership
-    invoice = db.execute(
+    invoice = (await db.execute(
         """SELECT i.*, c.name, c.email, c.phone, u.tier
            FROM invoices i
            JOIN clients c ON i.client_id = c.id
            JOIN users u ON i.user_id = u.id
            WHERE i.id = :id AND i.user_id = :user_id""",
         {'id': action.invoice_id, 'user_id': user_id}
-    ).fetchone()
+    )).fetchone()
     
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
+    # The row carries the current tier; later limit checks reuse it
+    tier_resolver.prime(user_id, invoice['tier'])
+    
     # Check if action is allowed for tier
     allowed_actions = {
         'starter': ['email'],
@@ -401,10 +817,13 @@ async def escalate_collection(
     
     # Check rate limits for the action
     action_type = action.action.replace('_', '')  # email, sms, aicall, etc.
-    limit_check = await rate_limiter.check_limit(user_id, action_type, 1)
+    limit_check = await rate_limiter.reserve(user_id, action_type, 1)
     
-    if not limit_check['allowed'] and not action.force:
-        raise HTTPException(status_code=429, detail=limit_check['reason'])
+    if not limit_check['allowed']:
+        if not action.force:
+            raise HTTPException(status_code=429, detail=limit_check['reason'])
+        # Forced actions go ahead over the limit but still count against it
+        await rate_limiter.consume_limit(user_id, action_type, 1)
     
     # Execute collection action
     if action.action == 'email':
@@ -414,23 +833,22 @@ async def escalate_collection(
     elif action.action == 'ai_call':
         result = await ai_handler.initiate_call(invoice)
         if not result['success']:
+            await rate_limiter.release(user_id, action_type, 1)
             raise HTTPException(status_code=400, detail=result['error'])
     elif action.action == 'letter':
         background_tasks.add_task(send_physical_letter, invoice)
     elif action.action == 'agency':
         background_tasks.add_task(refer_to_agency, invoice)
     
-    # Consume rate limit
-    await rate_limiter.consume_limit(user_id, action_type, 1)
-    
     # Log the action
-    db.execute(
+    await db.execute(
         """INSERT INTO collection_events 
            (invoice_id, event_type, event_status, manual, created_at)
            VALUES (:invoice_id, :action, 'initiated', true, NOW())""",
         {'invoice_id': action.invoice_id, 'action': action.action}
     )
-    db.commit()
+    await db.commit()
+    await invoice_cache.invalidate(action.invoice_id)
     
     return {
         'success': True,
@@ -443,13 +861,13 @@ async def escalate_collection(
 @app.get("/api/collections/strategy/{invoice_id}")
 async def get_collection_strategy(
     invoice_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
     """Get AI-recommended collection strategy"""
     
     # Get invoice details
-    invoice_data = db.execute(
+    invoice_data = (await db.execute(
         """SELECT i.*, 
            DATE_PART('day', NOW() - i.due_date) as days_overdue,
            c.name as client_name, c.email as client_email, c.phone as client_phone
@@ -457,7 +875,7 @@ async def get_collection_strategy(
            JOIN clients c ON i.client_id = c.id
            WHERE i.id = :id AND i.user_id = :user_id""",
         {'id': invoice_id, 'user_id': user_id}
-    ).fetchone()
+    )).fetchone()
     
     if not invoice_data:
         raise HTTPException(status_code=404, detail="Invoice not found")
@@ -482,14 +900,14 @@ async def get_collection_strategy(
     strategy = predictor.recommend_collection_strategy(invoice)
     
     # Get collection history
-    events = db.execute(
+    events = (await db.execute(
         """SELECT event_type, event_status, created_at 
            FROM collection_events 
            WHERE invoice_id = :id 
            ORDER BY created_at DESC 
            LIMIT 10""",
         {'id': invoice_id}
-    ).fetchall()
+    )).fetchall()
     
     return {
         'strategy': strategy,
@@ -539,7 +957,7 @@ async def handle_twilio_voice(request: Request):
 
 
 @app.post("/webhooks/twilio/ai-respond")
-async def handle_twilio_response(request: Request, db: Session = Depends(get_db)):
+async def handle_twilio_response(request: Request, db: AsyncDB = Depends(get_db)):
     """Handle customer response in AI call"""
     
     form_data = await request.form()
@@ -579,16 +997,16 @@ async def handle_twilio_response(request: Request, db: Session = Depends(get_db)
 @app.post("/api/payment-plans")
 async def create_payment_plan(
     plan: PaymentPlan,
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
     """Create a payment plan for an invoice"""
     
     # Get invoice
-    invoice = db.execute(
+    invoice = (await db.execute(
         "SELECT * FROM invoices WHERE id = :id AND user_id = :user_id",
         {'id': plan.invoice_id, 'user_id': user_id}
-    ).fetchone()
+    )).fetchone()
     
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
@@ -617,7 +1035,7 @@ async def create_payment_plan(
     
     # Save payment plan
     plan_id = generate_uuid()
-    db.execute(
+    await db.execute(
         """INSERT INTO payment_plans 
            (id, invoice_id, total_amount, initial_payment, num_installments, 
             installment_amount, frequency, schedule, status, created_at)
@@ -636,14 +1054,15 @@ async def create_payment_plan(
     )
     
     # Update invoice status
-    db.execute(
+    await db.execute(
         """UPDATE invoices 
            SET status = 'payment_plan', collection_status = 'paused'
            WHERE id = :id""",
         {'id': plan.invoice_id}
     )
     
-    db.commit()
+    await db.commit()
+    await invoice_cache.invalidate(plan.invoice_id)
     
     # Send confirmation email
     await send_payment_plan_confirmation(plan.invoice_id, plan_id, schedule)
@@ -659,16 +1078,16 @@ async def create_payment_plan(
 # Admin endpoints
 @app.get("/api/admin/metrics")
 async def get_metrics(
-    db: Session = Depends(get_db),
+    db: AsyncDB = Depends(get_db),
     user_id: str = Depends(get_current_user)
 ):
     """Get platform metrics for admin dashboard"""
     
     # Check if user is admin
-    user = db.execute(
+    user = (await db.execute(
         "SELECT role FROM users WHERE id = :id",
         {'id': user_id}
-    ).fetchone()
+    )).fetchone()
     
     if not user or user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin access required")
@@ -676,38 +1095,39 @@ async def get_metrics(
     # Get metrics
     metrics = {}
     
-    # Total invoices and amounts
-    metrics['invoices'] = dict(db.execute(
+    # Total invoices and amounts (whole-table scans get longer than the default timeout)
+    metrics['invoices'] = dict((await db.execute(
         """SELECT 
            COUNT(*) as total,
            SUM(amount) as total_amount,
            COUNT(*) FILTER (WHERE status = 'paid') as paid_count,
            SUM(amount) FILTER (WHERE status = 'paid') as paid_amount
-           FROM invoices"""
-    ).fetchone())
+           FROM invoices""",
+        timeout=60
+    )).fetchone())
     
     # Collection performance
-    metrics['collections'] = dict(db.execute(
+    metrics['collections'] = dict((await db.execute(
         """SELECT 
            COUNT(DISTINCT invoice_id) as active_collections,
            AVG(DATE_PART('day', paid_date - due_date)) as avg_days_to_payment,
            COUNT(*) FILTER (WHERE event_type = 'ai_call') as total_ai_calls,
            COUNT(*) FILTER (WHERE event_type = 'letter') as total_letters
            FROM collection_events"""
-    ).fetchone())
+    )).fetchone())
     
     # Cost tracking
-    metrics['costs'] = dict(db.execute(
+    metrics['costs'] = dict((await db.execute(
         """SELECT 
            SUM(cost) FILTER (WHERE DATE(created_at) = CURRENT_DATE) as today_cost,
            SUM(cost) FILTER (WHERE DATE_PART('month', created_at) = DATE_PART('month', CURRENT_DATE)) as month_cost,
            SUM(cost) as total_cost
            FROM collection_events
            WHERE cost > 0"""
-    ).fetchone())
+    )).fetchone())
     
     # Success rates by stage
-    metrics['success_by_stage'] = db.execute(
+    metrics['success_by_stage'] = [dict(row) for row in (await db.execute(
         """SELECT 
            collection_stage,
            COUNT(*) as total,
@@ -717,7 +1137,16 @@ async def get_metrics(
            WHERE collection_stage > 0
            GROUP BY collection_stage
            ORDER BY collection_stage"""
-    ).fetchall()
+    )).fetchall()]
+    
+    # Webhook retries answered from this worker's memory
+    metrics['idempotency_cache'] = idempotency_handler.cache_stats()
+    
+    # Connection pool saturation and per-caller usage on this worker
+    metrics['db_pool'] = database.pool_stats()
+    
+    # Invoice detail reads served from Redis on this worker
+    metrics['invoice_cache'] = invoice_cache.stats()
     
     return metrics
 
@@ -727,21 +1156,78 @@ def generate_uuid():
     import uuid
     return str(uuid.uuid4())
 
-def generate_invoice_number(user_id: str, db: Session) -> str:
-    """Generate sequential invoice number"""
-    
-    result = db.execute(
-        """SELECT COUNT(*) + 1 as next_num 
-           FROM invoices 
-           WHERE user_id = :user_id 
-           AND DATE_PART('year', created_at) = DATE_PART('year', CURRENT_DATE)""",
-        {'user_id': user_id}
-    ).fetchone()
+INSERT_INVOICE = """INSERT INTO invoices 
+                    (id, user_id, client_id, invoice_number, amount, subtotal, 
+                     tax_amount, currency, description, due_date, line_items, status, created_at)
+                    VALUES (:id, :user_id, :client_id, :invoice_number, :amount, :subtotal,
+                            :tax_amount, :currency, :description, :due_date, :line_items, :status, :created_at)"""
+
+def invoice_totals(invoice: InvoiceCreate):
+    """(subtotal, tax, total) from the line items"""
+    subtotal = sum(item['quantity'] * item['price'] for item in invoice.line_items)
+    tax_amount = subtotal * invoice.tax_rate
+    return subtotal, tax_amount, subtotal + tax_amount
+
+async def generate_invoice_pdf(invoice: Dict, _db: AsyncDB, base_url: str) -> str:
+    """Render the invoice PDF on the worker pool and return its URL under `base_url`"""
+    return await pdf_renderer.render(invoice, base_url)
+
+async def send_invoice_email(invoice_id: str, user_id: str, base_url: str):
+    """Send invoice email to client"""
+    return await send_invoice_emails([invoice_id], user_id, base_url)
+
+async def send_invoice_emails(invoice_ids: List[str], user_id: str, base_url: str):
+    """Email each invoice to its client, up to 1000 per SendGrid request
     
-    year = datetime.now().year
-    number = result['next_num']
+    `base_url` is the URL the PDFs are served under, taken from the request
+    that created them.
+    """
+    try:
+        template_id = os.environ.get('SENDGRID_TEMPLATE_INVOICE')
+        if not template_id:
+            logger.error("Invoice email template not configured")
+            return {'success': False, 'error': 'Email template not configured'}
+        
+        async with database.open('invoice_emails') as db:
+            invoices = (await db.execute(
+                """SELECT i.id, i.invoice_number, i.amount, i.currency, i.due_date,
+                          c.name as client_name, c.email as client_email
+                   FROM invoices i
+                   JOIN clients c ON i.client_id = c.id
+                   WHERE i.id = ANY(:ids) AND i.user_id = :user_id""",
+                {'ids': invoice_ids, 'user_id': user_id}
+            )).fetchall()
+        
+        sent = 0
+        # SendGrid takes up to 1000 personalizations per request
+        for start in range(0, len(invoices), 1000):
+            message = Mail(from_email=os.environ.get('SENDGRID_FROM_EMAIL', 'invoices@recoup.uk'))
+            message.template_id = template_id
+            for invoice in invoices[start:start + 1000]:
+                personalization = Personalization()
+                personalization.add_to(To(invoice['client_email']))
+                personalization.dynamic_template_data = {
+                    'invoice_number': invoice['invoice_number'],
+                    'amount': f"{invoice['currency']} {invoice['amount']:.2f}",
+                    'due_date': invoice['due_date'].strftime('%d %B %Y'),
+                    'client_name': invoice['client_name'],
+                    'pdf_url': pdf_renderer.url(invoice['id'], base_url),
+                    'payment_link': f"{os.environ.get('APP_URL', 'https://recoup.uk')}/pay/{invoice['id']}",
+                }
+                # Echoed back on SendGrid events so opens can be attributed
+                personalization.add_custom_arg(CustomArg('invoice_id', str(invoice['id'])))
+                message.add_personalization(personalization)
+            
+            # The SendGrid client blocks; keep it off the event loop
+            await asyncio.to_thread(sg.send, message)
+            sent += min(1000, len(invoices) - start)
+        
+        logger.info(f"Invoice emails sent: {sent} for user {user_id}")
+        return {'success': True, 'sent': sent}
     
-    return f"INV-{year}-{number:05d}"
+    except Exception as e:
+        logger.error(f"Failed to send invoice emails: {e}")
+        return {'success': False, 'error': str(e)}
 
 async def get_current_user(request: Request) -> str:
     """Get current user from Firebase auth token"""
@@ -753,17 +1239,26 @@ async def get_current_user(request: Request) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
 
-    # Extract token
-    token = authorization.split("Bearer ")[1]
+    # IdempotencyKeyMiddleware already verified this request's token
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is None:
+        # Extract token
+        token = authorization.split("Bearer ")[1]
 
-    try:
-        # Verify Firebase ID token
-        decoded_token = firebase_auth.verify_id_token(token)
-        user_id = decoded_token["uid"]
-        return user_id
-    except Exception as e:
-        logger.error(f"Firebase auth error: {e}")
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+        try:
+            # Verify Firebase ID token, off the event loop like the middleware
+            decoded_token = await asyncio.to_thread(firebase_auth.verify_id_token, token)
+            user_id = decoded_token["uid"]
+        except Exception as e:
+            logger.error(f"Firebase auth error: {e}")
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+    # Per-user API quota, served from this worker's leased tokens
+    limit_check = await rate_limiter.reserve(user_id, 'api_calls', 1)
+    if not limit_check['allowed']:
+        raise HTTPException(status_code=429, detail=limit_check['reason'])
+
+    return user_id
 
 async def send_collection_email(invoice: Dict, template_name: str):
     """Send collection email using SendGrid with dynamic templates"""
@@ -798,6 +1293,8 @@ async def send_collection_email(invoice: Dict, template_name: str):
         )
         message.template_id = template_id
         message.dynamic_template_data = template_data
+        # Echoed back on SendGrid events so opens can be attributed
+        message.custom_arg = CustomArg('invoice_id', str(invoice.get('invoiceId')))
 
         response = sg.send(message)
 
@@ -0,0 +1,158 @@
+# benchmark_bulk_invoices.py
+"""
+Throughput of importing invoices one request at a time vs POST /api/invoices/bulk
+
+Runs the database and PDF work of both endpoints for --invoices invoices:
+- one by one: what a client looping over POST /api/invoices triggers, with
+  --concurrency requests in flight. Each invoice allocates a number, inserts
+  and commits, renders its PDF, then marks it sent and commits again.
+- bulk: what /api/invoices/bulk does per request of --batch invoices. It
+  allocates the numbers with one UPDATE, inserts every row as one batch in
+  one transaction, renders the PDFs across the pool, and marks them sent
+  with one UPDATE.
+
+Reports invoices per second and, for bulk, where the time went. --latency-ms
+adds a simulated network round trip to Postgres, as in benchmark_database.py.
+
+Creates a scratch database next to the one in --database-url and drops it at
+the end. PDFs are written to a temporary directory.
+
+Usage:
+    python benchmark_bulk_invoices.py --database-url postgresql://localhost/recoup [--invoices 2000]
+                                      [--batch 2000] [--concurrency 20] [--pdf-workers 4]
+                                      [--latency-ms 1]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+from benchmark_database import INSERT_INVOICE, MARK_SENT, SCHEMA, new_invoice, start_latency_proxy
+from database import Database
+from invoice_numbers import InvoiceNumberAllocator
+from invoice_pdf import InvoicePdfRenderer
+
+USER_ID = 'user-import'
+
+
+async def one_by_one(database, allocator, renderer, count, concurrency):
+    """Each invoice as its own POST /api/invoices"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create():
+        async with semaphore, database.open('benchmark') as db:
+            row = new_invoice(USER_ID, await allocator.next_number(USER_ID, db), description='one by one')
+            await db.execute(INSERT_INVOICE, row)
+            await db.commit()
+            await renderer.render(row)
+            await db.execute(MARK_SENT, {'id': row['id']})
+            await db.commit()
+
+    await asyncio.gather(*(create() for _ in range(count)))
+
+
+async def bulk(database, allocator, renderer, count, batch, phases):
+    """The invoices in requests of `batch` to POST /api/invoices/bulk, one after another"""
+    for start in range(0, count, batch):
+        size = min(batch, count - start)
+        async with database.open('benchmark') as db:
+            started = time.perf_counter()
+            numbers = await allocator.next_numbers(USER_ID, size, db)
+            rows = [new_invoice(USER_ID, number, description='bulk') for number in numbers]
+            await db.execute(INSERT_INVOICE, rows)
+            await db.commit()
+            inserted = time.perf_counter()
+
+            urls = await renderer.render_many(rows)
+            rendered = time.perf_counter()
+
+            sent = [row['id'] for row, url in zip(rows, urls) if not isinstance(url, Exception)]
+            await db.execute("UPDATE invoices SET status = 'sent', sent_date = NOW() WHERE id = ANY(:ids)",
+                             {'ids': sent})
+            await db.commit()
+
+            phases['numbers + insert'] += inserted - started
+            phases['pdf'] += rendered - inserted
+            phases['mark sent'] += time.perf_counter() - rendered
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True, help='Postgres server to create the scratch database on')
+    parser.add_argument('--invoices', type=int, default=2000, help='Invoices imported per run')
+    parser.add_argument('--batch', type=int, default=2000, help='Invoices per bulk request')
+    parser.add_argument('--concurrency', type=int, default=20, help='Single-invoice requests in flight at once')
+    parser.add_argument('--pdf-workers', type=int, default=None, help='PDF render processes (default: CPU count)')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Simulated network round trip to Postgres')
+    args = parser.parse_args()
+
+    server = make_url(args.database_url).set(drivername='postgresql+psycopg2')
+    scratch = server.set(database=f'bench_{uuid.uuid4().hex[:8]}')
+    admin = create_engine(server, isolation_level='AUTOCOMMIT')
+    with admin.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{scratch.database}"'))
+
+    try:
+        engine = create_engine(scratch)
+        with engine.begin() as conn:
+            for statement in SCHEMA.split(';'):
+                conn.execute(text(statement))
+            conn.execute(text("INSERT INTO clients VALUES (:id, 'Client', 'client@example.com', '+447700900000')"),
+                         {'id': f'client-{USER_ID}'})
+        engine.dispose()
+
+        url = scratch.render_as_string(hide_password=False)
+        if args.latency_ms:
+            proxy_port = start_latency_proxy(scratch, args.latency_ms / 1000)
+            url = scratch.set(host='127.0.0.1', port=proxy_port, query={}).render_as_string(hide_password=False)
+        database = Database(url, pool_size=args.pool_size, max_overflow=args.pool_size)
+        allocator = InvoiceNumberAllocator(database)
+        await allocator.ensure_schema()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            renderer = InvoicePdfRenderer(output_dir=output_dir, base_url=f'file://{output_dir}', **(
+                {'workers': args.pdf_workers} if args.pdf_workers else {}))
+            # Start the render processes before timing
+            await renderer.render_many([new_invoice(USER_ID, 0, description='warm up')] * renderer.workers)
+
+            print(f"{args.invoices} invoices, {renderer.workers} PDF workers, {args.latency_ms} ms round trip\n")
+            print(f"  {'import':<36} {'invoices/s':>10} {'elapsed':>9}")
+
+            started = time.perf_counter()
+            await one_by_one(database, allocator, renderer, args.invoices, args.concurrency)
+            before = time.perf_counter() - started
+            print(f"  {f'one by one ({args.concurrency} in flight)':<36} {args.invoices / before:>10.0f} {before:>8.2f}s")
+
+            phases = {'numbers + insert': 0.0, 'pdf': 0.0, 'mark sent': 0.0}
+            started = time.perf_counter()
+            await bulk(database, allocator, renderer, args.invoices, args.batch, phases)
+            after = time.perf_counter() - started
+            print(f"  {f'bulk ({args.batch} per request)':<36} {args.invoices / after:>10.0f} {after:>8.2f}s")
+            print(f"  {'':<36} {before / after:>9.1f}x throughput\n")
+
+            print("Bulk time by phase:")
+            for name, seconds in phases.items():
+                print(f"  {name:<22} {seconds:>7.2f}s {seconds / after:>6.0%}")
+
+            renderer.close()
+
+        async with database.open('benchmark') as db:
+            duplicates = (await db.execute(
+                """SELECT COUNT(*) - COUNT(DISTINCT invoice_number) AS duplicates
+                   FROM invoices WHERE user_id = :user_id""", {'user_id': USER_ID})).fetchone()['duplicates']
+        print(f"\nDuplicate invoice numbers: {duplicates}")
+        await database.close()
+    finally:
+        with admin.connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{scratch.database}" WITH (FORCE)'))
+        admin.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
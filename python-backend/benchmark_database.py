@@ -0,0 +1,507 @@
+# benchmark_database.py
+"""
+Benchmarks for the database layer: pooled connections, and async queries
+under concurrency for get_invoice and create_invoice
+
+First, sequential short queries (one invoice lookup each) three ways:
+- connect per query: a new psycopg2 connection per call, as
+  ai_collection_system.get_db() used to open
+- pooled sync: database.connection(), now behind get_db()
+- pooled async: database.open(), used by app.py and the AI call handler
+The difference is the TCP and auth handshake each new connection pays.
+
+Then the invoice detail behind GET /api/invoices/{id}, fetched one request
+at a time: the three sequential queries get_invoice used to run, the single
+query that aggregates payments and events as JSON, and reads through
+invoice_cache.InvoiceDetailCache (on --redis-url, or in-process fakeredis)
+with most lookups hitting.
+
+Then invoice number allocation for a burst of creates spread over a few
+users: COUNT(*) + 1 over the user's invoices, as generate_invoice_number
+did, against invoice_numbers.InvoiceNumberAllocator with and without block
+leasing. It reports creates per second and numbers issued twice to one user.
+
+Then the concurrency comparison:
+
+Runs each endpoint's queries for many concurrent requests two ways:
+- sync: a blocking SQLAlchemy Session per request, as app.py used to do.
+  Each query holds the event loop, so requests run one at a time.
+- async: database.Database / AsyncDB on the asyncpg pool, as app.py does now
+
+For each it reports requests per second, p50 / p99 latency from arrival of
+a burst of --requests, and the worst event loop stall. The stall is measured by a 1 ms ticker running alongside
+the load. It is how long every other request on the worker, including ones
+that never touch Postgres, would have been frozen. The async run also prints
+the pool's saturation stats.
+
+A local Postgres answers in microseconds, which hides what the blocking
+path costs against a managed database across the network. --latency-ms
+routes both layers through an in-process proxy that delays every packet by
+that round trip.
+
+Creates a scratch database next to the one in --database-url, seeds it with
+clients and invoices, and drops it at the end. Needs a role that may create
+databases.
+
+Usage:
+    python benchmark_database.py --database-url postgresql://localhost/recoup [--concurrency 200]
+                                 [--requests 2000] [--pool-size 10] [--max-overflow 10]
+                                 [--latency-ms 1]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+import psycopg2
+
+from database import Database
+from invoice_cache import InvoiceDetailCache
+from invoice_numbers import InvoiceNumberAllocator
+
+SCHEMA = """
+CREATE TABLE clients (id TEXT PRIMARY KEY, name TEXT, email TEXT, phone TEXT);
+CREATE TABLE invoices (
+    id TEXT PRIMARY KEY, user_id TEXT NOT NULL, client_id TEXT REFERENCES clients(id),
+    invoice_number TEXT, amount NUMERIC, subtotal NUMERIC, tax_amount NUMERIC, currency TEXT,
+    description TEXT, due_date TIMESTAMP, line_items JSONB, status TEXT, sent_date TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX ON invoices (user_id, created_at);
+CREATE TABLE payments (id TEXT PRIMARY KEY, invoice_id TEXT, amount NUMERIC, created_at TIMESTAMP DEFAULT NOW());
+CREATE INDEX ON payments (invoice_id);
+CREATE TABLE collection_events (
+    id SERIAL PRIMARY KEY, invoice_id TEXT, event_type TEXT, created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX ON collection_events (invoice_id)
+"""
+
+# The queries app.py runs per request
+GET_INVOICE = (
+    """SELECT i.*, c.name as client_name, c.email as client_email
+       FROM invoices i
+       JOIN clients c ON i.client_id = c.id
+       WHERE i.id = :id AND i.user_id = :user_id""",
+    "SELECT * FROM payments WHERE invoice_id = :id ORDER BY created_at DESC",
+    "SELECT * FROM collection_events WHERE invoice_id = :id ORDER BY created_at DESC",
+)
+NEXT_NUMBER = """SELECT COUNT(*) + 1 as next_num
+                 FROM invoices
+                 WHERE user_id = :user_id
+                 AND DATE_PART('year', created_at) = DATE_PART('year', CURRENT_DATE)"""
+INSERT_INVOICE = """INSERT INTO invoices
+                    (id, user_id, client_id, invoice_number, amount, subtotal,
+                     tax_amount, currency, description, due_date, line_items, status, created_at)
+                    VALUES (:id, :user_id, :client_id, :invoice_number, :amount, :subtotal,
+                            :tax_amount, :currency, :description, :due_date, :line_items, :status, :created_at)"""
+MARK_SENT = "UPDATE invoices SET status = 'sent', sent_date = NOW() WHERE id = :id"
+# app.load_invoice_detail: the same detail in one round trip
+INVOICE_DETAIL = """SELECT i.user_id, json_build_object(
+                        'invoice', to_jsonb(i) || jsonb_build_object('client_name', c.name, 'client_email', c.email),
+                        'payments', COALESCE((SELECT json_agg(p ORDER BY p.created_at DESC)
+                                              FROM payments p WHERE p.invoice_id = i.id), '[]'),
+                        'collection_events', COALESCE((SELECT json_agg(e ORDER BY e.created_at DESC)
+                                                       FROM collection_events e WHERE e.invoice_id = i.id), '[]')
+                    )::text as detail
+                    FROM invoices i
+                    JOIN clients c ON i.client_id = c.id
+                    WHERE i.id = :id"""
+
+USERS = 50
+
+
+def new_invoice(user_id, number, description='Benchmark'):
+    invoice_number = number if isinstance(number, str) else f'INV-{datetime.utcnow().year}-{number:05d}'
+    return {
+        'id': str(uuid.uuid4()), 'user_id': user_id, 'client_id': f'client-{user_id}',
+        'invoice_number': invoice_number, 'amount': 120.0, 'subtotal': 100.0, 'tax_amount': 20.0,
+        'currency': 'GBP', 'description': description, 'due_date': datetime.utcnow() + timedelta(days=30),
+        'line_items': json.dumps([{'quantity': 1, 'price': 100.0}]), 'status': 'draft',
+        'created_at': datetime.utcnow(),
+    }
+
+
+def seed(url, invoices_per_user):
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        for statement in SCHEMA.split(';'):
+            conn.execute(text(statement))
+        invoice_ids = []
+        for u in range(USERS):
+            user_id = f'user-{u}'
+            conn.execute(text("INSERT INTO clients VALUES (:id, 'Client', 'client@example.com', '+447700900000')"),
+                         {'id': f'client-{user_id}'})
+            rows = [new_invoice(user_id, n) for n in range(invoices_per_user)]
+            conn.execute(text(INSERT_INVOICE), rows)
+            conn.execute(text("INSERT INTO payments (id, invoice_id, amount) VALUES (:id, :invoice_id, 10)"),
+                         [{'id': str(uuid.uuid4()), 'invoice_id': row['id']} for row in rows])
+            conn.execute(text("INSERT INTO collection_events (invoice_id, event_type) VALUES (:invoice_id, 'email')"),
+                         [{'invoice_id': row['id']} for row in rows])
+            invoice_ids += [(row['id'], user_id) for row in rows]
+    engine.dispose()
+    return invoice_ids
+
+
+# Sync Session calls, as the endpoints made them before: blocking inside a coroutine
+async def sync_get_invoice(SessionLocal, invoice_id, user_id):
+    db = SessionLocal()
+    try:
+        db.execute(text(GET_INVOICE[0]), {'id': invoice_id, 'user_id': user_id}).mappings().fetchone()
+        db.execute(text(GET_INVOICE[1]), {'id': invoice_id}).mappings().fetchall()
+        db.execute(text(GET_INVOICE[2]), {'id': invoice_id}).mappings().fetchall()
+    finally:
+        db.close()
+
+
+async def sync_create_invoice(SessionLocal, user_id):
+    db = SessionLocal()
+    try:
+        number = db.execute(text(NEXT_NUMBER), {'user_id': user_id}).mappings().fetchone()['next_num']
+        row = new_invoice(user_id, number)
+        db.execute(text(INSERT_INVOICE), row)
+        db.commit()
+        db.execute(text(MARK_SENT), {'id': row['id']})
+        db.commit()
+    finally:
+        db.close()
+
+
+# The same queries through the async layer app.py uses now
+async def async_get_invoice(database, invoice_id, user_id):
+    async with database.open() as db:
+        (await db.execute(GET_INVOICE[0], {'id': invoice_id, 'user_id': user_id})).fetchone()
+        (await db.execute(GET_INVOICE[1], {'id': invoice_id})).fetchall()
+        (await db.execute(GET_INVOICE[2], {'id': invoice_id})).fetchall()
+
+
+async def async_create_invoice(database, allocator, user_id):
+    async with database.open() as db:
+        row = new_invoice(user_id, await allocator.next_number(user_id, db))
+        await db.execute(INSERT_INVOICE, row)
+        await db.commit()
+        await db.execute(MARK_SENT, {'id': row['id']})
+        await db.commit()
+
+
+def start_latency_proxy(url, latency):
+    """Forward a local TCP port to the server in `url`, adding `latency` (s) per round trip
+
+    Runs on its own thread and event loop, so the blocking path stalling the
+    benchmark's loop does not stall the simulated network. Returns the port.
+    """
+    host = url.query.get('host') or url.host or 'localhost'
+    port = url.port or 5432
+    started = threading.Event()
+    listening = {}
+
+    async def pipe(reader, writer, delay):
+        # Delay each chunk without holding up the ones behind it
+        queue = asyncio.Queue()
+
+        async def send():
+            while True:
+                due, data = await queue.get()
+                await asyncio.sleep(max(due - time.perf_counter(), 0))
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send())
+        while True:
+            data = await reader.read(65536)
+            await queue.put((time.perf_counter() + delay, data))
+            if not data:
+                break
+        await sender
+
+    async def handle(client_reader, client_writer):
+        if host.startswith('/'):
+            server_reader, server_writer = await asyncio.open_unix_connection(os.path.join(host, f'.s.PGSQL.{port}'))
+        else:
+            server_reader, server_writer = await asyncio.open_connection(host, port)
+        # The whole round trip is added on the way back: epoll waits in whole
+        # milliseconds, so two half-delays would each round up
+        await asyncio.gather(pipe(client_reader, server_writer, 0), pipe(server_reader, client_writer, latency),
+                             return_exceptions=True)
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        listening['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    started.wait()
+    return listening['port']
+
+
+LOOKUP = "SELECT id, status, amount FROM invoices WHERE id = %(id)s"
+
+
+async def run_connection_setup(url, database, invoices, queries):
+    """Per-query latency with and without connection setup"""
+    libpq_url = make_url(url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+    def connect_per_query(invoice_id):
+        conn = psycopg2.connect(libpq_url)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(LOOKUP, {'id': invoice_id})
+                cur.fetchone()
+        finally:
+            conn.close()
+
+    def pooled_sync(invoice_id):
+        with database.connection('benchmark') as conn:
+            with conn.cursor() as cur:
+                cur.execute(LOOKUP, {'id': invoice_id})
+                cur.fetchone()
+
+    async def pooled_async(invoice_id):
+        async with database.open('benchmark') as db:
+            (await db.execute(LOOKUP.replace('%(id)s', ':id'), {'id': invoice_id})).fetchone()
+
+    results = {}
+    for name, query in (('connect per query', connect_per_query), ('pooled sync', pooled_sync),
+                        ('pooled async', pooled_async)):
+        latencies = []
+        for i in range(queries):
+            started = time.perf_counter()
+            result = query(invoices[i % len(invoices)][0])
+            if asyncio.iscoroutine(result):
+                await result
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        results[name] = {
+            'p50': statistics.median(latencies),
+            'p99': latencies[max(int(len(latencies) * 0.99) - 1, 0)],
+        }
+    return results
+
+
+async def run_invoice_detail(database, invoices, requests, redis_url, hot=50):
+    """Sequential detail reads three ways; the cached run repeats `hot` invoices"""
+    if redis_url:
+        import redis.asyncio as redis
+        client = redis.from_url(redis_url, decode_responses=True)
+    else:
+        import fakeredis
+        client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    cache = InvoiceDetailCache(redis_client=client)
+
+    async def three_queries(invoice_id, user_id):
+        async with database.open('benchmark') as db:
+            invoice = (await db.execute(GET_INVOICE[0], {'id': invoice_id, 'user_id': user_id})).fetchone()
+            payments = (await db.execute(GET_INVOICE[1], {'id': invoice_id})).fetchall()
+            events = (await db.execute(GET_INVOICE[2], {'id': invoice_id})).fetchall()
+            return json.dumps({'invoice': dict(invoice), 'payments': [dict(p) for p in payments],
+                               'collection_events': [dict(e) for e in events]}, default=str)
+
+    async def load(invoice_id):
+        async with database.open('benchmark') as db:
+            row = (await db.execute(INVOICE_DETAIL, {'id': invoice_id})).fetchone()
+            return (row['user_id'], row['detail']) if row else None
+
+    async def one_query(invoice_id, user_id):
+        return (await load(invoice_id))[1]
+
+    async def cached(invoice_id, user_id):
+        return await cache.get(invoice_id, user_id, lambda: load(invoice_id))
+
+    results = {}
+    for name, fetch in (('three queries', three_queries), ('one query', one_query), ('cached', cached)):
+        picks = invoices[:hot] if fetch is cached else invoices
+        latencies = []
+        for i in range(requests):
+            started = time.perf_counter()
+            await fetch(*picks[i * 7919 % len(picks)])
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        results[name] = {
+            'p50': statistics.median(latencies),
+            'p99': latencies[max(int(len(latencies) * 0.99) - 1, 0)],
+        }
+    results['cached'].update(cache.stats())
+    await client.aclose()
+    return results
+
+
+async def run_invoice_numbers(database, requests, concurrency, users=5):
+    """Concurrent creates for a few users with each way of numbering invoices"""
+    async def counted(db, user_id):
+        return (await db.execute(NEXT_NUMBER, {'user_id': user_id})).fetchone()['next_num']
+
+    allocators = {
+        'count + 1': None,
+        'sequence': InvoiceNumberAllocator(database),
+        'sequence, block 20': InvoiceNumberAllocator(database, block_size=20),
+    }
+    results = {}
+    for name, allocator in allocators.items():
+        async def create(user_id):
+            async with database.open('benchmark') as db:
+                if allocator is None:
+                    number = await counted(db, user_id)
+                else:
+                    number = await allocator.next_number(user_id, db)
+                await db.execute(INSERT_INVOICE, new_invoice(user_id, number, description=name))
+                await db.commit()
+
+        calls = [lambda u=f'user-{i % users}': create(u) for i in range(requests)]
+        results[name] = await run_load(calls, concurrency)
+        async with database.open('benchmark') as db:
+            results[name]['duplicates'] = (await db.execute(
+                """SELECT COUNT(*) - COUNT(DISTINCT (user_id, invoice_number)) AS duplicates
+                   FROM invoices WHERE description = :name""", {'name': name})).fetchone()['duplicates']
+    return results
+
+
+async def run_load(calls, concurrency):
+    """Run the calls `concurrency` at a time while a ticker measures event loop stalls"""
+    stalls = []
+    running = True
+
+    async def ticker():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - started - 0.001)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(call):
+        async with semaphore:
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    probe = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    # Every request arrives at once; latency includes queueing behind the others
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    elapsed = time.perf_counter() - started
+    running = False
+    await probe
+
+    latencies.sort()
+    return {
+        'throughput': len(calls) / elapsed,
+        'p50': statistics.median(latencies),
+        'p99': latencies[max(int(len(latencies) * 0.99) - 1, 0)],
+        'max_stall': max(stalls, default=0),
+    }
+
+
+def print_row(name, result):
+    print(f"  {name:<22} {result['throughput']:>8.0f} {result['p50'] * 1000:>7.1f}ms "
+          f"{result['p99'] * 1000:>7.1f}ms {result['max_stall'] * 1000:>8.1f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True, help='Postgres server to create the scratch database on')
+    parser.add_argument('--concurrency', type=int, default=200, help='Requests in flight at once')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint and layer')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--max-overflow', type=int, default=10)
+    parser.add_argument('--invoices', type=int, default=200, help='Seeded invoices per user')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Simulated network round trip to Postgres')
+    parser.add_argument('--queries', type=int, default=500, help='Sequential queries per connection mode')
+    parser.add_argument('--redis-url', help='Redis for the invoice detail cache (default: in-process fakeredis)')
+    args = parser.parse_args()
+
+    server = make_url(args.database_url).set(drivername='postgresql+psycopg2')
+    scratch = server.set(database=f'bench_{uuid.uuid4().hex[:8]}')
+    admin = create_engine(server, isolation_level='AUTOCOMMIT')
+    with admin.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{scratch.database}"'))
+    url = scratch.render_as_string(hide_password=False)
+
+    try:
+        invoices = seed(url, args.invoices)
+        if args.latency_ms:
+            proxy_port = start_latency_proxy(scratch, args.latency_ms / 1000)
+            url = scratch.set(host='127.0.0.1', port=proxy_port, query={}).render_as_string(hide_password=False)
+        sync_engine = create_engine(url, pool_size=args.pool_size, max_overflow=args.max_overflow)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+        database = Database(url, pool_size=args.pool_size, max_overflow=args.max_overflow)
+        allocator = InvoiceNumberAllocator(database)
+        await allocator.ensure_schema()
+
+        picks = [invoices[i * 7919 % len(invoices)] for i in range(args.requests)]
+        users = [f'user-{i % USERS}' for i in range(args.requests)]
+        workloads = {
+            'get_invoice': (
+                [lambda p=p: sync_get_invoice(SessionLocal, *p) for p in picks],
+                [lambda p=p: async_get_invoice(database, *p) for p in picks],
+            ),
+            'create_invoice': (
+                [lambda u=u: sync_create_invoice(SessionLocal, u) for u in users],
+                [lambda u=u: async_create_invoice(database, allocator, u) for u in users],
+            ),
+        }
+
+        print(f"{args.queries} sequential invoice lookups, {args.latency_ms} ms round trip:\n")
+        print(f"  {'connections':<22} {'p50':>9} {'p99':>9}")
+        setup = await run_connection_setup(url, database, invoices, args.queries)
+        for name, result in setup.items():
+            print(f"  {name:<22} {result['p50'] * 1000:>7.2f}ms {result['p99'] * 1000:>7.2f}ms")
+        print()
+
+        print(f"{args.queries} sequential invoice detail reads:\n")
+        print(f"  {'detail':<22} {'p50':>9} {'p99':>9}")
+        detail = await run_invoice_detail(database, invoices, args.queries, args.redis_url)
+        for name, result in detail.items():
+            print(f"  {name:<22} {result['p50'] * 1000:>7.2f}ms {result['p99'] * 1000:>7.2f}ms")
+        print(f"  cache hit rate {detail['cached']['hit_rate']:.0%}, "
+              f"avg hit {detail['cached']['avg_hit_ms']} ms, avg miss {detail['cached']['avg_miss_ms']} ms\n")
+
+        print(f"{args.requests} invoice creates over 5 users, {args.concurrency} in flight:\n")
+        print(f"  {'numbering':<22} {'req/s':>8} {'p50':>9} {'p99':>9} {'duplicates':>10}")
+        numbering = await run_invoice_numbers(database, args.requests, args.concurrency)
+        for name, result in numbering.items():
+            print(f"  {name:<22} {result['throughput']:>8.0f} {result['p50'] * 1000:>7.1f}ms "
+                  f"{result['p99'] * 1000:>7.1f}ms {result['duplicates']:>10}")
+        print()
+
+        # Open both pools before measuring
+        await run_load(workloads['get_invoice'][0][:args.pool_size], args.pool_size)
+        await run_load(workloads['get_invoice'][1][:args.pool_size], args.pool_size)
+
+        print(f"{args.requests} requests per run, {args.concurrency} in flight, "
+              f"pool {args.pool_size} + {args.max_overflow} overflow, {args.latency_ms} ms round trip\n")
+        print(f"  {'endpoint':<22} {'req/s':>8} {'p50':>9} {'p99':>9} {'max stall':>10}")
+        for endpoint, (sync_calls, async_calls) in workloads.items():
+            before = await run_load(sync_calls, args.concurrency)
+            after = await run_load(async_calls, args.concurrency)
+            print_row(f'{endpoint} sync', before)
+            print_row(f'{endpoint} async', after)
+            print(f"  {'':<22} {after['throughput'] / before['throughput']:>7.1f}x throughput\n")
+
+        print("Async pool:")
+        for name, value in database.pool_stats()['async'].items():
+            print(f"  {name:<22} {value}")
+
+        await database.close()
+        sync_engine.dispose()
+    finally:
+        with admin.connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{scratch.database}" WITH (FORCE)'))
+        admin.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,274 @@
+# benchmark_rate_limiter.py
+"""
+Concurrency check and round-trip benchmark for RateLimiter
+
+Fires many concurrent requests for the same user and action at a small limit
+and counts how many were allowed:
+- reserve: the atomic Lua check-and-consume. It must allow exactly the limit.
+- check+consume: the separate check_limit / consume_limit calls. Concurrent
+  requests all pass the check before any of them consumes, so they overshoot.
+
+Then measures Redis round trips and latency per request for both paths, and
+for reserve with tiers looked up through a TierResolver. Once a user's tier
+is in the resolver's local cache it adds no round trip.
+
+For `api_calls`, which workers serve from locally leased tokens, it compares
+the leased path with the pure-Redis reserve. It shows round trips and
+latency per request, and how many requests several workers together allow
+against the hourly limit. The total may exceed the limit by at most
+workers x max over-allowance.
+
+Finally it compares the Redis state each limiting algorithm keeps per user:
+fixed windows, sliding window counter and GCRA. It counts keys and, on a real
+Redis server, bytes from MEMORY USAGE. The same figures compare the old
+fixed-window layout (a string key per user, action and window) with the
+hash per user and window period it is migrated into.
+
+Runs against an in-process fakeredis server (Lua via lupa) by default, or a
+real Redis with --redis-url. Only real Redis shows network round-trip latency;
+--latency-ms adds a simulated delay to every round trip instead.
+
+Usage:
+    python benchmark_rate_limiter.py [--redis-url redis://localhost:6379] [--concurrency 200]
+                                     [--workers 4] [--latency-ms 0.5]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+
+import redis.asyncio as redis
+from redis.asyncio.connection import AbstractConnection
+from redis.exceptions import ResponseError
+
+from rate_limiter_py import ALGORITHMS, WINDOWS, RateLimiter
+from tier_resolver import TierResolver
+
+ACTION = 'emails'
+LEASED_ACTION = 'api_calls'
+LEGACY_ACTIONS = ('emails', 'sms', 'ai_calls', 'letters', 'api_calls')
+WINDOW = 'hourly'
+
+round_trips = 0
+
+
+def count_round_trips(latency):
+    """Count every packed send (a single command or a whole pipeline) as one round trip"""
+    send = AbstractConnection.send_packed_command
+
+    async def counted(self, *args, **kwargs):
+        global round_trips
+        round_trips += 1
+        if latency:
+            await asyncio.sleep(latency)
+        return await send(self, *args, **kwargs)
+
+    AbstractConnection.send_packed_command = counted
+
+
+def client_factory(redis_url):
+    """Clients for separate simulated workers, all talking to the same server"""
+    if redis_url:
+        return lambda: redis.from_url(redis_url, decode_responses=True)
+    try:
+        import fakeredis
+    except ImportError:
+        print("fakeredis not installed. Run: pip install fakeredis lupa, or pass --redis-url")
+        sys.exit(1)
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.aioredis.FakeRedis(server=server, decode_responses=True, max_connections=10000)
+
+
+async def reserve(limiter, user_id):
+    result = await limiter.reserve(user_id, ACTION)
+    return result['allowed']
+
+
+async def check_then_consume(limiter, user_id):
+    result = await limiter.check_limit(user_id, ACTION)
+    if result['allowed']:
+        await limiter.consume_limit(user_id, ACTION)
+    return result['allowed']
+
+
+async def reserve_api_call(limiter, user_id):
+    result = await limiter.reserve(user_id, LEASED_ACTION)
+    return result['allowed']
+
+
+async def run_concurrent(limiter, request_fn, concurrency):
+    """Send `concurrency` simultaneous requests for one new user"""
+    user_id = f'bench-{uuid.uuid4().hex[:8]}'
+    results = await asyncio.gather(*(request_fn(limiter, user_id) for _ in range(concurrency)))
+    usage = await limiter.redis.hget(limiter._get_key(user_id, WINDOW), ACTION)
+    return sum(results), int(usage or 0)
+
+
+async def run_latency(limiter, request_fn, requests):
+    """Sequential requests for one user, with per-request latency and round trips"""
+    global round_trips
+    user_id = f'bench-{uuid.uuid4().hex[:8]}'
+    latencies = []
+    round_trips = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        await request_fn(limiter, user_id)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return {
+        'roundTrips': round_trips / requests,
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+async def run_leased_workers(make_client, workers, requests):
+    """Several workers with their own buckets send `requests` in total for one user"""
+    user_id = f'bench-{uuid.uuid4().hex[:8]}'
+    limiters = [RateLimiter(redis_client=make_client()) for _ in range(workers)]
+    results = await asyncio.gather(*(
+        reserve_api_call(limiters[i % workers], user_id) for i in range(requests)
+    ))
+    for limiter in limiters:
+        await limiter.close()
+    usage = await limiters[0].redis.hget(limiters[0]._get_key(user_id, WINDOW), LEASED_ACTION)
+    return sum(results), int(usage or 0), limiters[0].max_over_allowance
+
+
+async def run_memory(make_client, users):
+    """Redis keys and bytes per user after one email and one SMS, per algorithm"""
+    results = {}
+    for algorithm in ALGORITHMS:
+        limiter = RateLimiter(redis_client=make_client(), algorithms={'emails': algorithm, 'sms': algorithm})
+        run = uuid.uuid4().hex[:8]
+        for i in range(users):
+            for action in ('emails', 'sms'):
+                await limiter.reserve(f'{run}-{i}', action)
+
+        results[algorithm] = await measure_keys(limiter.redis, run, users)
+    return results
+
+
+async def measure_keys(client, run, users):
+    """Keys and MEMORY USAGE bytes per user for one run's users"""
+    keys = [key async for key in client.scan_iter(match=f'ratelimit:*{run}-*')]
+    try:
+        memory = sum([await client.memory_usage(key) for key in keys]) / users
+    except ResponseError:
+        memory = None  # fakeredis has no MEMORY USAGE
+    return {'keys': len(keys) / users, 'bytes': memory}
+
+
+async def run_migration(make_client, users):
+    """Fixed-window state per user before and after migrate_legacy_keys()
+
+    Writes the old layout (one string key per user, action and window, plus
+    a daily cost key) for users active in every action, then migrates it.
+    """
+    limiter = RateLimiter(redis_client=make_client())
+    run = uuid.uuid4().hex[:8]
+    pipe = limiter.redis.pipeline(transaction=False)
+    for i in range(users):
+        user_id = f'{run}-{i}'
+        for window in WINDOWS:
+            period = limiter._get_timestamp_for_window(window)
+            for action in LEGACY_ACTIONS:
+                pipe.set(f'ratelimit:{user_id}:{action}:{window}:{period}', 3, ex=limiter._get_ttl(window))
+        period = limiter._get_timestamp_for_window('daily')
+        pipe.set(f'ratelimit:cost:{user_id}:daily:{period}', 4.58, ex=limiter._get_ttl('daily'))
+    await pipe.execute()
+
+    before = await measure_keys(limiter.redis, run, users)
+    migrated = await limiter.migrate_legacy_keys()
+    after = await measure_keys(limiter.redis, run, users)
+    return before, after, migrated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', help='Real Redis to run against (default: in-process fakeredis)')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4, help='Simulated workers for the leased api_calls check')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Simulated delay per Redis round trip')
+    parser.add_argument('--users', type=int, default=500, help='Users for the per-algorithm memory comparison')
+    args = parser.parse_args()
+
+    count_round_trips(args.latency_ms / 1000)
+    make_client = client_factory(args.redis_url)
+    # The atomicity check compares paths on the calendar-window counters
+    limiter = RateLimiter(redis_client=make_client(), algorithms={ACTION: 'fixed'})
+    limit = (await limiter._get_limits(None))[WINDOW][ACTION]
+
+    print(f"{args.concurrency} concurrent '{ACTION}' requests against a {WINDOW} limit of {limit}:")
+    overshoot = False
+    for name, request_fn in (('reserve', reserve), ('check+consume', check_then_consume)):
+        allowed, usage = await run_concurrent(limiter, request_fn, args.concurrency)
+        print(f"  {name:<14} allowed {allowed:>4}   counter {usage:>4}   overshoot {max(allowed - limit, 0):>4}")
+        if name == 'reserve' and (allowed != limit or usage != limit):
+            overshoot = True
+
+    # Raise the limits so every latency request does the full check-and-consume
+    for window in WINDOWS:
+        limiter.limits['pro'][window][ACTION] = args.requests
+    print(f"\n{args.requests} sequential requests:")
+    print(f"  {'path':<14} {'round trips':>11} {'p50':>9} {'p99':>9}")
+    resolved = RateLimiter(
+        redis_client=make_client(),
+        algorithms={ACTION: 'fixed'},
+        tier_resolver=TierResolver(lambda user_id: 'pro', redis_client=make_client()),
+    )
+    resolved.limits = limiter.limits
+    paths = (
+        ('reserve', limiter, reserve),
+        ('check+consume', limiter, check_then_consume),
+        ('reserve+tiers', resolved, reserve),
+    )
+    for name, each, request_fn in paths:
+        result = await run_latency(each, request_fn, args.requests)
+        print(f"  {name:<14} {result['roundTrips']:>11.1f} {result['p50'] * 1e6:>7.0f}us {result['p99'] * 1e6:>7.0f}us")
+    await resolved.tier_resolver.close()
+
+    api_limit = (await limiter._get_limits(None))[WINDOW][LEASED_ACTION]
+    print(f"\n{args.requests} sequential '{LEASED_ACTION}' requests (limit {api_limit}/hour):")
+    print(f"  {'path':<14} {'round trips':>11} {'p50':>9} {'p99':>9}")
+    pure = RateLimiter(redis_client=make_client(), lease_actions=())
+    leased = RateLimiter(redis_client=make_client())
+    for name, each in (('pure redis', pure), ('leased', leased)):
+        # Stay under the limit: a refused request would not measure the hot path
+        each.limits['pro'][WINDOW][LEASED_ACTION] = args.requests * 2
+        result = await run_latency(each, reserve_api_call, args.requests)
+        print(f"  {name:<14} {result['roundTrips']:>11.2f} {result['p50'] * 1e6:>7.0f}us {result['p99'] * 1e6:>7.0f}us")
+    await leased.close()
+
+    total = api_limit * 2
+    allowed, usage, max_over = await run_leased_workers(make_client, args.workers, total)
+    bound = api_limit + args.workers * max_over
+    print(f"\n{args.workers} workers, {total} concurrent '{LEASED_ACTION}' requests:")
+    print(f"  allowed {allowed}   counter {usage}   limit {api_limit}   bound {bound}")
+    if allowed > bound:
+        overshoot = True
+
+    print(f"\nRedis state per user after one email and one SMS ({args.users} users):")
+    print(f"  {'algorithm':<14} {'keys':>6} {'bytes':>8}")
+    for algorithm, result in (await run_memory(make_client, args.users)).items():
+        memory = f"{result['bytes']:.0f}" if result['bytes'] is not None else 'n/a'
+        print(f"  {algorithm:<14} {result['keys']:>6.1f} {memory:>8}")
+
+    before, after, migrated = await run_migration(make_client, args.users)
+    print(f"\nFixed-window state per user active in {len(LEGACY_ACTIONS)} actions ({migrated} keys migrated):")
+    print(f"  {'layout':<14} {'keys':>6} {'bytes':>8}")
+    for name, result in (('key per action', before), ('hash per window', after)):
+        memory = f"{result['bytes']:.0f}" if result['bytes'] is not None else 'n/a'
+        print(f"  {name:<14} {result['keys']:>6.1f} {memory:>8}")
+
+    if overshoot:
+        print("\nFAIL: more requests allowed than the limit allows")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,299 @@
+# benchmark_suite.py
+"""
+Load test for the Redis hot paths: RateLimiter and IdempotencyHandler
+
+Each scenario fires thousands of concurrent coroutines per user and action,
+spread over several simulated workers (separate clients on one Redis), and
+reports:
+- throughput: decisions per second of wall time
+- p50 / p99: latency of one decision under that load
+- cmds / rtt: Redis commands and round trips per decision
+- violations: over-admission (more allowed than the limit permits) for the
+  rate limiter, double execution (a handler run more than once per event)
+  for idempotency
+
+check+consume is included as the known-unsafe baseline; its over-admission
+is reported but does not fail the run. Any other violation exits with
+status 1. Save a run with --json and pass it as --compare to a later run
+to see the change in throughput and latency per scenario.
+
+Runs against an in-process fakeredis server by default, or a local
+redis-server with --redis-url. Each worker gets a bounded pool of
+--pool-size connections, so queueing for a connection shows up in latency
+the way it would in production.
+
+Usage:
+    python benchmark_suite.py [--redis-url redis://localhost:6379] [--concurrency 2000]
+                              [--users 5] [--workers 4] [--pool-size 50] [--json results.json]
+                              [--compare baseline.json] [--only reserve]
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import uuid
+
+import redis.asyncio as redis
+from redis.asyncio.connection import AbstractConnection
+
+from idempotency_py import IdempotencyHandler
+from rate_limiter_py import WINDOWS, RateLimiter
+
+counters = {'commands': 0, 'round_trips': 0}
+
+
+def count_redis_traffic():
+    """Count commands as they are packed and round trips as they are sent"""
+    pack = AbstractConnection.pack_command
+    send = AbstractConnection.send_packed_command
+
+    def counted_pack(self, *args):
+        counters['commands'] += 1
+        return pack(self, *args)
+
+    async def counted_send(self, *args, **kwargs):
+        counters['round_trips'] += 1
+        return await send(self, *args, **kwargs)
+
+    AbstractConnection.pack_command = counted_pack
+    AbstractConnection.send_packed_command = counted_send
+
+
+def client_factory(redis_url, pool_size):
+    """Clients for separate simulated workers, each with a bounded pool as in production"""
+    if redis_url:
+        return lambda: redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            redis_url, max_connections=pool_size, timeout=None, decode_responses=True))
+    try:
+        import fakeredis
+    except ImportError:
+        print("fakeredis not installed. Run: pip install fakeredis lupa, or pass --redis-url")
+        sys.exit(1)
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.aioredis.FakeRedis(
+        server=server, decode_responses=True, connection_pool_class=redis.BlockingConnectionPool,
+        max_connections=pool_size)
+
+
+async def timed(fn):
+    started = time.perf_counter()
+    result = await fn()
+    return result, time.perf_counter() - started
+
+
+async def measure(calls):
+    """Run the calls concurrently; their results and the load's statistics"""
+    counters['commands'] = counters['round_trips'] = 0
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(*(timed(call) for call in calls))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in outcomes)
+    return [result for result, _ in outcomes], {
+        'decisions': len(calls),
+        'throughput': len(calls) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000,
+        'commands': counters['commands'] / len(calls),
+        'round_trips': counters['round_trips'] / len(calls),
+    }
+
+
+async def warm_up(calls, args, repeat=True):
+    """Open each worker's pool and load the Lua scripts before measuring"""
+    await asyncio.gather(*(call() for call in calls for _ in range(args.pool_size if repeat else 1)))
+
+
+def limit_for(limiter, action):
+    limits = limiter.limits['pro']
+    return min(limits[window][action] for window in WINDOWS if action in limits.get(window, {}))
+
+
+async def rate_limit_scenario(make_client, args, action, algorithm, path='reserve'):
+    """Every user sends `concurrency` requests for one action at once"""
+    limiters = [
+        RateLimiter(redis_client=make_client(), algorithms={action: algorithm})
+        for _ in range(args.workers)
+    ]
+    run = uuid.uuid4().hex[:8]
+    users = [f'{run}-{i}' for i in range(args.users)]
+
+    async def request(limiter, user_id):
+        if path == 'check+consume':
+            result = await limiter.check_limit(user_id, action)
+            if result['allowed']:
+                await limiter.consume_limit(user_id, action)
+            return user_id, result['allowed']
+        result = await limiter.reserve(user_id, action)
+        return user_id, result['allowed']
+
+    await warm_up([
+        (lambda limiter=limiter: limiter.reserve(f'{run}-warmup', action))
+        for limiter in limiters
+    ], args)
+
+    calls = [
+        (lambda limiter=limiters[i % args.workers], user_id=user_id: request(limiter, user_id))
+        for user_id in users
+        for i in range(args.concurrency)
+    ]
+    results, stats = await measure(calls)
+    for limiter in limiters:
+        await limiter.close()
+
+    allowed = {user_id: 0 for user_id in users}
+    for user_id, ok in results:
+        allowed[user_id] += ok
+    limit = limit_for(limiters[0], action)
+    if limiters[0]._is_leased(action, limiters[0].limits['pro']):
+        # Each worker may run up to max_over_allowance ahead of its leases
+        limit += args.workers * limiters[0].max_over_allowance
+    stats['allowed'] = sum(allowed.values())
+    stats['violations'] = sum(max(count - limit, 0) for count in allowed.values())
+    return stats
+
+
+async def bulk_check_scenario(make_client, args, action='emails'):
+    """check_limits_many over one batch holding every user's requests"""
+    limiter = RateLimiter(redis_client=make_client(), algorithms={action: 'fixed'})
+    run = uuid.uuid4().hex[:8]
+    requests = [(f'{run}-{i}', action, 1) for i in range(args.users) for _ in range(args.concurrency)]
+
+    await warm_up([lambda: limiter.check_limits_many([(f'{run}-warmup', action, 1)])], args)
+
+    async def check_and_consume():
+        results = await limiter.check_limits_many(requests)
+        allowed = [request for request, result in zip(requests, results) if result['allowed']]
+        await limiter.consume_limits_many(allowed)
+        return allowed
+
+    (allowed,), stats = await measure([check_and_consume])
+    # One call decides the whole batch; report per request
+    stats['throughput'] = len(requests) / (stats['p50_ms'] / 1000)
+    stats['commands'] /= len(requests)
+    stats['round_trips'] /= len(requests)
+    stats['decisions'] = len(requests)
+
+    per_user = {}
+    for user_id, _, count in allowed:
+        per_user[user_id] = per_user.get(user_id, 0) + count
+    limit = limit_for(limiter, action)
+    stats['allowed'] = len(allowed)
+    stats['violations'] = sum(max(count - limit, 0) for count in per_user.values())
+    return stats
+
+
+async def idempotency_scenario(make_client, args, local_cache=True, completed=False):
+    """Every event is delivered `concurrency` times at once across the workers"""
+    handlers = [
+        IdempotencyHandler(redis_client=make_client(), local_cache_size=10000 if local_cache else 0)
+        for _ in range(args.workers)
+    ]
+    run = uuid.uuid4().hex[:8]
+    events = [f'evt_{run}_{i}' for i in range(args.users)]
+    executions = {event_id: 0 for event_id in events}
+
+    def handler_for(event_id):
+        async def handler():
+            executions[event_id] += 1
+            await asyncio.sleep(0.01)  # Simulated handler work
+            return {'event': event_id}
+        return handler
+
+    async def noop():
+        return None
+
+    await warm_up([
+        (lambda handler=handler, i=i: handler.handle_webhook('bench', f'warmup_{run}_{i}', noop))
+        for handler in handlers
+        for i in range(args.pool_size)
+    ], args, repeat=False)
+
+    if completed:
+        # Retry storm for events that were already processed
+        for event_id in events:
+            await handlers[0].handle_webhook('bench', event_id, handler_for(event_id))
+
+    calls = [
+        (lambda handler=handlers[i % args.workers], event_id=event_id:
+            handler.handle_webhook('bench', event_id, handler_for(event_id)))
+        for event_id in events
+        for i in range(args.concurrency)
+    ]
+    results, stats = await measure(calls)
+
+    stats['allowed'] = sum(executions.values())
+    stats['violations'] = sum(max(count - 1, 0) for count in executions.values())
+    stats['violations'] += sum(1 for result in results if result is None)
+    return stats
+
+
+SCENARIOS = {
+    'reserve fixed': lambda mc, a: rate_limit_scenario(mc, a, 'emails', 'fixed'),
+    'reserve sliding': lambda mc, a: rate_limit_scenario(mc, a, 'emails', 'sliding'),
+    'reserve gcra': lambda mc, a: rate_limit_scenario(mc, a, 'emails', 'gcra'),
+    'reserve leased': lambda mc, a: rate_limit_scenario(mc, a, 'api_calls', 'fixed'),
+    'check+consume': lambda mc, a: rate_limit_scenario(mc, a, 'emails', 'fixed', 'check+consume'),
+    'bulk check': lambda mc, a: bulk_check_scenario(mc, a),
+    'webhook new': lambda mc, a: idempotency_scenario(mc, a),
+    'webhook replay': lambda mc, a: idempotency_scenario(mc, a, completed=True),
+    'webhook replay redis': lambda mc, a: idempotency_scenario(mc, a, local_cache=False, completed=True),
+}
+# Reported but expected to over-admit
+UNSAFE = {'check+consume'}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', help='Real Redis to run against (default: in-process fakeredis)')
+    parser.add_argument('--concurrency', type=int, default=2000, help='Concurrent requests per user and action')
+    parser.add_argument('--users', type=int, default=5, help='Users (or webhook events) per scenario')
+    parser.add_argument('--workers', type=int, default=4, help='Simulated workers, each with its own client')
+    parser.add_argument('--pool-size', type=int, default=50, help='Redis connections per worker')
+    parser.add_argument('--only', action='append', help='Run only scenarios whose name contains this')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Earlier --json results to compare against')
+    args = parser.parse_args()
+
+    count_redis_traffic()
+    make_client = client_factory(args.redis_url, args.pool_size)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['scenarios']
+
+    print(f"{args.users} users x {args.concurrency} concurrent requests, {args.workers} workers\n")
+    print(f"  {'scenario':<22} {'decisions':>9} {'per sec':>9} {'p50':>8} {'p99':>8} "
+          f"{'cmds':>5} {'rtt':>5} {'allowed':>7} {'violations':>10}")
+    results = {}
+    failed = False
+    for name, scenario in SCENARIOS.items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        stats = results[name] = await scenario(make_client, args)
+        line = (f"  {name:<22} {stats['decisions']:>9} {stats['throughput']:>9.0f} "
+                f"{stats['p50_ms']:>6.1f}ms {stats['p99_ms']:>6.1f}ms "
+                f"{stats['commands']:>5.2f} {stats['round_trips']:>5.2f} "
+                f"{stats['allowed']:>7} {stats['violations']:>10}")
+        if name in baseline:
+            before = baseline[name]
+            line += (f"   throughput {stats['throughput'] / before['throughput'] - 1:+.0%}"
+                     f", p99 {stats['p99_ms'] / before['p99_ms'] - 1:+.0%}")
+        print(line)
+        if stats['violations'] and name not in UNSAFE:
+            failed = True
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'scenarios': results}, f, indent=2)
+
+    if failed:
+        print("\nFAIL: over-admission or double execution outside the unsafe baseline")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,339 @@
+# database.py
+"""
+Pooled Postgres connections for the whole process
+
+One Database per process (`get_database()`) serves both the FastAPI app and
+ai_collection_system, so no caller pays a TCP and auth handshake per query:
+- an asyncpg pool for code running on the event loop (`session()` as the
+  request dependency, `open(caller)` elsewhere), queried through AsyncDB
+- a psycopg2 pool, created on first use, for blocking callers such as Celery
+  tasks and the payment predictor (`connection(caller)`)
+
+Both pools ping a connection that sat idle for DB_POOL_PING_AFTER seconds
+before handing it out, replace connections after DB_POOL_RECYCLE seconds,
+and set a server-side statement timeout on every connection (overridable per
+query). pool_stats() reports saturation, waits and timeouts per pool, and
+checkouts, waits and hold times per caller.
+"""
+
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+from psycopg2.extras import RealDictCursor
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DBAPIError, DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+logger = logging.getLogger(__name__)
+
+# Postgres SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+
+def database_url_from_env():
+    """DATABASE_URL, or one built from the DB_HOST / DB_NAME / DB_USER / DB_PASSWORD variables"""
+    if os.environ.get("DATABASE_URL"):
+        return os.environ["DATABASE_URL"]
+    return URL.create(
+        "postgresql",
+        username=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD"),
+        host=os.environ.get("DB_HOST"),
+        database=os.environ.get("DB_NAME"),
+    ).render_as_string(hide_password=False)
+
+
+def driver_url(url, driver):
+    """The same database through another driver (`asyncpg` or `psycopg2`)"""
+    scheme, sep, rest = str(url).partition("://")
+    if not (scheme in ("postgres", "postgresql") or scheme.startswith("postgresql+")):
+        return url
+    url = make_url(f"postgresql+{driver}{sep}{rest}")
+    if driver == "asyncpg" and "sslmode" in url.query:
+        # libpq's sslmode (as in hosted DATABASE_URLs) is asyncpg's ssl
+        url = url.difference_update_query(["sslmode"]).update_query_dict({"ssl": url.query["sslmode"]})
+    return url
+
+
+def async_database_url(url):
+    """The same database through the asyncpg driver"""
+    return driver_url(url, "asyncpg")
+
+
+_database = None
+
+
+def get_database():
+    """The process-wide Database, created from the environment on first use"""
+    global _database
+    if _database is None:
+        _database = Database(database_url_from_env())
+    return _database
+
+
+class Database:
+    def __init__(
+        self,
+        database_url=os.environ.get("DATABASE_URL"),
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 10)),
+        sync_pool_size=int(os.environ.get("DB_SYNC_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        ping_after=float(os.environ.get("DB_POOL_PING_AFTER", 30)),
+        statement_timeout=float(os.environ.get("DB_STATEMENT_TIMEOUT", 10)),
+    ):
+        # statement_timeout (s) is enforced by Postgres, so a cancelled query
+        # leaves its connection usable
+        self.database_url = database_url
+        self.statement_timeout = statement_timeout
+        # Pinging on every checkout costs a round trip (three on asyncpg) per
+        # query; a connection used moments ago is trusted instead
+        self.ping_after = ping_after
+        self.pool_options = {
+            'max_overflow': max_overflow,
+            'pool_timeout': pool_timeout,
+            'pool_recycle': pool_recycle,
+        }
+        self.engine = create_async_engine(
+            async_database_url(database_url),
+            pool_size=pool_size,
+            connect_args={'server_settings': {'statement_timeout': str(int(statement_timeout * 1000))}},
+            **self.pool_options,
+        )
+        self.sessionmaker = async_sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.sync_pool_size = sync_pool_size
+        self._sync_engine = None
+
+        self.pools = {'async': PoolStats(pool_size + max_overflow)}
+        self.callers = {}
+        self._watch_pool('async', self.engine.sync_engine)
+
+    async def session(self):
+        """FastAPI dependency: one session per request, closed afterwards"""
+        db = AsyncDB(self.sessionmaker(), self, 'api')
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    def open(self, caller='app'):
+        """A session outside a request: `async with database.open('caller') as db:`"""
+        return AsyncDB(self.sessionmaker(), self, caller)
+
+    @contextmanager
+    def connection(self, caller='app'):
+        """A pooled psycopg2 connection for blocking code: `with database.connection('caller') as conn:`
+
+        Rows come back as dicts (RealDictCursor). Like `with psycopg2.connect()`,
+        the transaction commits when the block exits and rolls back if it
+        raises. The connection then goes back to the pool instead of being
+        closed.
+        """
+        started = time.perf_counter()
+        try:
+            conn = self.sync_engine.raw_connection()
+        except PoolTimeoutError:
+            self._record_timeout('sync', caller)
+            raise
+        acquired = time.perf_counter()
+        self._record_acquire('sync', caller, acquired - started)
+        # Set per checkout: SQLAlchemy's own setup queries expect plain tuple rows
+        conn.dbapi_connection.cursor_factory = RealDictCursor
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            if getattr(e, 'pgcode', None) == QUERY_CANCELED:
+                self.pools['sync'].query_timeouts += 1
+            self.caller_stats(caller)['errors'] += 1
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+            self.caller_stats(caller)['held'] += time.perf_counter() - acquired
+
+    @property
+    def sync_engine(self):
+        """The psycopg2 engine, created on first use so async-only processes never open it"""
+        if self._sync_engine is None:
+            self._sync_engine = create_engine(
+                driver_url(self.database_url, "psycopg2"),
+                pool_size=self.sync_pool_size,
+                connect_args={'options': f'-c statement_timeout={int(self.statement_timeout * 1000)}'},
+                **self.pool_options,
+            )
+            self.pools['sync'] = PoolStats(self.sync_pool_size + self.pool_options['max_overflow'])
+            self._watch_pool('sync', self._sync_engine)
+        return self._sync_engine
+
+    def caller_stats(self, caller):
+        if caller not in self.callers:
+            self.callers[caller] = {'checkouts': 0, 'wait': 0.0, 'max_wait': 0.0, 'held': 0.0,
+                                    'errors': 0, 'pool_timeouts': 0}
+        return self.callers[caller]
+
+    def pool_stats(self):
+        """Pool saturation and per-caller usage for the admin metrics endpoint"""
+        stats = {}
+        for name, engine in (('async', self.engine.sync_engine), ('sync', self._sync_engine)):
+            if engine is not None:
+                stats[name] = self.pools[name].report(engine.pool)
+        stats['callers'] = {
+            caller: {
+                'checkouts': usage['checkouts'],
+                'avg_acquire_wait_ms': round(usage['wait'] / usage['checkouts'] * 1000, 3) if usage['checkouts'] else 0,
+                'max_acquire_wait_ms': round(usage['max_wait'] * 1000, 3),
+                'avg_hold_ms': round(usage['held'] / usage['checkouts'] * 1000, 3) if usage['checkouts'] else 0,
+                'errors': usage['errors'],
+                'pool_timeouts': usage['pool_timeouts'],
+            }
+            for caller, usage in self.callers.items()
+        }
+        return stats
+
+    async def close(self, sync=True):
+        """Close pooled connections; the pools refill on next use
+
+        Celery tasks call close(sync=False) before their event loop ends,
+        since asyncpg connections cannot outlive the loop that opened them.
+        The psycopg2 pool is not tied to a loop and can stay open.
+        """
+        await self.engine.dispose()
+        if sync and self._sync_engine is not None:
+            self._sync_engine.dispose()
+
+    def _watch_pool(self, pool_name, engine):
+        """Health-check idle connections on checkout and track peak usage"""
+
+        def on_checkin(dbapi_connection, connection_record):
+            connection_record.info['checked_in_at'] = time.monotonic()
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            stats = self.pools[pool_name]
+            stats.peak_checked_out = max(stats.peak_checked_out, engine.pool.checkedout())
+            idle_since = connection_record.info.get('checked_in_at')
+            if idle_since is not None and time.monotonic() - idle_since > self.ping_after:
+                try:
+                    engine.dialect.do_ping(dbapi_connection)
+                except Exception as e:
+                    # The pool discards this connection and checks out a fresh one
+                    stats.failed_pings += 1
+                    raise DisconnectionError(f"Idle connection failed health check: {e}")
+
+        event.listen(engine, "checkin", on_checkin)
+        event.listen(engine, "checkout", on_checkout)
+
+    def _record_acquire(self, pool_name, caller, waited):
+        self.pools[pool_name].record_acquire(waited)
+        usage = self.caller_stats(caller)
+        usage['checkouts'] += 1
+        usage['wait'] += waited
+        usage['max_wait'] = max(usage['max_wait'], waited)
+
+    def _record_timeout(self, pool_name, caller):
+        stats = self.pools[pool_name]
+        stats.pool_timeouts += 1
+        self.caller_stats(caller)['pool_timeouts'] += 1
+        logger.warning(f"Database {pool_name} pool exhausted ({stats.capacity} connections), caller {caller}")
+
+
+class PoolStats:
+    """Saturation counters for one pool"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.acquisitions = 0
+        self.acquire_wait = 0.0
+        self.max_acquire_wait = 0.0
+        self.peak_checked_out = 0
+        self.pool_timeouts = 0
+        self.query_timeouts = 0
+        self.failed_pings = 0
+
+    def record_acquire(self, waited):
+        self.acquisitions += 1
+        self.acquire_wait += waited
+        self.max_acquire_wait = max(self.max_acquire_wait, waited)
+
+    def report(self, pool):
+        checked_out = pool.checkedout()
+        return {
+            'capacity': self.capacity,
+            'checked_out': checked_out,
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'saturation': round(checked_out / self.capacity, 3) if self.capacity else 0,
+            'peak_checked_out': self.peak_checked_out,
+            'acquisitions': self.acquisitions,
+            'avg_acquire_wait_ms': round(self.acquire_wait / self.acquisitions * 1000, 3) if self.acquisitions else 0,
+            'max_acquire_wait_ms': round(self.max_acquire_wait * 1000, 3),
+            'pool_timeouts': self.pool_timeouts,
+            'query_timeouts': self.query_timeouts,
+            'failed_pings': self.failed_pings,
+        }
+
+
+class AsyncDB:
+    """Awaitable stand-in for the request's Session
+
+    `await db.execute(sql, params)` takes the raw SQL strings the endpoints
+    already use and returns rows as mappings (`row['amount']`, `dict(row)`).
+    """
+
+    def __init__(self, session, database, caller='app'):
+        self.session = session
+        self.database = database
+        self.caller = caller
+        self._acquired_at = None
+
+    async def execute(self, sql, params=None, timeout=None):
+        """Run one statement; `timeout` (s) overrides the statement timeout for the rest of the transaction"""
+        if not self.session.in_transaction():
+            # First statement of a transaction checks a connection out of the pool
+            started = time.perf_counter()
+            try:
+                await self.session.connection()
+            except PoolTimeoutError:
+                self.database._record_timeout('async', self.caller)
+                raise
+            self._acquired_at = time.perf_counter()
+            self.database._record_acquire('async', self.caller, self._acquired_at - started)
+
+        try:
+            if timeout is not None:
+                await self.session.execute(text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}"))
+            result = await self.session.execute(text(sql), params or {})
+        except DBAPIError as e:
+            if getattr(e.orig, 'sqlstate', None) == QUERY_CANCELED:
+                self.database.pools['async'].query_timeouts += 1
+            self.database.caller_stats(self.caller)['errors'] += 1
+            raise
+        return result.mappings() if result.returns_rows else result
+
+    async def commit(self):
+        await self.session.commit()
+        self._released()
+
+    async def rollback(self):
+        await self.session.rollback()
+        self._released()
+
+    async def close(self):
+        await self.session.close()
+        self._released()
+
+    def _released(self):
+        # Ending the transaction hands the connection back to the pool
+        if self._acquired_at is not None:
+            self.database.caller_stats(self.caller)['held'] += time.perf_counter() - self._acquired_at
+            self._acquired_at = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,138 @@
+# feature_store.py
+"""
+Incrementally maintained feature counters for payment prediction
+Replaces per-request COUNT(DISTINCT ...) aggregation with keyed counter reads
+"""
+
+import logging
+
+from database import AsyncDB
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS client_feature_counters (
+    client_id TEXT PRIMARY KEY,
+    late_payments INTEGER NOT NULL DEFAULT 0,
+    disputes INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS invoice_feature_counters (
+    invoice_id TEXT PRIMARY KEY,
+    email_opens INTEGER NOT NULL DEFAULT 0,
+    sms_responses INTEGER NOT NULL DEFAULT 0,
+    partial_payments INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+# Counter table -> (key column, counter columns)
+COUNTER_TABLES = {
+    'client_feature_counters': ('client_id', ('late_payments', 'disputes')),
+    'invoice_feature_counters': ('invoice_id', ('email_opens', 'sms_responses', 'partial_payments')),
+}
+
+
+class FeatureStore:
+    """Per-client and per-invoice counters updated as collection events happen
+
+    Writes run on the caller's session (database.AsyncDB) so a counter bump
+    commits (or rolls back) together with the event row that caused it.
+    """
+
+    async def ensure_schema(self, db: AsyncDB):
+        """Create the counter tables if they do not exist"""
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                await db.execute(statement)
+        await db.commit()
+
+    async def record_late_payment(self, db: AsyncDB, client_id: str, count: int = 1):
+        await self._increment(db, 'client_feature_counters', client_id, 'late_payments', count)
+
+    async def record_dispute(self, db: AsyncDB, client_id: str, count: int = 1):
+        await self._increment(db, 'client_feature_counters', client_id, 'disputes', count)
+
+    async def record_email_open(self, db: AsyncDB, invoice_id: str, count: int = 1):
+        await self._increment(db, 'invoice_feature_counters', invoice_id, 'email_opens', count)
+
+    async def record_sms_response(self, db: AsyncDB, invoice_id: str, count: int = 1):
+        await self._increment(db, 'invoice_feature_counters', invoice_id, 'sms_responses', count)
+
+    async def record_partial_payment(self, db: AsyncDB, invoice_id: str, count: int = 1):
+        await self._increment(db, 'invoice_feature_counters', invoice_id, 'partial_payments', count)
+
+    async def rebuild(self, db: AsyncDB):
+        """Recompute every counter from the source event tables
+
+        Used for the initial backfill and to repair drift; steady-state
+        updates come from the record_* calls. Late and partial payments are
+        derived with the predicates the payment webhook bumps on: a payment
+        is late if it was recorded after the invoice's due date, and partial
+        if it was for less than the invoice amount.
+        """
+        await db.execute(
+            """INSERT INTO client_feature_counters (client_id, late_payments, disputes, updated_at)
+               SELECT c.id::text,
+                      (SELECT COUNT(*) FROM payments p JOIN invoices i ON p.invoice_id = i.id
+                       WHERE i.client_id = c.id AND p.created_at > i.due_date),
+                      (SELECT COUNT(*) FROM disputes d WHERE d.client_id = c.id),
+                      NOW()
+               FROM clients c
+               ON CONFLICT (client_id) DO UPDATE
+               SET late_payments = EXCLUDED.late_payments,
+                   disputes = EXCLUDED.disputes,
+                   updated_at = NOW()"""
+        )
+        await db.execute(
+            """INSERT INTO invoice_feature_counters
+               (invoice_id, email_opens, sms_responses, partial_payments, updated_at)
+               SELECT i.id::text,
+                      (SELECT COUNT(*) FROM email_events e WHERE e.invoice_id = i.id AND e.opened = true),
+                      (SELECT COUNT(*) FROM sms_events s WHERE s.invoice_id = i.id AND s.responded = true),
+                      (SELECT COUNT(*) FROM payments p WHERE p.invoice_id = i.id AND p.amount < i.amount),
+                      NOW()
+               FROM invoices i
+               ON CONFLICT (invoice_id) DO UPDATE
+               SET email_opens = EXCLUDED.email_opens,
+                   sms_responses = EXCLUDED.sms_responses,
+                   partial_payments = EXCLUDED.partial_payments,
+                   updated_at = NOW()"""
+        )
+        await db.commit()
+        logger.info("Rebuilt feature counters from source tables")
+
+    async def _increment(self, db: AsyncDB, table: str, key: str, counter: str, count: int):
+        key_column, counters = COUNTER_TABLES[table]
+        if counter not in counters:
+            raise ValueError(f"Unknown counter {counter} for {table}")
+
+        await db.execute(
+            f"""INSERT INTO {table} ({key_column}, {counter}, updated_at)
+                VALUES (:key, :count, NOW())
+                ON CONFLICT ({key_column}) DO UPDATE
+                SET {counter} = {table}.{counter} + EXCLUDED.{counter},
+                    updated_at = NOW()""",
+            {'key': str(key), 'count': count}
+        )
+
+
+if __name__ == "__main__":
+    # Create the counter tables and backfill them from the event tables
+    import asyncio
+    from database import get_database
+
+    async def create():
+        database = get_database()
+        try:
+            store = FeatureStore()
+            async with database.open('feature_store') as db:
+                await store.ensure_schema(db)
+                await store.rebuild(db)
+        finally:
+            await database.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(create())
@@ -1,48 +1,418 @@
 # python-services/idempotency.py
 import redis.asyncio as redis
+import asyncio
+import base64
 import hashlib
 import json
+import zlib
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Extends the processing lease, only while this worker still holds it.
+# KEYS[1]: idempotency key; ARGV[1]: lease value; ARGV[2]: TTL (ms)
+EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Replaces the lease with the final record (or deletes it when ARGV[2] is
+# empty) and wakes waiting duplicates. A worker whose lease expired and was
+# taken over leaves the new holder's lease alone.
+# KEYS[1]: idempotency key; ARGV[1]: lease value; ARGV[2]: record; ARGV[3]: TTL (s)
+# ARGV[4]: notification channel
+FINISH_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+redis.call('PUBLISH', ARGV[4], ARGV[2])
+return 1
+"""
+
+class InProgressError(ValueError):
+    """Another worker is still processing the event after the wait timeout"""
+
 
 class IdempotencyHandler:
-    def __init__(self, redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379")):
-        self.redis = redis.from_url(redis_url, decode_responses=True)
+    def __init__(
+        self,
+        redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379"),
+        redis_client=None,
+        lease_ttl=float(os.environ.get("IDEMPOTENCY_LEASE_TTL", 30)),
+        wait_timeout=float(os.environ.get("IDEMPOTENCY_WAIT_TIMEOUT", 60)),
+        local_cache_size=int(os.environ.get("IDEMPOTENCY_LOCAL_CACHE_SIZE", 10000)),
+        local_cache_ttl=float(os.environ.get("IDEMPOTENCY_LOCAL_CACHE_TTL", 600)),
+    ):
+        self.redis = redis_client or redis.from_url(redis_url, decode_responses=True)
+        self._extend_script = self.redis.register_script(EXTEND_SCRIPT)
+        self._finish_script = self.redis.register_script(FINISH_SCRIPT)
         self.ttl = 86400 * 2 # Default 2 days for webhooks
+        # A processing lease lives this long unless its holder's heartbeat
+        # extends it, so a crashed worker's lease is taken over once it expires
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = lease_ttl / 3
+        # How long a duplicate waits for the in-flight delivery's result
+        self.wait_timeout = wait_timeout
+
+        # Recently completed results, so retry storms are answered without Redis.
+        # Completed results never change, so a local copy cannot go stale.
+        self.local_cache_size = local_cache_size
+        self.local_cache_ttl = local_cache_ttl
+        self._local = OrderedDict()  # key -> (result, expires at)
+        self.local_hits = 0
+        self.local_misses = 0
+        self.local_evictions = 0
+        # Deliveries of one event in this process share a single lease attempt,
+        # so a retry storm holds one Redis wait per worker, not one per request
+        self._inflight = {}
+        self._waiters = {}  # result channel -> futures of local waiters
+        self._listener = None
+        self._listener_ready = None
 
     def _generate_key(self, provider, event_id):
         return f"idempotency:{provider}:{event_id}"
 
+    def _channel(self, key):
+        return f"{key}:done"
+
     async def handle_webhook(self, provider, event_id, handler):
+        """Run `handler` once per (provider, event_id) and return its result
+
+        The first delivery takes a lease with SET NX and runs the handler.
+        Duplicates that arrive meanwhile wait for its result and return it.
+        If the handler fails, the lease is released so a redelivery (or a
+        duplicate waiting in another process) runs it again.
+        """
         key = self._generate_key(provider, event_id)
-        
-        # Check if the key exists
-        existing = await self.redis.get(key)
-        if existing:
-            response_data = json.loads(existing)
-            if response_data.get('status') == 'completed':
-                # Already processed, return cached result
-                return response_data.get('result')
-            else:
-                # Still processing or failed, prevent new execution
-                raise ValueError("Webhook is already being processed or has failed.")
-
-        # Key does not exist, start processing
+
+        found, result = self._cached(key)
+        if found:
+            return result
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = self._inflight[key] = asyncio.ensure_future(self._handle(key, handler))
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(inflight)
+
+    async def _handle(self, key, handler):
+        lease = await self._acquire(key)
+        if lease is None:
+            existing = await self.redis.get(key)
+            if existing is not None:
+                response_data = json.loads(existing)
+                if response_data.get('status') == 'completed':
+                    # Already processed, return cached result
+                    self._remember(key, response_data.get('result'))
+                    return response_data.get('result')
+            completed, result, lease = await self._wait_for_result(key)
+            if completed:
+                self._remember(key, result)
+                return result
+
+        result = await self._run(key, lease, handler)
+        self._remember(key, result)
+        return result
+
+    def _cached(self, key):
+        """(True, result) for a locally cached completed event, else (False, None)"""
+        entry = self._local.get(key)
+        if entry is not None and time.monotonic() < entry[1]:
+            self._local.move_to_end(key)
+            self.local_hits += 1
+            return True, entry[0]
+        if entry is not None:
+            del self._local[key]
+            self.local_evictions += 1
+        self.local_misses += 1
+        return False, None
+
+    def _remember(self, key, result):
+        if self.local_cache_size <= 0:
+            return
+        self._local[key] = (result, time.monotonic() + self.local_cache_ttl)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_cache_size:
+            self._local.popitem(last=False)
+            self.local_evictions += 1
+
+    def cache_stats(self):
+        """Counters for the in-process cache of completed events"""
+        lookups = self.local_hits + self.local_misses
+        return {
+            'size': len(self._local),
+            'capacity': self.local_cache_size,
+            'hits': self.local_hits,
+            'misses': self.local_misses,
+            'evictions': self.local_evictions,
+            'hit_rate': round(self.local_hits / lookups, 4) if lookups else None,
+        }
+
+    async def _acquire(self, key):
+        """The lease value if this worker now holds the key's lease, else None"""
+        lease = json.dumps({
+            'status': 'processing',
+            'owner': uuid.uuid4().hex,
+            'timestamp': datetime.utcnow().isoformat(),
+        })
+        if await self.redis.set(key, lease, nx=True, px=int(self.lease_ttl * 1000)):
+            return lease
+        return None
+
+    async def _run(self, key, lease, handler):
+        heartbeat = asyncio.ensure_future(self._heartbeat(key, lease))
         try:
-            # Set a processing lock
-            await self.redis.set(key, json.dumps({'status': 'processing', 'timestamp': datetime.utcnow().isoformat()}), ex=self.ttl)
-            
             # Execute the actual webhook logic
             result = await handler()
-            
-            # Store the successful result and mark as completed
-            response_to_cache = {'status': 'completed', 'result': result}
-            await self.redis.set(key, json.dumps(response_to_cache), ex=self.ttl)
-            
-            return result
-        except Exception as e:
-            # If the handler fails, store the failure state
-            failure_response = {'status': 'failed', 'error': str(e)}
-            await self.redis.set(key, json.dumps(failure_response), ex=3600) # Keep failure record for 1 hour
-            raise e
+        except Exception:
+            heartbeat.cancel()
+            # Release the lease so the provider's retry processes the event again
+            await self._finish_script(keys=[key], args=[lease, '', 0, self._channel(key)])
+            raise
+        heartbeat.cancel()
+
+        # Store the successful result and mark as completed
+        response_to_cache = json.dumps({'status': 'completed', 'result': result})
+        if not await self._finish_script(keys=[key], args=[lease, response_to_cache, self.ttl, self._channel(key)]):
+            logger.warning(f"Idempotency lease for {key} was lost before the handler finished")
+        return result
+
+    async def _heartbeat(self, key, lease):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                if not await self._extend_script(keys=[key], args=[lease, int(self.lease_ttl * 1000)]):
+                    return  # Lease lost; the result write will notice
+            except Exception as e:
+                logger.error(f"Idempotency lease heartbeat for {key} failed: {e}")
+
+    async def _wait_for_result(self, key):
+        """Wait while another worker holds the lease
+
+        Returns (True, result, None) once that worker finishes, or
+        (False, None, lease) if this worker takes the lease over because the
+        holder failed or its lease expired.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        channel = self._channel(key)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise InProgressError("Webhook is still being processed by another worker.")
+            # Listen before re-reading the key so a result published in
+            # between is not missed
+            try:
+                await asyncio.wait_for(self._ensure_listener(), remaining)
+            except asyncio.TimeoutError:
+                continue
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(channel, set()).add(waiter)
+            try:
+                existing = await self.redis.get(key)
+                if existing is None:
+                    lease = await self._acquire(key)
+                    if lease is not None:
+                        return False, None, lease
+                    continue
+                response_data = json.loads(existing)
+                if response_data.get('status') == 'completed':
+                    return True, response_data.get('result'), None
+
+                # Wake on the holder's notification, or re-check once its lease could have expired
+                ttl = await self.redis.pttl(key)
+                timeout = min(deadline - time.monotonic(), ttl / 1000 if ttl > 0 else self.heartbeat_interval)
+                try:
+                    await asyncio.wait_for(waiter, max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                waiters = self._waiters.get(channel)
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[channel]
+
+    async def _ensure_listener(self):
+        if self._listener is None or self._listener.done():
+            self._listener_ready = asyncio.Event()
+            self._listener = asyncio.ensure_future(self._listen())
+        await self._listener_ready.wait()
+
+    async def _listen(self):
+        """One pattern subscription per process wakes every local waiter
+
+        Waiters share it instead of each holding a pub/sub connection, which
+        a storm of distinct in-flight events would otherwise drain the pool for.
+        """
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.psubscribe(self._channel(self._generate_key('*', '*')))
+                self._listener_ready.set()
+                # Results published while unsubscribed were missed; re-check
+                self._wake(list(self._waiters))
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self._wake([message['channel']])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Idempotency result listener failed: {e}")
+                self._listener_ready.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _wake(self, channels):
+        for channel in channels:
+            for waiter in self._waiters.get(channel, ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+
+# Refusals a client is expected to retry: timeout, conflict, locked, too early, rate limited
+TRANSIENT_STATUSES = frozenset({408, 409, 423, 425, 429})
+
+
+class _UncachedResponse(Exception):
+    """Carries a server error or transient refusal out of handle_webhook without storing it"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+class IdempotencyKeyMiddleware:
+    """ASGI middleware replaying responses to POSTs retried with an Idempotency-Key
+
+    The first request with a key runs normally and its response (status,
+    headers, zlib-compressed body) is stored through the IdempotencyHandler
+    under the user and key. Retries get that response back without running
+    the route. Concurrent retries wait for the first to finish. Server
+    errors and transient refusals (TRANSIENT_STATUSES, such as 429 and 409)
+    are not stored, so a retry after one runs the route again.
+    Reusing a key for a different request returns 422.
+
+    `identify(headers)` is awaited and maps lower-cased request headers to a
+    user id, or None to let the request through unchanged (the route then
+    rejects it). The id is left in the request state as `user_id`, so the
+    route's auth dependency can reuse it instead of identifying again.
+    """
+
+    def __init__(self, app, handler, identify, header="idempotency-key", max_key_length=255):
+        self.app = app
+        self.handler = handler
+        self.identify = identify
+        self.header = header.encode()
+        self.max_key_length = max_key_length
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST':
+            return await self.app(scope, receive, send)
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        idempotency_key = headers.get(self.header.decode())
+        user_id = await self.identify(headers) if idempotency_key is not None else None
+        if user_id is None:
+            return await self.app(scope, receive, send)
+        scope.setdefault('state', {})['user_id'] = user_id
+        if not idempotency_key or len(idempotency_key) > self.max_key_length:
+            return await self._send_error(send, 400, f"Idempotency-Key must be 1-{self.max_key_length} characters")
+
+        body = await self._read_body(receive)
+        fingerprint = hashlib.sha256(f"{scope['method']} {scope['path']}\n".encode() + body).hexdigest()
+        executed = False
+
+        async def run_route():
+            nonlocal executed
+            executed = True
+            messages = []
+            body_sent = False
+
+            async def replay_receive():
+                nonlocal body_sent
+                if not body_sent:
+                    body_sent = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                return await receive()
+
+            async def capture(message):
+                messages.append(message)
+                # The client gets the response straight away; background tasks
+                # still run before the record is stored
+                await send(message)
+
+            await self.app(scope, replay_receive, capture)
+            response = self._encode(messages, fingerprint)
+            if response['status'] >= 500 or response['status'] in TRANSIENT_STATUSES:
+                raise _UncachedResponse(response)
+            return response
+
+        try:
+            response = await self.handler.handle_webhook('api', f'{user_id}:{idempotency_key}', run_route)
+        except _UncachedResponse as e:
+            if executed:
+                return
+            # A concurrent duplicate in this process shares the first request's error
+            response = e.response
+        except InProgressError:
+            return await self._send_error(send, 409, "A request with this Idempotency-Key is still being processed")
+
+        if executed:
+            return
+        if response['fingerprint'] != fingerprint:
+            return await self._send_error(send, 422, "Idempotency-Key was already used for a different request")
+        await send({
+            'type': 'http.response.start',
+            'status': response['status'],
+            'headers': [
+                (name.encode('latin-1'), value.encode('latin-1')) for name, value in response['headers']
+            ] + [(b'idempotent-replayed', b'true')],
+        })
+        await send({'type': 'http.response.body', 'body': zlib.decompress(base64.b64decode(response['body']))})
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    def _encode(messages, fingerprint):
+        start = next(message for message in messages if message['type'] == 'http.response.start')
+        body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+        return {
+            'status': start['status'],
+            'headers': [
+                [name.decode('latin-1'), value.decode('latin-1')] for name, value in start.get('headers', [])
+            ],
+            'body': base64.b64encode(zlib.compress(body)).decode(),
+            'fingerprint': fingerprint,
+        }
 
+    @staticmethod
+    async def _send_error(send, status, detail):
+        body = json.dumps({'detail': detail}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
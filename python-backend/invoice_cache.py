@@ -0,0 +1,135 @@
+# invoice_cache.py
+"""
+Read-through Redis cache for the invoice detail served by GET /api/invoices/{id}
+
+Entries are the finished JSON response, as Postgres built it, stored with the
+owning user_id in a hash per invoice. A hit is one Redis round trip, with no
+database connection and no JSON encoding. Concurrent misses for one invoice
+on a worker share a single load.
+
+Every write that changes an invoice, its payments or its collection events
+calls `invalidate()` after committing. Invalidation bumps a generation
+counter as well as deleting the entry. A fill only lands if the generation
+is still the one seen before the load, so a load that read the old rows
+cannot put them back after the invalidation. Entries also expire after
+INVOICE_CACHE_TTL seconds, which bounds staleness from any writer that does
+not invalidate.
+"""
+
+import redis.asyncio as redis
+import asyncio
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# KEYS: entry hash, generation key
+# ARGV: generation seen before loading, owner user_id, detail JSON, TTL (s)
+FILL_SCRIPT = """
+local generation = redis.call('GET', KEYS[2]) or ''
+if generation ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'owner', ARGV[2], 'detail', ARGV[3])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return 1
+"""
+
+
+class InvoiceDetailCache:
+    def __init__(
+        self,
+        redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379"),
+        redis_client=None,
+        ttl=int(os.environ.get("INVOICE_CACHE_TTL", 300)),
+    ):
+        self.redis = redis_client or redis.from_url(redis_url, decode_responses=True)
+        self.ttl = ttl
+        self._fill_script = self.redis.register_script(FILL_SCRIPT)
+
+        self._loading = {}  # (invoice_id, generation) -> in-flight load shared by concurrent misses
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+        self.max_miss_seconds = 0.0
+
+    async def get(self, invoice_id, user_id, load):
+        """The invoice detail JSON if `user_id` owns the invoice, else None
+
+        `load()` is awaited on a miss and returns (owner user_id, detail JSON)
+        or None when the invoice does not exist.
+        """
+        started = time.perf_counter()
+        key, generation_key = self._get_keys(invoice_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(key, 'owner', 'detail')
+            pipe.get(generation_key)
+            (owner, detail), generation = await pipe.execute()
+
+        if detail is not None:
+            self.hits += 1
+            self.hit_seconds += time.perf_counter() - started
+            return self._decode(detail) if self._decode(owner) == user_id else None
+
+        # Only share a load that started after the latest invalidation
+        generation = self._decode(generation) or ''
+        loading_key = (invoice_id, generation)
+        loading = self._loading.get(loading_key)
+        if loading is None:
+            loading = self._loading[loading_key] = asyncio.ensure_future(self._fill(invoice_id, load, generation))
+            loading.add_done_callback(lambda _: self._loading.pop(loading_key, None))
+        loaded = await asyncio.shield(loading)
+
+        elapsed = time.perf_counter() - started
+        self.misses += 1
+        self.miss_seconds += elapsed
+        self.max_miss_seconds = max(self.max_miss_seconds, elapsed)
+        if loaded is None or loaded[0] != user_id:
+            return None
+        return loaded[1]
+
+    async def _fill(self, invoice_id, load, generation):
+        loaded = await load()
+        if loaded is not None:
+            owner, detail = loaded
+            try:
+                await self._fill_script(keys=list(self._get_keys(invoice_id)),
+                                        args=[generation, owner, detail, self.ttl])
+            except Exception as e:
+                # Serve the fresh row anyway; the next request retries the fill
+                logger.warning(f"Failed to cache invoice {invoice_id}: {e}")
+        return loaded
+
+    async def invalidate(self, *invoice_ids):
+        """Drop invoices from the cache after a write that changes their detail"""
+        if not invoice_ids:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for invoice_id in invoice_ids:
+                key, generation_key = self._get_keys(invoice_id)
+                pipe.delete(key)
+                pipe.incr(generation_key)
+                # Outlives any fill that could still be comparing against it
+                pipe.expire(generation_key, self.ttl * 2)
+            await pipe.execute()
+
+    def stats(self):
+        """Hit ratio and lookup latency on this worker"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'avg_hit_ms': round(self.hit_seconds / self.hits * 1000, 3) if self.hits else None,
+            'avg_miss_ms': round(self.miss_seconds / self.misses * 1000, 3) if self.misses else None,
+            'max_miss_ms': round(self.max_miss_seconds * 1000, 3),
+        }
+
+    def _decode(self, value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _get_keys(self, invoice_id):
+        return f"invoice_detail:{invoice_id}", f"invoice_detail:{invoice_id}:gen"
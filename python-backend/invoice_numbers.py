@@ -0,0 +1,179 @@
+# invoice_numbers.py
+"""
+Per-user, per-year invoice number sequences
+
+Invoice numbers used to be COUNT(*) + 1 over the user's invoices for the
+year. That scan grew with the user's history, and two concurrent creates
+read the same count and got the same number. Numbers now come from a counter
+row per (user, year) in `invoice_sequences`, advanced by one atomic
+UPDATE ... RETURNING, so allocation costs the same on the first invoice and
+the ten thousandth, and concurrent creates can never share a number.
+
+With INVOICE_NUMBER_BLOCK=1 (the default) the counter is advanced in the
+caller's transaction. An invoice insert that rolls back hands its number
+back, so the sequence has no gaps. Concurrent creates for the same user wait
+on that user's row until the first one commits; other users are unaffected.
+
+A larger block makes each worker lease that many numbers at once (hi/lo) in
+a short transaction of its own, then hand them out from memory with no
+round trip. Numbers within a block are consecutive, but a worker's block is
+only ever used by that worker: invoices from different workers interleave,
+and numbers still unused when a worker stops are skipped.
+
+next_numbers() allocates a whole batch (bulk imports) with one UPDATE in the
+caller's transaction, whatever the block size, so a batch is always a
+consecutive run that rolls back together with its rows.
+
+The first allocation for a (user, year) seeds the counter from the highest
+number already issued, so existing users continue where they left off.
+"""
+
+import asyncio
+import os
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice_sequences (
+    user_id TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    last_value INTEGER NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, year)
+)
+"""
+
+ADVANCE = """UPDATE invoice_sequences
+             SET last_value = last_value + :count, updated_at = NOW()
+             WHERE user_id = :user_id AND year = :year
+             RETURNING last_value"""
+
+# Runs once per user and year; ON CONFLICT covers a concurrent first allocation
+SEED = """INSERT INTO invoice_sequences (user_id, year, last_value)
+          SELECT :user_id, :year,
+                 COALESCE(MAX(SUBSTRING(invoice_number FROM :pattern)::integer), 0) + :count
+          FROM invoices
+          WHERE user_id = :user_id AND invoice_number LIKE :prefix
+          ON CONFLICT (user_id, year) DO UPDATE
+          SET last_value = invoice_sequences.last_value + :count, updated_at = NOW()
+          RETURNING last_value"""
+
+
+class InvoiceNumberAllocator:
+    def __init__(
+        self,
+        database,
+        block_size=int(os.environ.get("INVOICE_NUMBER_BLOCK", 1)),
+        prefix="INV",
+    ):
+        # database.Database; its pool serves leases taken outside the caller's transaction
+        self.database = database
+        self.block_size = max(block_size, 1)
+        self.prefix = prefix
+
+        self._blocks = {}  # (user_id, year) -> [next number, last number] leased by this worker
+        self._leasing = {}  # (user_id, year) -> in-flight lease shared by concurrent callers
+
+    def format(self, year, number):
+        return f"{self.prefix}-{year}-{number:05d}"
+
+    async def ensure_schema(self):
+        """Create the sequence table if it does not exist"""
+        async with self.database.open('invoice_numbers') as db:
+            await db.execute(SCHEMA)
+            await db.commit()
+
+    async def next_number(self, user_id, db=None, year=None):
+        """The user's next invoice number for `year` (default: this year, UTC)
+
+        With a block size of 1 the counter is advanced on `db`, so it commits
+        or rolls back with the caller's invoice insert. Without `db`, or with
+        larger blocks, leases commit on a connection of their own.
+        """
+        year = year or datetime.utcnow().year
+        if self.block_size == 1:
+            return (await self.next_numbers(user_id, 1, db, year))[0]
+
+        key = (user_id, year)
+        while True:
+            number = self._take(key)
+            if number is not None:
+                return self.format(year, number)
+
+            # One lease per user and year at a time; everyone waiting draws from it
+            leasing = self._leasing.get(key)
+            if leasing is None:
+                leasing = self._leasing[key] = asyncio.ensure_future(self._lease(user_id, year))
+                leasing.add_done_callback(lambda _: self._leasing.pop(key, None))
+                first = await asyncio.shield(leasing)
+                return self.format(year, first)
+            await asyncio.shield(leasing)
+
+    async def next_numbers(self, user_id, count, db=None, year=None):
+        """`count` consecutive invoice numbers for `year`, advanced on `db` if given
+
+        Bypasses the worker's leased block: the counter only moves forward,
+        so a block leased earlier stays valid.
+        """
+        year = year or datetime.utcnow().year
+        if count < 1:
+            return []
+        if db is None:
+            async with self.database.open('invoice_numbers') as own:
+                last = await self._advance(own, user_id, year, count)
+                await own.commit()
+        else:
+            last = await self._advance(db, user_id, year, count)
+        return [self.format(year, number) for number in range(last - count + 1, last + 1)]
+
+    def _take(self, key):
+        block = self._blocks.get(key)
+        if block is None:
+            return None
+        number = block[0]
+        if number == block[1]:
+            del self._blocks[key]
+        else:
+            block[0] += 1
+        return number
+
+    async def _lease(self, user_id, year):
+        """Lease a block and keep all but its first number, which the leaser takes"""
+        async with self.database.open('invoice_numbers') as db:
+            last = await self._advance(db, user_id, year, self.block_size)
+            await db.commit()
+
+        first = last - self.block_size + 1
+        self._blocks[(user_id, year)] = [first + 1, last]
+        logger.debug(f"Leased invoice numbers {first}-{last} for {user_id} ({year})")
+        return first
+
+    async def _advance(self, db, user_id, year, count):
+        """Advance the counter by `count` and return its new last value"""
+        params = {'user_id': user_id, 'year': year, 'count': count}
+        row = (await db.execute(ADVANCE, params)).fetchone()
+        if row is None:
+            row = (await db.execute(SEED, {
+                **params,
+                'pattern': f'^{self.prefix}-{year}-(\\d+)$',
+                'prefix': f'{self.prefix}-{year}-%',
+            })).fetchone()
+        return row['last_value']
+
+
+if __name__ == "__main__":
+    # Create the sequence table
+    from database import get_database
+
+    async def create():
+        database = get_database()
+        try:
+            await InvoiceNumberAllocator(database).ensure_schema()
+        finally:
+            await database.close()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(create())
@@ -0,0 +1,158 @@
+# invoice_pdf.py
+"""
+Invoice PDF rendering on a pool of worker processes
+
+Laying out a PDF is pure-Python CPU work that holds the GIL, so rendering on
+the event loop (or on threads) blocks every other request on the worker.
+InvoicePdfRenderer runs it in separate processes and writes each file to
+INVOICE_PDF_DIR. The app serves that directory under /invoices/pdf, so URLs
+are built from the request's base URL. Set INVOICE_PDF_BASE_URL instead when
+something else (a CDN or a bucket synced from the directory) serves it.
+
+render() handles one invoice; render_many() splits a batch into chunks across
+the pool and returns a URL or an error per invoice, in order, so one bad row
+does not fail a bulk import.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+
+def render_invoice_pdf(invoice):
+    """The invoice laid out as an A4 PDF"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    pdf.setTitle(f"Invoice {invoice['invoice_number']}")
+    width, height = A4
+
+    pdf.setFont('Helvetica-Bold', 20)
+    pdf.drawString(50, height - 60, f"Invoice {invoice['invoice_number']}")
+    pdf.setFont('Helvetica', 11)
+    pdf.drawString(50, height - 85, f"Due: {invoice['due_date']:%d %B %Y}")
+    pdf.drawString(50, height - 100, invoice.get('description') or '')
+
+    line_items = invoice['line_items']
+    if isinstance(line_items, str):
+        line_items = json.loads(line_items)
+
+    y = height - 140
+    pdf.setFont('Helvetica-Bold', 11)
+    for x, heading in ((50, 'Item'), (360, 'Qty'), (420, 'Price'), (490, 'Total')):
+        pdf.drawString(x, y, heading)
+    pdf.setFont('Helvetica', 11)
+    for item in line_items:
+        y -= 18
+        if y < 120:
+            pdf.showPage()
+            pdf.setFont('Helvetica', 11)
+            y = height - 60
+        pdf.drawString(50, y, str(item.get('description', ''))[:55])
+        pdf.drawRightString(390, y, f"{item['quantity']:g}")
+        pdf.drawRightString(470, y, f"{item['price']:.2f}")
+        pdf.drawRightString(545, y, f"{item['quantity'] * item['price']:.2f}")
+
+    y -= 36
+    currency = invoice.get('currency', 'GBP')
+    for label, amount in (('Subtotal', invoice['subtotal']), ('Tax', invoice['tax_amount']),
+                          ('Total', invoice['amount'])):
+        pdf.drawRightString(470, y, label)
+        pdf.drawRightString(545, y, f"{currency} {amount:.2f}")
+        y -= 16
+
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def _render_chunk(invoices, output_dir):
+    """Render and write a chunk in a worker process; None or the error for each invoice"""
+    results = []
+    for invoice in invoices:
+        try:
+            with open(os.path.join(output_dir, f"{invoice['id']}.pdf"), 'wb') as f:
+                f.write(render_invoice_pdf(invoice))
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class InvoicePdfRenderer:
+    def __init__(
+        self,
+        output_dir=os.environ.get("INVOICE_PDF_DIR", "invoices/pdf"),
+        base_url=os.environ.get("INVOICE_PDF_BASE_URL"),
+        workers=int(os.environ.get("INVOICE_PDF_WORKERS", os.cpu_count() or 1)),
+        chunk_size=50,
+    ):
+        self.output_dir = output_dir
+        self.base_url = base_url
+        self.workers = max(workers, 1)
+        # Invoices per task sent to a worker; amortises pickling and scheduling
+        self.chunk_size = chunk_size
+
+        self._pool = None
+
+    def url(self, invoice_id, base_url=None):
+        """Where the invoice's PDF is served; INVOICE_PDF_BASE_URL wins over `base_url`"""
+        base_url = self.base_url or base_url
+        if not base_url:
+            raise ValueError("No base URL for invoice PDFs; pass one or set INVOICE_PDF_BASE_URL")
+        return f"{base_url.rstrip('/')}/{invoice_id}.pdf"
+
+    def _executor(self):
+        # Started on first use, so importing app.py does not fork
+        if self._pool is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            # Workers fork from a clean server process, not from this one with
+            # its event loop, threads and open sockets
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('forkserver'))
+        return self._pool
+
+    async def render(self, invoice, base_url=None):
+        """Render one invoice and return its URL"""
+        result, = await self.render_many([invoice], base_url)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def render_many(self, invoices, base_url=None):
+        """Render a batch across the pool; a URL or the exception for each invoice, in order"""
+        if not invoices:
+            return []
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        # Enough chunks to keep every worker busy, none larger than chunk_size
+        size = max(min(self.chunk_size, -(-len(invoices) // self.workers)), 1)
+        chunks = [invoices[i:i + size] for i in range(0, len(invoices), size)]
+
+        outcomes = await asyncio.gather(
+            *(loop.run_in_executor(pool, _render_chunk, chunk, self.output_dir) for chunk in chunks),
+            return_exceptions=True,
+        )
+
+        results = []
+        for chunk, outcome in zip(chunks, outcomes):
+            if isinstance(outcome, Exception):
+                # The worker died (or the chunk would not pickle); every invoice in it failed
+                logger.error(f"PDF render chunk failed: {outcome}")
+                results += [outcome] * len(chunk)
+            else:
+                results += [error or self.url(invoice['id'], base_url) for invoice, error in zip(chunk, outcome)]
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -1,13 +1,329 @@
 # python-services/rate_limiter.py
 import redis.asyncio as redis
+import asyncio
 import time
 from datetime import datetime
 import os
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = ("hourly", "daily", "monthly")
+# Field of the daily counter hash holding the day's spend
+COST_FIELD = "cost"
+
+# Fixed-window counters live in one hash per user per window period
+# (ratelimit:{user}:{window}:{period}) with one small integer field per action,
+# and the day's spend in the daily hash. Expiry is set on the whole hash.
+
+# Checks every window and the daily cost cap, then consumes all of them, in one
+# atomic step. Concurrent reservations cannot both pass a check and overshoot.
+#
+# KEYS[1..3]: hourly, daily, monthly counter hashes
+# ARGV[1]: action field; ARGV[2]: count; ARGV[3..5]: window limits; ARGV[6..8]: window TTLs
+# ARGV[9]: cost; ARGV[10]: daily cost limit
+# A limit of -1 means unlimited.
+#
+# Returns {allowed, blocking key index (0 if none, 4 for cost), hourly, daily,
+# monthly usage, cost spent as a string}. Usage is after the reservation when allowed.
+RESERVE_SCRIPT = """
+local field = ARGV[1]
+local count = tonumber(ARGV[2])
+local usage = {}
+for i = 1, 3 do
+    usage[i] = tonumber(redis.call('HGET', KEYS[i], field) or '0')
+end
+local cost = tonumber(ARGV[9])
+local spent = tonumber(redis.call('HGET', KEYS[2], '""" + COST_FIELD + """') or '0')
+
+for i = 1, 3 do
+    local limit = tonumber(ARGV[2 + i])
+    if limit >= 0 and usage[i] + count > limit then
+        return {0, i, usage[1], usage[2], usage[3], tostring(spent)}
+    end
+end
+local cost_limit = tonumber(ARGV[10])
+if cost > 0 and cost_limit >= 0 and spent + cost > cost_limit then
+    return {0, 4, usage[1], usage[2], usage[3], tostring(spent)}
+end
+
+for i = 1, 3 do
+    usage[i] = redis.call('HINCRBY', KEYS[i], field, count)
+    if redis.call('TTL', KEYS[i]) < 0 then
+        redis.call('EXPIRE', KEYS[i], ARGV[5 + i])
+    end
+end
+if cost > 0 then
+    spent = tonumber(redis.call('HINCRBYFLOAT', KEYS[2], '""" + COST_FIELD + """', ARGV[9]))
+end
+return {1, 0, usage[1], usage[2], usage[3], tostring(spent)}
+"""
+
+# Leases a block of quota from one window counter for a worker's local bucket.
+# Leased tokens count as used until returned, so leases alone never exceed the
+# limit. Tokens the worker already spent on credit (its debt) are recorded
+# whether or not they fit.
+#
+# KEYS[1]: window counter hash
+# ARGV[1]: debt; ARGV[2]: block size; ARGV[3]: limit; ARGV[4]: TTL; ARGV[5]: action field
+#
+# Returns {tokens granted, usage after}.
+LEASE_SCRIPT = """
+local debt = tonumber(ARGV[1])
+local used = tonumber(redis.call('HGET', KEYS[1], ARGV[5]) or '0')
+local grant = math.max(math.min(tonumber(ARGV[2]), tonumber(ARGV[3]) - used - debt), 0)
+local total = debt + grant
+if total ~= 0 then
+    used = redis.call('HINCRBY', KEYS[1], ARGV[5], total)
+    if redis.call('TTL', KEYS[1]) < 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    end
+end
+return {grant, used}
+"""
+
+# Hands unspent leased tokens back; skipped once the window's hash expired
+RETURN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[2], -tonumber(ARGV[1]))
+end
+return 0
+"""
+
+# Moves one pre-hash-layout counter (a string key per user, action and window)
+# into its field of the user's window hash, keeping the longer TTL.
+#
+# KEYS[1]: legacy counter; KEYS[2]: window hash
+# ARGV[1]: field; ARGV[2]: '1' if the counter is a float (the cost total)
+MIGRATE_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return 0
+end
+local ttl = redis.call('TTL', KEYS[1])
+if ARGV[2] == '1' then
+    redis.call('HINCRBYFLOAT', KEYS[2], ARGV[1], value)
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[1], value)
+end
+if ttl > 0 and redis.call('TTL', KEYS[2]) < ttl then
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+# Smoothed algorithms keep all of a (user, action)'s window state in one hash
+# and read the clock from Redis, so every worker agrees on it. Both share one
+# argument layout and, like RESERVE_SCRIPT, check the daily cost cap.
+#
+# KEYS[1]: state hash; KEYS[2]: daily counter hash (holds the cost total)
+# ARGV[1]: count; ARGV[2]: mode ('check', 'reserve' or 'force')
+# ARGV[3..5]: hourly, daily, monthly limits (-1 = unlimited); ARGV[6..8]: their periods (s)
+# ARGV[9]: GCRA burst ratio; ARGV[10]: cost; ARGV[11]: daily cost limit; ARGV[12]: daily TTL
+#
+# Returns {allowed, blocking window index (0 if none, 4 for cost), retry after (s),
+# hourly, daily, monthly remaining (-1 = unlimited), cost spent}.
+SMOOTHED_COMMON = """
+local count = tonumber(ARGV[1])
+local mode = ARGV[2]
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local windows = {'hourly', 'daily', 'monthly'}
+local remaining = {-1, -1, -1}
+local spent = tonumber(redis.call('HGET', KEYS[2], '""" + COST_FIELD + """') or '0')
+
+local function check_cost()
+    local cost = tonumber(ARGV[10])
+    local cost_limit = tonumber(ARGV[11])
+    if mode ~= 'force' and cost > 0 and cost_limit >= 0 and spent + cost > cost_limit then
+        return false
+    end
+    return true
+end
+
+local function consume_cost()
+    if tonumber(ARGV[10]) ~= 0 then
+        spent = tonumber(redis.call('HINCRBYFLOAT', KEYS[2], '""" + COST_FIELD + """', ARGV[10]))
+        if redis.call('TTL', KEYS[2]) < 0 then
+            redis.call('EXPIRE', KEYS[2], ARGV[12])
+        end
+    end
+end
+"""
+
+# Generic cell rate algorithm: one theoretical arrival time (TAT) per window.
+# Requests are spaced period / limit apart, after a burst of limit x burst
+# ratio (at least one, and at least the request's count) back to back. The
+# TAT may run ahead of now by the tolerance, interval x (burst - 1), so any
+# rolling period admits at most limit + burst - 1: a ratio of 1 would let
+# nearly twice the limit through, the boundary burst this algorithm avoids.
+GCRA_SCRIPT = SMOOTHED_COMMON + """
+local tats = {}
+local horizon = 0
+for i = 1, 3 do
+    local limit = tonumber(ARGV[2 + i])
+    if limit >= 0 then
+        local period = tonumber(ARGV[5 + i])
+        local interval = period / math.max(limit, 1)
+        local burst = math.max(math.floor(limit * tonumber(ARGV[9])), 1, count)
+        local tolerance = interval * (burst - 1)
+        local tat = math.max(tonumber(redis.call('HGET', KEYS[1], windows[i]) or '0'), now)
+        local new_tat = math.max(tat + interval * count, now)
+        -- Conforms if the last of the `count` cells is due within the tolerance
+        if mode ~= 'force' and (limit == 0 or new_tat - interval - now > tolerance) then
+            local retry = period
+            if limit > 0 then
+                retry = new_tat - interval - tolerance - now
+            end
+            return {0, i, tostring(retry), remaining[1], remaining[2], remaining[3], tostring(spent)}
+        end
+        tats[i] = new_tat
+        remaining[i] = math.max(math.floor((tolerance + interval - (new_tat - now)) / interval), 0)
+        horizon = math.max(horizon, new_tat - now)
+    end
+end
+if not check_cost() then
+    return {0, 4, '0', remaining[1], remaining[2], remaining[3], tostring(spent)}
+end
+
+if mode ~= 'check' then
+    for i = 1, 3 do
+        if tats[i] then
+            redis.call('HSET', KEYS[1], windows[i], tostring(tats[i]))
+        end
+    end
+    -- Once every TAT has passed, the state equals an empty hash
+    if horizon > 0 then
+        redis.call('EXPIRE', KEYS[1], math.ceil(horizon) + 1)
+    end
+    consume_cost()
+end
+return {1, 0, '0', remaining[1], remaining[2], remaining[3], tostring(spent)}
+"""
+
+# Sliding window counter: the current fixed window's count plus the previous
+# window's count weighted by how much of it still overlaps the last period.
+# Each window stores its index and the two counts (three hash fields).
+SLIDING_SCRIPT = SMOOTHED_COMMON + """
+local state = {}
+local longest = 0
+for i = 1, 3 do
+    local limit = tonumber(ARGV[2 + i])
+    if limit >= 0 then
+        local period = tonumber(ARGV[5 + i])
+        local index = math.floor(now / period)
+        local elapsed = now - index * period
+        local stored = redis.call('HMGET', KEYS[1], windows[i] .. ':index', windows[i] .. ':cur', windows[i] .. ':prev')
+        local stored_index = tonumber(stored[1] or '-1')
+        local current, previous = 0, 0
+        if stored_index == index then
+            current = tonumber(stored[2] or '0')
+            previous = tonumber(stored[3] or '0')
+        elseif stored_index == index - 1 then
+            previous = tonumber(stored[2] or '0')
+        end
+
+        local estimate = previous * (period - elapsed) / period + current
+        if mode ~= 'force' and estimate + count > limit then
+            local retry = period - elapsed
+            if previous > 0 and current + count <= limit then
+                retry = period * (1 - (limit - current - count) / previous) - elapsed
+            end
+            return {0, i, tostring(retry), remaining[1], remaining[2], remaining[3], tostring(spent)}
+        end
+        state[i] = {index, math.max(current + count, 0), previous}
+        remaining[i] = math.max(math.floor(limit - estimate - count), 0)
+        longest = math.max(longest, period)
+    end
+end
+if not check_cost() then
+    return {0, 4, '0', remaining[1], remaining[2], remaining[3], tostring(spent)}
+end
+
+if mode ~= 'check' then
+    for i = 1, 3 do
+        if state[i] then
+            redis.call('HSET', KEYS[1],
+                windows[i] .. ':index', state[i][1],
+                windows[i] .. ':cur', state[i][2],
+                windows[i] .. ':prev', state[i][3])
+        end
+    end
+    if longest > 0 then
+        redis.call('EXPIRE', KEYS[1], math.ceil(2 * longest))
+    end
+    consume_cost()
+end
+return {1, 0, '0', remaining[1], remaining[2], remaining[3], tostring(spent)}
+"""
+
+# Limiting algorithms selectable per action; anything unlisted uses "fixed"
+ALGORITHMS = ("fixed", "sliding", "gcra")
+# Actions use calendar-aligned "fixed" windows unless configured otherwise
+DEFAULT_ALGORITHMS = {}
+
+class LeasedBucket:
+    """Quota leased from one Redis window counter and spent locally"""
+
+    def __init__(self, key, action, window_ts, limit):
+        self.key = key  # the user's hourly counter hash
+        self.action = action
+        self.window_ts = window_ts
+        self.limit = limit
+        self.tokens = 0  # leased from Redis, not yet spent
+        self.debt = 0  # spent on credit, not yet recorded in Redis
+        self.remaining = limit  # global quota left at the last lease
+        self.exhausted = False  # a lease came back short this window
+        self.retry_at = 0.0
+        self.last_used = time.monotonic()
+        self.refill = None  # in-flight lease task
+        self.closed = False  # handed back by reconcile()
 
 class RateLimiter:
-    def __init__(self, redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379")):
-        self.redis = redis.from_url(redis_url, decode_responses=True)
+    def __init__(
+        self,
+        redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379"),
+        redis_client=None,
+        lease_actions=("api_calls",),
+        lease_block=int(os.environ.get("RATE_LIMIT_LEASE_BLOCK", 20)),
+        max_over_allowance=int(os.environ.get("RATE_LIMIT_MAX_OVER_ALLOWANCE", 5)),
+        reconcile_interval=float(os.environ.get("RATE_LIMIT_RECONCILE_INTERVAL", 5)),
+        algorithms=None,
+        gcra_burst_ratio=float(os.environ.get("RATE_LIMIT_GCRA_BURST_RATIO", 0.1)),
+        tier_resolver=None,
+    ):
+        self.redis = redis_client or redis.from_url(redis_url, decode_responses=True)
+        self._reserve_script = self.redis.register_script(RESERVE_SCRIPT)
+        self._lease_script = self.redis.register_script(LEASE_SCRIPT)
+        self._return_script = self.redis.register_script(RETURN_SCRIPT)
+        self._migrate_script = self.redis.register_script(MIGRATE_SCRIPT)
+        self._smoothed_scripts = {
+            'gcra': self.redis.register_script(GCRA_SCRIPT),
+            'sliding': self.redis.register_script(SLIDING_SCRIPT),
+        }
+
+        # Per-action algorithm: calendar-aligned "fixed" windows, "sliding" or "gcra"
+        self.algorithms = dict(DEFAULT_ALGORITHMS, **(algorithms or {}))
+        unknown = set(self.algorithms.values()) - set(ALGORITHMS)
+        if unknown:
+            raise ValueError(f"Unknown rate limit algorithm(s): {', '.join(sorted(unknown))}")
+        # Share of each window's limit GCRA admits back to back
+        self.gcra_burst_ratio = gcra_burst_ratio
+
+        # High-volume actions served from locally leased quota (hourly window only)
+        self.lease_actions = set(lease_actions)
+        self.lease_block = lease_block
+        # Requests a worker may allow per window beyond what Redis has granted
+        self.max_over_allowance = max_over_allowance
+        self.reconcile_interval = reconcile_interval
+        self._buckets = {}
+        self._reconciler = None
+
+        # Cached user -> tier lookups (see tier_resolver.py)
+        self.tier_resolver = tier_resolver
+
         self.limits = {
           'starter': {
               'monthly': {'collections': 10, 'emails': 500, 'sms': 0, 'ai_calls': 0, 'letters': 0},
@@ -32,67 +348,468 @@ class RateLimiter:
           'letter': 1.50
         }
 
+    async def _get_limits(self, user_id):
+        # Usually served from the resolver's in-process cache, with no round trip
+        if self.tier_resolver is None:
+            user_tier = "pro"  # No resolver (benchmarks, local runs): everyone is pro
+        else:
+            user_tier = await self.tier_resolver.resolve(user_id)
+        return self.limits.get(user_tier, self.limits['starter'])
+
+    async def reserve(self, user_id, action, count=1):
+        """Atomically check every window and the cost cap and consume them (one round trip)
+
+        Use this instead of check_limit + consume_limit, which can let
+        concurrent requests overshoot a limit. Returns the blocking `window`
+        ('hourly', 'daily', 'monthly' or 'cost') when the request is refused.
+        """
+        limits = await self._get_limits(user_id)
+        if self._is_leased(action, limits):
+            return await self._reserve_leased(user_id, action, count, limits['hourly'][action])
+        if self._algorithm(action) != "fixed":
+            return await self._run_smoothed(user_id, action, count, limits, "reserve")
+
+        cost = self.costs.get(action, 0) * count
+        cost_limit = limits.get('daily', {}).get('total_cost_gbp')
+
+        keys = [self._get_key(user_id, window) for window in WINDOWS]
+        window_limits = [limits.get(window, {}).get(action) for window in WINDOWS]
+        args = [action, count]
+        args += [-1 if limit is None else limit for limit in window_limits]
+        args += [self._get_ttl(window) for window in WINDOWS]
+        args += [cost, -1 if cost_limit is None else cost_limit]
+
+        allowed, blocked, *usage, spent = await self._reserve_script(keys=keys, args=args)
+
+        remaining = {
+            window: limit - used
+            for window, limit, used in zip(WINDOWS, window_limits, usage)
+            if limit is not None
+        }
+        return self._result(action, allowed, blocked, remaining, cost, cost_limit, spent)
+
+    def _result(self, action, allowed, blocked, remaining, cost, cost_limit, spent, retry_after=None):
+        if cost_limit is not None and cost > 0:
+            remaining['total_cost_gbp'] = round(cost_limit - float(spent), 4)
+
+        if allowed:
+            return {'allowed': True, 'remaining': remaining}
+        if blocked == 4:
+            return {'allowed': False, 'window': 'cost', 'reason': 'Daily cost limit exceeded', 'remaining': remaining}
+        window = WINDOWS[blocked - 1]
+        result = {
+            'allowed': False,
+            'window': window,
+            'reason': f'{window.capitalize()} limit for {action} exceeded',
+            'remaining': remaining,
+        }
+        if retry_after is not None:
+            result['retry_after'] = round(retry_after, 3)
+        return result
+
+    def _algorithm(self, action):
+        return self.algorithms.get(action, "fixed")
+
+    async def _run_smoothed(self, user_id, action, count, limits, mode):
+        """Check and/or consume a sliding-window or GCRA action in one round trip"""
+        cost = self.costs.get(action, 0) * count
+        cost_limit = limits.get('daily', {}).get('total_cost_gbp')
+        allowed, blocked, retry_after, *window_remaining, spent = await self._call_smoothed(
+            user_id, action, count, limits, mode
+        )
+
+        remaining = {
+            window: left
+            for window, left in zip(WINDOWS, window_remaining)
+            if left >= 0
+        }
+        return self._result(action, allowed, blocked, remaining, cost, cost_limit, spent, float(retry_after))
+
+    def _call_smoothed(self, user_id, action, count, limits, mode, client=None):
+        """The smoothed script call; queued rather than sent when `client` is a pipeline"""
+        cost = self.costs.get(action, 0) * count
+        cost_limit = limits.get('daily', {}).get('total_cost_gbp')
+        window_limits = [limits.get(window, {}).get(action) for window in WINDOWS]
+
+        args = [count, mode]
+        args += [-1 if limit is None else limit for limit in window_limits]
+        args += [self._get_ttl(window) for window in WINDOWS]
+        args += [self.gcra_burst_ratio, cost, -1 if cost_limit is None else cost_limit, self._get_ttl("daily")]
+
+        script = self._smoothed_scripts[self._algorithm(action)]
+        return script(
+            keys=[self._get_state_key(user_id, action), self._get_key(user_id, "daily")],
+            args=args,
+            client=client,
+        )
+
+    def _is_leased(self, action, limits):
+        """Leasing covers actions limited on the hourly window alone, with no cost"""
+        return (
+            action in self.lease_actions
+            and self._algorithm(action) == "fixed"
+            and limits.get('hourly', {}).get(action) is not None
+            and all(limits.get(window, {}).get(action) is None for window in ("daily", "monthly"))
+            and not self.costs.get(action)
+        )
+
+    async def _reserve_leased(self, user_id, action, count, limit):
+        """Serve a reservation from this worker's leased tokens
+
+        Redis is only contacted to lease the next block. When the tokens run
+        out, up to max_over_allowance requests are allowed on credit while the
+        next lease is fetched in the background, so the hot path never waits
+        on Redis until the window is nearly used up.
+        """
+        self._ensure_reconciler()
+        while True:
+            bucket = self._get_bucket(user_id, action, limit)
+            bucket.last_used = time.monotonic()
+
+            if bucket.tokens >= count:
+                bucket.tokens -= count
+                if bucket.tokens < self.lease_block // 4 and not bucket.exhausted:
+                    # Fetch the next block before this one runs out
+                    self._lease(bucket, count).add_done_callback(self._log_lease_error)
+                return {'allowed': True, 'remaining': {'hourly': bucket.remaining + bucket.tokens}}
+
+            if bucket.exhausted:
+                if time.monotonic() < bucket.retry_at:
+                    return {
+                        'allowed': False,
+                        'window': 'hourly',
+                        'reason': f'Hourly limit for {action} exceeded',
+                        'remaining': {'hourly': bucket.tokens},
+                    }
+            elif bucket.debt + count <= self.max_over_allowance:
+                bucket.debt += count
+                self._lease(bucket, count).add_done_callback(self._log_lease_error)
+                return {'allowed': True, 'remaining': {'hourly': bucket.remaining}}
+
+            await self._lease(bucket, count)
+            if not bucket.closed and bucket.tokens < count and bucket.exhausted:
+                bucket.retry_at = time.monotonic() + self.reconcile_interval
+
+    def _get_bucket(self, user_id, action, limit):
+        key = self._get_key(user_id, "hourly")
+        bucket = self._buckets.get((key, action))
+        if bucket is None:
+            bucket = self._buckets[(key, action)] = LeasedBucket(
+                key, action, self._get_timestamp_for_window("hourly"), limit
+            )
+        return bucket
+
+    def _lease(self, bucket, need):
+        """The bucket's in-flight lease, starting one if none is running"""
+        if bucket.refill is None or bucket.refill.done():
+            bucket.refill = asyncio.ensure_future(self._fetch_lease(bucket, need))
+        return bucket.refill
+
+    async def _fetch_lease(self, bucket, need):
+        debt, bucket.debt = bucket.debt, 0
+        try:
+            granted, used = await self._lease_script(
+                keys=[bucket.key],
+                args=[debt, max(self.lease_block, need), bucket.limit, self._get_ttl("hourly"), bucket.action],
+            )
+        except Exception:
+            bucket.debt += debt
+            raise
+
+        bucket.tokens += granted
+        bucket.remaining = max(bucket.limit - used, 0)
+        if granted < need:
+            # No more credit this window; later requests wait for a real lease
+            bucket.exhausted = True
+
+    @staticmethod
+    def _log_lease_error(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Rate limit lease failed: {task.exception()}")
+
+    def _ensure_reconciler(self):
+        if self._reconciler is None or self._reconciler.done():
+            self._reconciler = asyncio.get_running_loop().create_task(self._reconcile_loop())
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Rate limit reconciliation failed: {e}")
+
+    async def reconcile(self, force=False):
+        """Hand idle buckets' unspent tokens back to Redis for other workers
+
+        Buckets used within the last reconcile_interval keep their lease
+        unless `force` is set. Buckets from a past window are dropped; their
+        counters expire on their own.
+        """
+        now = time.monotonic()
+        window_ts = self._get_timestamp_for_window("hourly")
+        for key, bucket in list(self._buckets.items()):
+            if bucket.refill is not None and not bucket.refill.done():
+                continue
+            current = bucket.window_ts == window_ts
+            if current and not force and now - bucket.last_used < self.reconcile_interval:
+                continue
+
+            del self._buckets[key]
+            bucket.closed = True
+            if current and bucket.tokens != bucket.debt:
+                await self._return_script(keys=[bucket.key], args=[bucket.tokens - bucket.debt, bucket.action])
+
+    async def close(self):
+        """Stop the reconciler and return every leased token"""
+        if self._reconciler is not None:
+            self._reconciler.cancel()
+            self._reconciler = None
+        await self.reconcile(force=True)
+
+    async def release(self, user_id, action, count=1):
+        """Give back a reservation whose action did not go ahead"""
+        limits = await self._get_limits(user_id)
+        if self._is_leased(action, limits):
+            # Back into the local bucket; reconcile() returns it to Redis if unused
+            self._get_bucket(user_id, action, limits['hourly'][action]).tokens += count
+            return
+        await self.consume_limit(user_id, action, -count)
+
     async def check_limit(self, user_id, action, count=1):
-        # In a real app, you'd get the user's tier from the database
-        user_tier = "pro" # Mocking for now
-        limits = self.limits.get(user_tier, self.limits['starter'])
+        """Check without consuming (one round trip); reserve() is the race-free path"""
+        limits = await self._get_limits(user_id)
+        if self._algorithm(action) != "fixed":
+            return await self._run_smoothed(user_id, action, count, limits, "check")
 
         # Check various time windows
-        if not await self._is_allowed(user_id, action, count, "hourly", limits.get('hourly', {}).get(action)):
-            return {'allowed': False, 'reason': f'Hourly limit for {action} exceeded'}
-        if not await self._is_allowed(user_id, action, count, "daily", limits.get('daily', {}).get(action)):
-            return {'allowed': False, 'reason': f'Daily limit for {action} exceeded'}
-        if not await self._is_allowed(user_id, action, count, "monthly", limits.get('monthly', {}).get(action)):
-            return {'allowed': False, 'reason': f'Monthly limit for {action} exceeded'}
+        pipe = self.redis.pipeline(transaction=False)
+        for window in WINDOWS:
+            pipe.hmget(self._get_key(user_id, window), [action, COST_FIELD])
+        windows = await pipe.execute()
+        usage = [used for used, _ in windows]
+        current_cost = windows[WINDOWS.index("daily")][1]
+
+        for window, current_usage in zip(WINDOWS, usage):
+            limit = limits.get(window, {}).get(action)
+            if limit is not None and int(current_usage or 0) + count > limit:
+                return {'allowed': False, 'window': window, 'reason': f'{window.capitalize()} limit for {action} exceeded'}
 
         # Check cost limit
         cost = self.costs.get(action, 0) * count
         if cost > 0:
             daily_cost_limit = limits.get('daily', {}).get('total_cost_gbp')
-            if not await self._is_cost_allowed(user_id, cost, daily_cost_limit):
-                return {'allowed': False, 'reason': 'Daily cost limit exceeded'}
+            if daily_cost_limit is not None and float(current_cost or 0) + cost > daily_cost_limit:
+                return {'allowed': False, 'window': 'cost', 'reason': 'Daily cost limit exceeded'}
 
         return {'allowed': True}
     
     async def consume_limit(self, user_id, action, count=1):
+        if self._algorithm(action) != "fixed":
+            # Consumed even over the limit, like the fixed-window counters below
+            await self._run_smoothed(user_id, action, count, await self._get_limits(user_id), "force")
+            return {'allowed': True}
+
         pipe = self.redis.pipeline()
-        for window in ["hourly", "daily", "monthly"]:
-            key = self._get_key(user_id, action, window)
-            pipe.incrby(key, count)
+        for window in WINDOWS:
+            key = self._get_key(user_id, window)
+            pipe.hincrby(key, action, count)
             pipe.expire(key, self._get_ttl(window))
         
         cost = self.costs.get(action, 0) * count
-        if cost > 0:
-            cost_key = self._get_cost_key(user_id, "daily")
-            pipe.incrbyfloat(cost_key, cost)
-            pipe.expire(cost_key, self._get_ttl("daily"))
+        if cost != 0:
+            # Negative when release() refunds a reservation
+            pipe.hincrbyfloat(self._get_key(user_id, "daily"), COST_FIELD, cost)
 
         await pipe.execute()
         return {'allowed': True}
 
-    async def _is_allowed(self, user_id, action, count, window, limit):
-        if limit is None:
-            return True
-        key = self._get_key(user_id, action, window)
-        current_usage = await self.redis.get(key)
-        current_usage = int(current_usage) if current_usage else 0
-        return current_usage + count <= limit
-
-    async def _is_cost_allowed(self, user_id, cost, limit):
-        if limit is None:
-            return True
-        key = self._get_cost_key(user_id, "daily")
-        current_cost = await self.redis.get(key)
-        current_cost = float(current_cost) if current_cost else 0
-        return current_cost + cost <= limit
-
-    def _get_key(self, user_id, action, window):
-        ts = self._get_timestamp_for_window(window)
-        return f"ratelimit:{user_id}:{action}:{window}:{ts}"
+    async def check_limits_many(self, requests):
+        """Check many (user_id, action, count) requests in one round trip
+
+        Reads every window counter, smoothed-algorithm state and cost total the
+        batch touches in one pipeline, then decides the requests in order
+        against a shared budget: an allowed request uses up quota for later
+        requests from the same user. Nothing is consumed; pass the allowed
+        requests to consume_limits_many(). Returns one check_limit-style
+        result per request.
+        """
+        requests = list(requests)
+        if not requests:
+            return []
+        user_ids = list(dict.fromkeys(user_id for user_id, _, _ in requests))
+        user_limits = dict(zip(user_ids, await asyncio.gather(*(self._get_limits(user_id) for user_id in user_ids))))
+        pairs = list(dict.fromkeys((user_id, action) for user_id, action, _ in requests))
+
+        smoothed = [pair for pair in pairs if self._algorithm(pair[1]) != "fixed"]
 
-    def _get_cost_key(self, user_id, window):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.time()
+        for user_id in user_ids:
+            for window in WINDOWS:
+                pipe.hgetall(self._get_key(user_id, window))
+        for user_id, action in smoothed:
+            pipe.hgetall(self._get_state_key(user_id, action))
+        (seconds, microseconds), *hashes = await pipe.execute()
+
+        now = int(seconds) + int(microseconds) / 1000000
+        counters = {
+            user_id: dict(zip(WINDOWS, hashes[i * len(WINDOWS):(i + 1) * len(WINDOWS)]))
+            for i, user_id in enumerate(user_ids)
+        }
+        states = dict(zip(smoothed, hashes[len(user_ids) * len(WINDOWS):]))
+        spent = {user_id: float(counters[user_id]["daily"].get(COST_FIELD, 0)) for user_id in user_ids}
+        budgets = {}
+        for user_id, action in pairs:
+            if (user_id, action) in states:
+                stored = states[(user_id, action)]
+            else:
+                stored = [counters[user_id][window].get(action) for window in WINDOWS]
+            budgets[(user_id, action)] = self._batch_state(action, stored, now)
+
+        results = []
+        for user_id, action, count in requests:
+            limits = user_limits[user_id]
+            state = budgets[(user_id, action)]
+            updated = {}
+            blocked = None
+            for window in WINDOWS:
+                limit = limits.get(window, {}).get(action)
+                if limit is None:
+                    continue
+                updated[window] = self._batch_admit(action, state[window], limit, self._get_ttl(window), count, now)
+                if updated[window] is None:
+                    blocked = window
+                    break
+
+            cost = self.costs.get(action, 0) * count
+            cost_limit = limits.get('daily', {}).get('total_cost_gbp')
+            if blocked:
+                results.append({'allowed': False, 'window': blocked, 'reason': f'{blocked.capitalize()} limit for {action} exceeded'})
+            elif cost > 0 and cost_limit is not None and spent[user_id] + cost > cost_limit:
+                results.append({'allowed': False, 'window': 'cost', 'reason': 'Daily cost limit exceeded'})
+            else:
+                state.update(updated)
+                spent[user_id] += cost
+                results.append({'allowed': True})
+        return results
+
+    def _batch_state(self, action, stored, now):
+        """Per-window budget state for check_limits_many, from what Redis holds now"""
+        algorithm = self._algorithm(action)
+        if algorithm == "fixed":
+            # Counter value per window
+            return {window: int(used or 0) for window, used in zip(WINDOWS, stored)}
+        if algorithm == "gcra":
+            # Theoretical arrival time per window
+            return {window: max(float(stored.get(window, 0)), now) for window in WINDOWS}
+
+        # Sliding: (current, previous) window counts as of now
+        state = {}
+        for window in WINDOWS:
+            index = now // self._get_ttl(window)
+            stored_index = float(stored.get(f'{window}:index', -1))
+            if stored_index == index:
+                state[window] = (float(stored[f'{window}:cur']), float(stored.get(f'{window}:prev', 0)))
+            elif stored_index == index - 1:
+                state[window] = (0, float(stored[f'{window}:cur']))
+            else:
+                state[window] = (0, 0)
+        return state
+
+    def _batch_admit(self, action, state, limit, period, count, now):
+        """A window's state after admitting `count`, or None if it does not fit
+
+        Mirrors the per-request Lua scripts for each algorithm.
+        """
+        algorithm = self._algorithm(action)
+        if algorithm == "fixed":
+            return state + count if state + count <= limit else None
+        if algorithm == "gcra":
+            interval = period / max(limit, 1)
+            tolerance = interval * (max(int(limit * self.gcra_burst_ratio), 1, count) - 1)
+            new_tat = max(state + interval * count, now)
+            return new_tat if limit > 0 and new_tat - interval - now <= tolerance else None
+
+        current, previous = state
+        elapsed = now % period
+        if previous * (period - elapsed) / period + current + count > limit:
+            return None
+        return (current + count, previous)
+
+    async def consume_limits_many(self, requests):
+        """Consume many (user_id, action, count) requests in one pipeline
+
+        Like consume_limit, requests are recorded even over the limit, so check
+        them with check_limits_many() first. Counts for the same user and
+        action are added up and written once.
+        """
+        requests = list(requests)
+        totals = {}
+        for user_id, action, count in requests:
+            totals[(user_id, action)] = totals.get((user_id, action), 0) + count
+        if not totals:
+            return []
+        user_ids = list(dict.fromkeys(user_id for user_id, _ in totals))
+        user_limits = dict(zip(user_ids, await asyncio.gather(*(self._get_limits(user_id) for user_id in user_ids))))
+
+        pipe = self.redis.pipeline(transaction=False)
+        costs = {}
+        for (user_id, action), count in totals.items():
+            if self._algorithm(action) != "fixed":
+                # The script adds the action's cost itself
+                await self._call_smoothed(user_id, action, count, user_limits[user_id], "force", client=pipe)
+                continue
+            for window in WINDOWS:
+                pipe.hincrby(self._get_key(user_id, window), action, count)
+            costs[user_id] = costs.get(user_id, 0) + self.costs.get(action, 0) * count
+
+        for user_id, cost in costs.items():
+            # One expiry per user and window hash, however many actions it counts
+            for window in WINDOWS:
+                pipe.expire(self._get_key(user_id, window), self._get_ttl(window))
+            if cost > 0:
+                pipe.hincrbyfloat(self._get_key(user_id, "daily"), COST_FIELD, cost)
+
+        await pipe.execute()
+        return [{'allowed': True} for _ in requests]
+
+    async def migrate_legacy_keys(self, batch_size=500):
+        """Fold counters from the old one-key-per-action layout into the window hashes
+
+        Old keys (ratelimit:{user}:{action}:{window}:{period} and
+        ratelimit:cost:{user}:daily:{period}) are moved into the matching
+        hash field and deleted. Each key moves atomically, so this can run
+        while workers serve traffic, and again safely. Returns the number of
+        keys migrated.
+        """
+        migrated = 0
+        async for key in self.redis.scan_iter(match="ratelimit:*", count=batch_size, _type="string"):
+            if isinstance(key, bytes):
+                key = key.decode()
+            parts = key.split(":")
+            if parts[1] == "cost" and len(parts) >= 5:
+                user_id, window, period = ":".join(parts[2:-2]), parts[-2], parts[-1]
+                field, is_float = COST_FIELD, "1"
+            elif len(parts) >= 5:
+                user_id, window, period = ":".join(parts[1:-3]), parts[-2], parts[-1]
+                field, is_float = parts[-3], "0"
+            else:
+                continue
+            if window not in WINDOWS:
+                continue
+            hash_key = f"ratelimit:{user_id}:{window}:{period}"
+            migrated += await self._migrate_script(keys=[key, hash_key], args=[field, is_float])
+        return migrated
+
+    def _get_key(self, user_id, window):
+        # One hash per user per window period, one field per action
         ts = self._get_timestamp_for_window(window)
-        return f"ratelimit:cost:{user_id}:{window}:{ts}"
+        return f"ratelimit:{user_id}:{window}:{ts}"
+
+    def _get_state_key(self, user_id, action):
+        # One key per (user, action) for the sliding and GCRA algorithms
+        return f"ratelimit:{self._algorithm(action)}:{user_id}:{action}"
 
     def _get_timestamp_for_window(self, window):
         now = datetime.utcnow()
@@ -112,3 +829,15 @@ class RateLimiter:
         if window == "monthly":
             return 31 * 86400
         return 3600
+
+
+if __name__ == "__main__":
+    # Move counters written before the hash layout: python rate_limiter_py.py
+    logging.basicConfig(level=logging.INFO)
+
+    async def migrate():
+        limiter = RateLimiter()
+        logger.info(f"Migrated {await limiter.migrate_legacy_keys()} rate limit keys")
+        await limiter.redis.aclose()
+
+    asyncio.run(migrate())
@@ -0,0 +1,66 @@
+# tests/test_escalation_pending.py
+"""
+Actions the nightly escalation run refuses for quota are retried on later runs
+
+Needs the worker's dependencies (celery, openai, twilio) and fakeredis.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("openai")
+pytest.importorskip("twilio")
+fakeredis = pytest.importorskip("fakeredis")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ai_collection_system as acs
+from rate_limiter_py import RateLimiter
+
+
+class StubPredictor:
+    def recommend_collection_strategies(self, invoices):
+        return [{'urgency': 'low', 'payment_probability': 0.9} for _ in invoices]
+
+
+def overdue_row(invoice_id, days_overdue):
+    return {
+        'id': invoice_id, 'user_id': 'user-1', 'client_id': 'client-1', 'amount': 100.0,
+        'currency': 'GBP', 'due_date': datetime.utcnow() - timedelta(days=days_overdue),
+        'days_overdue': days_overdue, 'client_name': 'Client', 'client_email': 'client@example.com',
+        'client_phone': '+447700900000', 'user_tier': 'starter',
+    }
+
+
+def test_refused_action_is_sent_on_a_later_run(monkeypatch):
+    server = fakeredis.FakeServer()
+    redis_client = fakeredis.aioredis.FakeRedis(server=server)
+    limiter = RateLimiter(redis_client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    queued = []
+    monkeypatch.setattr(acs, 'redis_client', redis_client)
+    monkeypatch.setattr(acs, 'rate_limiter', limiter)
+    monkeypatch.setattr(acs.execute_collection_action, 'delay', lambda *args: queued.append(args))
+
+    # Starter users may send 10 emails an hour; 11 invoices reach the 7-day stage at once
+    hourly_limit = limiter.limits['starter']['hourly']['emails']
+    rows = [overdue_row(f'inv-{i}', 7) for i in range(hourly_limit + 1)]
+    assert asyncio.run(acs.process_escalation_chunk(rows, StubPredictor())) == hourly_limit
+    refused = next(row['id'] for row in rows if (row['id'], 'gentle_email') not in queued)
+
+    # Next day: quota has reset, and the invoice is past the stage's exact day
+    async def reset_quota():
+        await limiter.redis.delete(*await limiter.redis.keys('ratelimit:*'))
+    asyncio.run(reset_quota())
+    queued.clear()
+    assert asyncio.run(acs.process_escalation_chunk([overdue_row(refused, 8)], StubPredictor())) == 1
+    assert queued == [(refused, 'gentle_email')]
+
+    # Once sent it is no longer pending
+    queued.clear()
+    asyncio.run(redis_client.delete(acs.action_claim_key(refused)))
+    assert asyncio.run(acs.process_escalation_chunk([overdue_row(refused, 9)], StubPredictor())) == 0
@@ -0,0 +1,91 @@
+# tests/test_rate_limiter.py
+"""
+Concurrent reservations never overshoot a limit, and releases refund them
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rate_limiter_py import COST_FIELD, RateLimiter
+
+
+def make_limiter(**kwargs):
+    # No tier resolver: every user gets the pro limits. Enough connections
+    # for every reservation to be in flight at once, as on a busy worker
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True, max_connections=1000)
+    return RateLimiter(redis_client=client, **kwargs)
+
+
+@pytest.mark.parametrize("algorithm", ["fixed", "sliding"])
+def test_concurrent_reserves_stop_at_the_limit(algorithm):
+    async def run():
+        limiter = make_limiter(algorithms={'emails': algorithm})
+        limit = limiter.limits['pro']['hourly']['emails']
+
+        results = await asyncio.gather(*(limiter.reserve('user-1', 'emails', 1) for _ in range(limit * 4)))
+        allowed = sum(result['allowed'] for result in results)
+
+        if algorithm == "fixed":
+            used = await limiter.redis.hget(limiter._get_key('user-1', 'hourly'), 'emails')
+        else:
+            used = await limiter.redis.hget(limiter._get_state_key('user-1', 'emails'), 'hourly:cur')
+        return limit, allowed, int(float(used))
+
+    limit, allowed, used = asyncio.run(run())
+    assert allowed == limit
+    assert used == limit
+
+
+def test_release_refunds_the_daily_cost():
+    async def run():
+        limiter = make_limiter()
+        daily_key = limiter._get_key('user-1', 'daily')
+
+        assert (await limiter.reserve('user-1', 'sms', 2))['allowed']
+        reserved = float(await limiter.redis.hget(daily_key, COST_FIELD))
+        await limiter.release('user-1', 'sms', 2)
+        return reserved, float(await limiter.redis.hget(daily_key, COST_FIELD)), \
+            int(await limiter.redis.hget(daily_key, 'sms'))
+
+    reserved, refunded, used = asyncio.run(run())
+    assert reserved == pytest.approx(0.08)
+    assert refunded == pytest.approx(0)
+    assert used == 0
+
+
+def test_gcra_admits_the_burst_back_to_back():
+    async def run():
+        limiter = make_limiter(algorithms={'emails': 'gcra'}, gcra_burst_ratio=0.1)
+        results = [await limiter.reserve('user-1', 'emails', 1) for _ in range(20)]
+        return limiter, results
+
+    limiter, results = asyncio.run(run())
+    # Pro hourly limit 50: a 10% burst is 5, then one every 72 s
+    assert sum(result['allowed'] for result in results) == 5
+    assert 0 < results[5]['retry_after'] <= 72
+
+
+@pytest.mark.parametrize("ratio", [0.1, 0.5, 1.0])
+def test_gcra_rolling_period_admits_at_most_limit_plus_burst(ratio):
+    limiter = make_limiter(algorithms={'emails': 'gcra'}, gcra_burst_ratio=ratio)
+    limit, period = 50, 3600
+    burst = max(int(limit * ratio), 1)
+
+    # A request every 10 s for two hours, against the batch path's mirror of the script
+    tat, admitted = 0.0, []
+    for now in range(0, 2 * period, 10):
+        updated = limiter._batch_admit('emails', max(tat, now), limit, period, 1, now)
+        if updated is not None:
+            tat = updated
+            admitted.append(now)
+
+    busiest = max(sum(1 for t in admitted if start <= t < start + period) for start in admitted)
+    assert busiest <= limit + burst - 1
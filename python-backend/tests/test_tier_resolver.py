@@ -0,0 +1,107 @@
+# tests/test_tier_resolver.py
+"""
+An invalidation during a tier lookup is never undone by that lookup
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tier_resolver import TierResolver
+
+
+class SlowTable:
+    """A `users` table whose reads block until released"""
+
+    def __init__(self, tier):
+        self.tier = tier
+        self.reads = 0
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def load(self, user_id):
+        self.reads += 1
+        tier = self.tier
+        self.reading.set()
+        await self.release.wait()
+        return tier
+
+
+def make_resolver(load, **kwargs):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    return TierResolver(load, redis_client=client, **kwargs)
+
+
+def test_invalidation_during_load_is_not_undone():
+    async def run():
+        table = SlowTable('starter')
+        resolver = make_resolver(table.load, settle_delay=0)
+
+        lookup = asyncio.ensure_future(resolver.resolve('user_1'))
+        await table.reading.wait()
+
+        # The subscription changes while the old row is in flight
+        table.tier = 'pro'
+        await resolver.invalidate('user_1')
+        table.release.set()
+
+        # The stale lookup still answers its own caller...
+        assert await lookup == 'starter'
+        # ...but caches nothing
+        assert await resolver.redis.get('tier:user_1') is None
+        assert resolver.cached('user_1') is None
+
+        assert await resolver.resolve('user_1') == 'pro'
+        assert await resolver.redis.get('tier:user_1') == 'pro'
+        assert resolver.cached('user_1') == 'pro'
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_misses_after_invalidation_do_not_share_the_stale_load():
+    async def run():
+        table = SlowTable('starter')
+        resolver = make_resolver(table.load, settle_delay=0)
+
+        stale = asyncio.ensure_future(resolver.resolve('user_1'))
+        await table.reading.wait()
+        table.tier = 'pro'
+        await resolver.invalidate('user_1')
+
+        fresh = asyncio.ensure_future(resolver.resolve('user_1'))
+        await asyncio.sleep(0)
+        table.release.set()
+
+        assert await stale == 'starter'
+        assert await fresh == 'pro'
+        assert table.reads == 2
+        await resolver.close()
+
+    asyncio.run(run())
+
+
+def test_invalidation_repeats_after_the_settle_delay():
+    async def run():
+        table = SlowTable('starter')
+        table.release.set()
+        resolver = make_resolver(table.load, settle_delay=0.05)
+
+        # The webhook here beats the other service's write to users.tier
+        await resolver.invalidate('user_1')
+        assert await resolver.resolve('user_1') == 'starter'
+
+        table.tier = 'pro'
+        await asyncio.sleep(0.1)
+        assert resolver.cached('user_1') is None
+        assert await resolver.resolve('user_1') == 'pro'
+        await resolver.close()
+
+    asyncio.run(run())
@@ -0,0 +1,213 @@
+# tier_resolver.py
+"""
+Cached subscription tier lookups for the rate limiters
+
+Tiers are read through three layers:
+- an in-process LRU, so the common case costs no round trip at all
+- a shared Redis key per user, so a cold worker does not hit the database
+- the `users` table
+
+Subscription changes (Stripe and Clerk webhooks) call `invalidate()`, which
+deletes the Redis key and publishes the user id so every worker evicts its
+local entry. Local entries also expire after a short TTL, which bounds how
+stale a worker can be if it missed an invalidation message.
+
+Invalidation also bumps a generation counter, as invoice_cache does. A fill
+only lands if the generation is still the one seen before the load, and a
+worker only primes its LRU if no invalidation arrived meanwhile, so a load
+that read the old row cannot put it back after the invalidation.
+
+This service never writes `users.tier`; the Next.js Stripe and Clerk webhooks
+do, from the same events. An invalidation that runs before their commit lets
+the next miss cache the old tier again, so `invalidate()` repeats itself
+after TIER_INVALIDATE_SETTLE seconds. That bounds staleness from the race to
+the settle delay instead of TIER_CACHE_TTL.
+"""
+
+import redis.asyncio as redis
+import asyncio
+import os
+import time
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "tier:invalidate"
+
+# KEYS: tier key, generation key
+# ARGV: generation seen before loading, tier, TTL (s)
+FILL_SCRIPT = """
+local generation = redis.call('GET', KEYS[2]) or ''
+if generation ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', tonumber(ARGV[3]))
+return 1
+"""
+
+
+class TierResolver:
+    def __init__(
+        self,
+        load_tier,
+        redis_url=os.environ.get("REDIS_URL", "redis://localhost:6379"),
+        redis_client=None,
+        local_ttl=float(os.environ.get("TIER_CACHE_LOCAL_TTL", 60)),
+        redis_ttl=int(os.environ.get("TIER_CACHE_TTL", 900)),
+        max_entries=int(os.environ.get("TIER_CACHE_SIZE", 10000)),
+        settle_delay=float(os.environ.get("TIER_INVALIDATE_SETTLE", 30)),
+        default_tier="starter",
+    ):
+        # `load_tier(user_id) -> tier or None`; awaited if async, else run in a thread
+        self.load_tier = load_tier
+        self.redis = redis_client or redis.from_url(redis_url, decode_responses=True)
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.max_entries = max_entries
+        self.settle_delay = settle_delay
+        # Tier for users with no row, as the old per-call lookups assumed
+        self.default_tier = default_tier
+
+        self._local = OrderedDict()  # user_id -> (tier, expires at)
+        self._loading = {}  # user_id -> in-flight lookup shared by concurrent misses
+        self._subscriber = None
+        self._fill_script = self.redis.register_script(FILL_SCRIPT)
+        # Bumped on every invalidation this worker sees; a fetch that spans
+        # one must not prime the LRU
+        self._invalidations = 0
+        self._settling = set()  # repeat invalidations waiting on settle_delay
+
+    def cached(self, user_id):
+        """The locally cached tier, or None on a miss (never blocks)"""
+        entry = self._local.get(user_id)
+        if entry is None:
+            return None
+        tier, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._local[user_id]
+            return None
+        self._local.move_to_end(user_id)
+        return tier
+
+    async def resolve(self, user_id):
+        """The user's tier: local LRU, then Redis, then the users table"""
+        self._ensure_subscriber()
+        tier = self.cached(user_id)
+        if tier is not None:
+            return tier
+
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = self._loading[user_id] = asyncio.ensure_future(self._fetch(user_id))
+            loading.add_done_callback(lambda done: self._finished_loading(user_id, done))
+        return await asyncio.shield(loading)
+
+    def _finished_loading(self, user_id, done):
+        # An invalidation may already have replaced the shared load
+        if self._loading.get(user_id) is done:
+            del self._loading[user_id]
+
+    async def _fetch(self, user_id):
+        invalidations = self._invalidations
+        key, generation_key = self._get_keys(user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.get(generation_key)
+            tier, generation = await pipe.execute()
+
+        tier = self._decode(tier)
+        fresh = True
+        if tier is None:
+            if asyncio.iscoroutinefunction(self.load_tier):
+                tier = await self.load_tier(user_id)
+            else:
+                tier = await asyncio.to_thread(self.load_tier, user_id)
+            tier = tier or self.default_tier
+            # Rejected if the user was invalidated while the row was read
+            fresh = await self._fill_script(keys=[key, generation_key],
+                                            args=[self._decode(generation) or '', tier, self.redis_ttl])
+
+        # Serve what was read either way, but only cache it if nothing changed since
+        if fresh and invalidations == self._invalidations:
+            self.prime(user_id, tier)
+        return tier
+
+    def prime(self, user_id, tier):
+        """Cache a tier read elsewhere, e.g. a row that already joined `users`"""
+        self._local[user_id] = (tier, time.monotonic() + self.local_ttl)
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    async def invalidate(self, user_id, settle=True):
+        """Drop a user's tier everywhere after their subscription changed
+
+        With `settle`, the invalidation repeats after settle_delay, in case the
+        service that writes `users.tier` had not committed yet.
+        """
+        self._evict(user_id)
+        key, generation_key = self._get_keys(user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.incr(generation_key)
+            # Outlives any fill that could still be comparing against it
+            pipe.expire(generation_key, self.redis_ttl * 2)
+            pipe.publish(INVALIDATION_CHANNEL, user_id)
+            await pipe.execute()
+
+        if settle and self.settle_delay > 0:
+            task = asyncio.get_running_loop().create_task(self._settle(user_id))
+            self._settling.add(task)
+            task.add_done_callback(self._settling.discard)
+
+    async def _settle(self, user_id):
+        await asyncio.sleep(self.settle_delay)
+        try:
+            await self.invalidate(user_id, settle=False)
+        except Exception as e:
+            logger.error(f"Repeat tier invalidation failed for {user_id}: {e}")
+
+    def _evict(self, user_id):
+        self._invalidations += 1
+        self._local.pop(user_id, None)
+        # Later misses must not share a load that read the old row
+        self._loading.pop(user_id, None)
+
+    def _ensure_subscriber(self):
+        if self._subscriber is None or self._subscriber.done():
+            self._subscriber = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        """Evict local entries as other workers publish invalidations"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations published while unsubscribed were missed
+                self._invalidations += 1
+                self._local.clear()
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    self._evict(self._decode(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Tier invalidation subscriber failed: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def close(self):
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            self._subscriber = None
+        for task in list(self._settling):
+            task.cancel()
+
+    def _decode(self, value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _get_keys(self, user_id):
+        return f"tier:{user_id}", f"tier:{user_id}:gen"
@@ -0,0 +1,101 @@
+"""
+Forest Inference Latency Benchmark
+
+Trains the ensemble members used by the payment prediction service on
+synthetic data, compiles them with forest_inference, and reports single-row
+and batch latency for native vs compiled inference. Parity with the native
+models is covered by tests/test_forest_inference.py.
+
+Usage:
+    python benchmark_inference.py [--samples 2000] [--batch 500] [--repeat 200]
+"""
+
+import argparse
+import sys
+import time
+from typing import Callable, Dict
+
+import numpy as np
+
+try:
+    import xgboost as xgb
+    from sklearn.ensemble import (GradientBoostingRegressor, RandomForestClassifier,
+                                  RandomForestRegressor)
+except ImportError:
+    print("ML libraries not installed. Run: pip install -r requirements.txt")
+    sys.exit(1)
+
+from forest_inference import compile_model
+
+N_FEATURES = 28  # 25 base + 3 engineered features, as in ml_service_enhanced
+
+
+def build_models(n_samples: int, seed: int = 42) -> Dict[str, tuple]:
+    """Train each supported model type with the service's hyperparameters"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_samples, N_FEATURES))
+    y = 30 + 8 * X[:, 0] - 5 * X[:, 1] + 3 * X[:, 2] * X[:, 3] + rng.normal(scale=4, size=n_samples)
+
+    models = {
+        'xgboost': xgb.XGBRegressor(
+            n_estimators=150, max_depth=6, learning_rate=0.05, subsample=0.8,
+            colsample_bytree=0.8, reg_alpha=0.1, reg_lambda=1.0, random_state=42
+        ),
+        'xgboost_classifier': xgb.XGBClassifier(n_estimators=100, max_depth=6, random_state=42),
+        'gradient_boost': GradientBoostingRegressor(
+            n_estimators=100, max_depth=5, learning_rate=0.1, random_state=42
+        ),
+        'random_forest': RandomForestRegressor(n_estimators=100, max_depth=10, random_state=42),
+        'random_forest_classifier': RandomForestClassifier(
+            n_estimators=100, max_depth=10, min_samples_split=5, random_state=42
+        ),
+    }
+
+    for name, model in models.items():
+        target = (y > 30).astype(int) if name.endswith('classifier') else y
+        model.fit(X, target)
+
+    return {name: (model, compile_model(model)) for name, model in models.items()}
+
+
+def time_call(fn: Callable, repeat: int) -> float:
+    """Median wall time of fn() in microseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return float(np.median(samples) * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--samples', type=int, default=2000, help='training samples')
+    parser.add_argument('--batch', type=int, default=500, help='rows per batch prediction')
+    parser.add_argument('--repeat', type=int, default=200, help='timing repetitions')
+    args = parser.parse_args()
+
+    models = build_models(args.samples)
+    X_eval = np.random.default_rng(7).normal(size=(args.batch, N_FEATURES))
+
+    print(f"{'model':<26}{'native 1 row':>15}{'compiled 1 row':>17}"
+          f"{'native batch':>15}{'compiled batch':>17}")
+
+    for name, (model, compiled) in models.items():
+        if name.endswith('classifier'):
+            native_fn, compiled_fn = model.predict_proba, compiled.predict_proba
+        else:
+            native_fn, compiled_fn = model.predict, compiled.predict
+
+        row = X_eval[:1]
+        print(
+            f"{name:<26}"
+            f"{time_call(lambda: native_fn(row), args.repeat):>13.1f}us"
+            f"{time_call(lambda: compiled_fn(row), args.repeat):>15.1f}us"
+            f"{time_call(lambda: native_fn(X_eval), max(args.repeat // 10, 5)):>13.1f}us"
+            f"{time_call(lambda: compiled_fn(X_eval), max(args.repeat // 10, 5)):>15.1f}us"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Model Store Startup and Memory Benchmark
+
+Publishes one trained ensemble in both storage layouts, then starts several
+worker processes against each layout at the same time, the way gunicorn
+starts its workers:
+- pickle: each worker runs `joblib.load` on the scaler and all three ensemble
+  members. This is the flat `models/*.pkl` layout.
+- mmap: each worker loads the registry version. The compiled engines are
+  memory-mapped; only the scaler is unpickled.
+
+It reports:
+- the time until every worker is up, including the interpreter and imports
+- the import time of the libraries the service loads in either layout
+- the time spent loading models, and the time to the first prediction
+  (both measured after the imports)
+- RSS per worker
+- total PSS across workers, measured while all of them are alive. PSS
+  (proportional set size) splits shared pages between the processes that map
+  them, so the total shows the real memory cost of the worker pool.
+
+Usage:
+    python benchmark_model_store.py [--workers 4] [--samples 5000]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+N_FEATURES = 28  # 25 base + 3 engineered features, as in ml_service_enhanced
+MEMBERS = ('xgboost', 'gradient_boost', 'random_forest')
+WARMUP_ROWS = 2000
+
+
+def memory_usage() -> dict:
+    """RSS and PSS of this process in MB (Linux /proc only)"""
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    usage[key.lower()] = int(rest.split()[0]) / 1024
+    except OSError:
+        import resource
+        usage['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return usage
+
+
+def run_worker(layout: str, root: str):
+    """Load models like one service worker, report timings, then wait for the parent"""
+    started = time.perf_counter()
+
+    # ml_service_enhanced imports these at module load in either layout
+    import joblib
+    import numpy as np
+    import xgboost  # noqa: F401
+    import sklearn.ensemble  # noqa: F401
+    import sklearn.preprocessing  # noqa: F401
+    imported = time.perf_counter()
+
+    if layout == 'pickle':
+        models = {
+            name: joblib.load(os.path.join(root, 'pickle', f'{name}.pkl'))
+            for name in ('scaler',) + MEMBERS
+        }
+        scaler = models['scaler']
+        predictors = [models[name] for name in MEMBERS]
+    else:
+        from model_registry import ModelRegistry
+        model_set = ModelRegistry(os.path.join(root, 'registry')).load_active()
+        scaler = model_set.get('scaler')
+        predictors = [model_set.engines[name] for name in MEMBERS]
+
+    loaded = time.perf_counter()
+
+    for predictor in predictors:
+        predictor.predict(scaler.transform(np.zeros((1, N_FEATURES))))
+    first_prediction = time.perf_counter()
+
+    # Touch the whole model, as steady-state traffic would
+    X = scaler.transform(np.random.default_rng(0).normal(size=(WARMUP_ROWS, N_FEATURES)))
+    for predictor in predictors:
+        predictor.predict(X)
+
+    print(json.dumps({
+        'imports': imported - started,
+        'load': loaded - imported,
+        'firstPrediction': first_prediction - imported,
+    }), flush=True)
+
+    # Measure memory only once every worker is up, so shared pages are split
+    sys.stdin.readline()
+    print(json.dumps(memory_usage()), flush=True)
+    sys.stdin.readline()
+
+
+def build_store(root: str, n_samples: int):
+    """Train the service ensemble and write it in both layouts"""
+    try:
+        import joblib
+        import numpy as np
+        import xgboost as xgb
+        from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+        from sklearn.preprocessing import RobustScaler
+    except ImportError:
+        print("ML libraries not installed. Run: pip install -r requirements.txt")
+        sys.exit(1)
+
+    from forest_inference import compile_model
+    from model_registry import ModelRegistry
+
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(n_samples, N_FEATURES))
+    y = 30 + 8 * X[:, 0] - 5 * X[:, 1] + 3 * X[:, 2] * X[:, 3] + rng.normal(scale=4, size=n_samples)
+
+    scaler = RobustScaler()
+    X_scaled = scaler.fit_transform(X)
+    artifacts = {
+        'scaler': scaler,
+        'xgboost': xgb.XGBRegressor(
+            n_estimators=150, max_depth=6, learning_rate=0.05, subsample=0.8,
+            colsample_bytree=0.8, reg_alpha=0.1, reg_lambda=1.0, random_state=42
+        ).fit(X_scaled, y),
+        'gradient_boost': GradientBoostingRegressor(
+            n_estimators=100, max_depth=5, learning_rate=0.1, random_state=42
+        ).fit(X_scaled, y),
+        'random_forest': RandomForestRegressor(
+            n_estimators=100, max_depth=10, random_state=42
+        ).fit(X_scaled, y),
+    }
+
+    os.makedirs(os.path.join(root, 'pickle'))
+    for name, artifact in artifacts.items():
+        joblib.dump(artifact, os.path.join(root, 'pickle', f'{name}.pkl'))
+
+    engines = {name: compile_model(artifacts[name]) for name in MEMBERS}
+    ModelRegistry(os.path.join(root, 'registry')).publish(artifacts, {}, engines=engines)
+
+
+def directory_size(path: str) -> float:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return total / (1024 * 1024)
+
+
+def run_layout(layout: str, root: str, workers: int) -> dict:
+    """Start `workers` processes at once and collect their measurements"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    spawned = time.perf_counter()
+    procs = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', layout, '--root', root],
+            cwd=here, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        for _ in range(workers)
+    ]
+
+    timings = []
+    startup = []
+    for proc in procs:
+        timings.append(json.loads(proc.stdout.readline()))
+        startup.append(time.perf_counter() - spawned)
+
+    for proc in procs:
+        proc.stdin.write('\n')
+        proc.stdin.flush()
+    memory = [json.loads(proc.stdout.readline()) for proc in procs]
+
+    for proc in procs:
+        proc.stdin.close()
+        proc.wait()
+
+    return {
+        'startup': max(startup),
+        'imports': statistics.median(t['imports'] for t in timings),
+        'load': statistics.median(t['load'] for t in timings),
+        'firstPrediction': statistics.median(t['firstPrediction'] for t in timings),
+        'rss': statistics.median(m.get('rss', 0) for m in memory),
+        'pssTotal': sum(m['pss'] for m in memory) if all('pss' in m for m in memory) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--worker', choices=('pickle', 'mmap'), help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.root)
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"Training ensemble on {args.samples} samples...")
+        build_store(root, args.samples)
+        print(f"On disk: pickle {directory_size(os.path.join(root, 'pickle')):.1f} MB, "
+              f"registry (pickles + engines) {directory_size(os.path.join(root, 'registry')):.1f} MB\n")
+
+        print(f"{'layout':<8} {'workers up':>11} {'imports':>9} {'load':>9} {'1st pred':>9} "
+              f"{'RSS/worker':>11} {'PSS total':>10}")
+        for layout in ('pickle', 'mmap'):
+            result = run_layout(layout, root, args.workers)
+            pss = f"{result['pssTotal']:.1f} MB" if result['pssTotal'] is not None else 'n/a'
+            print(f"{layout:<8} {result['startup'] * 1000:>9.0f}ms {result['imports'] * 1000:>7.0f}ms "
+                  f"{result['load'] * 1000:>7.0f}ms "
+                  f"{result['firstPrediction'] * 1000:>7.0f}ms {result['rss']:>8.1f} MB {pss:>10}")
+
+
+if __name__ == '__main__':
+    main()
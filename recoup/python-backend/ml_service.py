@@ -15,8 +15,12 @@ Features continuous learning from actual payment outcomes
 **API Endpoints:**
 - POST /ml/predict-payment - Predict payment time
 - POST /ml/record-outcome - Record actual payment for retraining
-- POST /ml/train - Trigger model retraining
+- POST /ml/train - Start background model retraining (returns a job id)
+- GET /ml/train/<job_id> - Training job progress and result
 - GET /ml/model-info - Get model metadata
+- GET /ml/model-versions - List published model versions
+- POST /ml/model-versions/<version>/activate - Promote a version
+- POST /ml/model-versions/rollback - Re-activate the previous version
 """
 
 import os
@@ -24,10 +28,14 @@ import json
 import pickle
 import numpy as np
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional
 from flask import Flask, request, jsonify
 import logging
 
+from model_registry import ModelRegistry, ModelSet
+from outcome_log import OutcomeLog
+from training_jobs import TrainingJobManager
+
 # ML libraries
 try:
     import xgboost as xgb
@@ -47,9 +55,18 @@ MODEL_DIR = os.path.join(os.path.dirname(__file__), 'models')
 SCALER_PATH = os.path.join(MODEL_DIR, 'scaler.pkl')
 XGBOOST_PATH = os.path.join(MODEL_DIR, 'xgboost_model.pkl')
 GB_PATH = os.path.join(MODEL_DIR, 'gradient_boost_model.pkl')
+# Pre-outcome-log training data; imported into OUTCOME_LOG_DIR on startup
 TRAINING_DATA_PATH = os.path.join(MODEL_DIR, 'training_data.json')
+OUTCOME_LOG_DIR = os.path.join(MODEL_DIR, 'outcomes')
+# Status files for background training jobs
+TRAINING_JOBS_DIR = os.path.join(MODEL_DIR, 'jobs')
 MODEL_METADATA_PATH = os.path.join(MODEL_DIR, 'model_metadata.json')
 
+# Versioned artifact sets for this service (see model_registry.py)
+REGISTRY_DIR = os.path.join(MODEL_DIR, 'basic')
+# Seconds between checks of the registry's active version pointer
+MODEL_POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', 5))
+
 # Ensure model directory exists
 os.makedirs(MODEL_DIR, exist_ok=True)
 
@@ -96,65 +113,75 @@ class PaymentPredictor:
     """ML-powered payment time predictor"""
 
     def __init__(self):
-        self.scaler: Optional[StandardScaler] = None
-        self.xgboost_model: Optional[Any] = None
-        self.gb_model: Optional[Any] = None
-        self.metadata: Dict[str, Any] = {}
-        self.training_data: List[Dict[str, Any]] = []
+        self.registry = ModelRegistry(REGISTRY_DIR, poll_interval=MODEL_POLL_INTERVAL)
+        # Live models; replaced as a whole so requests always see one version
+        self.models = ModelSet(version=None)
+        # Recorded outcomes used for retraining
+        self.outcomes = OutcomeLog(OUTCOME_LOG_DIR)
 
         # Load models if they exist
         self.load_models()
 
-    def load_models(self):
-        """Load pre-trained models from disk"""
-        try:
-            if os.path.exists(SCALER_PATH):
-                self.scaler = joblib.load(SCALER_PATH)
-                logging.info("Loaded scaler")
+    @property
+    def scaler(self) -> Optional[Any]:
+        return self.models.get('scaler')
 
-            if os.path.exists(XGBOOST_PATH) and HAS_ML:
-                self.xgboost_model = joblib.load(XGBOOST_PATH)
-                logging.info("Loaded XGBoost model")
+    @property
+    def xgboost_model(self) -> Optional[Any]:
+        return self.models.get('xgboost') if HAS_ML else None
 
-            if os.path.exists(GB_PATH):
-                self.gb_model = joblib.load(GB_PATH)
-                logging.info("Loaded Gradient Boosting model")
+    @property
+    def gb_model(self) -> Optional[Any]:
+        return self.models.get('gradient_boost')
 
-            if os.path.exists(MODEL_METADATA_PATH):
-                with open(MODEL_METADATA_PATH, 'r') as f:
-                    self.metadata = json.load(f)
-                logging.info("Loaded model metadata")
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.models.metadata
 
-            if os.path.exists(TRAINING_DATA_PATH):
-                with open(TRAINING_DATA_PATH, 'r') as f:
-                    self.training_data = json.load(f)
-                logging.info(f"Loaded {len(self.training_data)} training samples")
+    def refresh_models(self, force: bool = False):
+        """Pick up a newly activated registry version, if any"""
+        model_set = self.registry.poll(self.models.version, force=force)
+        if model_set is not None:
+            self.models = model_set
+            logging.info(f"Serving model version {model_set.version}")
 
-        except Exception as e:
-            logging.error(f"Error loading models: {e}")
-
-    def save_models(self):
-        """Save trained models to disk"""
+    def load_models(self):
+        """Load the active model version from the registry"""
         try:
-            if self.scaler:
-                joblib.dump(self.scaler, SCALER_PATH)
-
-            if self.xgboost_model and HAS_ML:
-                joblib.dump(self.xgboost_model, XGBOOST_PATH)
+            model_set = self.registry.load_active() or self.import_legacy_models()
+            if model_set is not None:
+                self.models = model_set
+                logging.info(f"Loaded model version {model_set.version}")
 
-            if self.gb_model:
-                joblib.dump(self.gb_model, GB_PATH)
+            # Move a pre-log training_data.json into the outcome log
+            self.outcomes.import_json(TRAINING_DATA_PATH)
 
-            with open(MODEL_METADATA_PATH, 'w') as f:
-                json.dump(self.metadata, f, indent=2)
+        except Exception as e:
+            logging.error(f"Error loading models: {e}")
 
-            with open(TRAINING_DATA_PATH, 'w') as f:
-                json.dump(self.training_data, f, indent=2)
+    def import_legacy_models(self) -> Optional[ModelSet]:
+        """Publish pickles from the pre-registry flat layout as the first version"""
+        legacy_paths = {
+            'scaler': SCALER_PATH,
+            'xgboost': XGBOOST_PATH,
+            'gradient_boost': GB_PATH,
+        }
+        artifacts = {
+            name: joblib.load(path)
+            for name, path in legacy_paths.items()
+            if os.path.exists(path)
+        }
+        if not artifacts:
+            return None
 
-            logging.info("Models saved successfully")
+        metadata = {}
+        if os.path.exists(MODEL_METADATA_PATH):
+            with open(MODEL_METADATA_PATH, 'r') as f:
+                metadata = json.load(f)
 
-        except Exception as e:
-            logging.error(f"Error saving models: {e}")
+        self.registry.publish(artifacts, metadata)
+        logging.info("Imported legacy models into the model registry")
+        return self.registry.load_active()
 
     def extract_features(self, data: Dict[str, Any]) -> np.ndarray:
         """Extract feature vector from input data"""
@@ -184,24 +211,30 @@ class PaymentPredictor:
         """
         features = self.extract_features(features_dict)
 
+        # Snapshot the live version so a concurrent swap cannot mix models
+        self.refresh_models()
+        models = self.models
+        xgboost_model = models.get('xgboost') if HAS_ML else None
+        gb_model = models.get('gradient_boost')
+
         # If models not trained, use rule-based fallback
-        if not self.xgboost_model and not self.gb_model:
+        if not xgboost_model and not gb_model:
             return self._fallback_prediction(features_dict)
 
         # Scale features
-        if self.scaler:
-            features_scaled = self.scaler.transform(features)
+        if models.get('scaler'):
+            features_scaled = models.get('scaler').transform(features)
         else:
             features_scaled = features
 
         # Ensemble prediction
         predictions = []
-        if self.xgboost_model and HAS_ML:
-            xgb_pred = self.xgboost_model.predict(features_scaled)[0]
+        if xgboost_model:
+            xgb_pred = xgboost_model.predict(features_scaled)[0]
             predictions.append(xgb_pred)
 
-        if self.gb_model:
-            gb_pred = self.gb_model.predict(features_scaled)[0]
+        if gb_model:
+            gb_pred = gb_model.predict(features_scaled)[0]
             predictions.append(gb_pred)
 
         # Average ensemble predictions
@@ -224,7 +257,7 @@ class PaymentPredictor:
         )
 
         # Feature importance
-        factors = self._get_feature_importance(features_dict)
+        factors = self._get_feature_importance(features_dict, xgboost_model)
 
         return {
             'predictedDaysUntilPayment': max(0, predicted_days),
@@ -233,6 +266,7 @@ class PaymentPredictor:
             'recommendedStrategy': strategy,
             'riskLevel': risk_level,
             'factors': factors,
+            'modelVersion': models.version,
         }
 
     def _fallback_prediction(self, features_dict: Dict[str, Any]) -> Dict[str, Any]:
@@ -296,11 +330,13 @@ class PaymentPredictor:
 
         return risk_level, strategy
 
-    def _get_feature_importance(self, features_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _get_feature_importance(
+        self, features_dict: Dict[str, Any], xgboost_model: Optional[Any] = None
+    ) -> List[Dict[str, Any]]:
         """Get top 5 most important features"""
         # If XGBoost model available, use its feature importance
-        if self.xgboost_model and HAS_ML and hasattr(self.xgboost_model, 'feature_importances_'):
-            importances = self.xgboost_model.feature_importances_
+        if xgboost_model and HAS_ML and hasattr(xgboost_model, 'feature_importances_'):
+            importances = xgboost_model.feature_importances_
             top_indices = np.argsort(importances)[-5:][::-1]
 
             factors = []
@@ -331,78 +367,96 @@ class PaymentPredictor:
             'timestamp': datetime.utcnow().isoformat(),
         }
 
-        self.training_data.append(training_sample)
-
-        # Save updated training data
+        # Append to the outcome log; cost does not grow with the log
         try:
-            with open(TRAINING_DATA_PATH, 'w') as f:
-                json.dump(self.training_data, f, indent=2)
-            logging.info(f"Recorded payment outcome. Total samples: {len(self.training_data)}")
+            self.outcomes.append(training_sample)
+            logging.info("Recorded payment outcome")
         except Exception as e:
             logging.error(f"Error saving training data: {e}")
 
-    def train_models(self, min_samples: int = 100):
-        """Train/retrain models on collected data"""
+    def train_models(self, min_samples: int = 100, progress: Optional[Callable[..., None]] = None):
+        """Train/retrain models on collected data
+
+        `progress(stage, fraction, **metrics)` is called as the fit advances;
+        background jobs use it to report status (see training_jobs.py).
+        """
         if not HAS_ML:
             logging.error("ML libraries not available for training")
             return {'success': False, 'error': 'ML libraries not installed'}
 
-        if len(self.training_data) < min_samples:
+        if progress is None:
+            progress = lambda stage, fraction, **metrics: None
+
+        sample_count = len(self.outcomes)
+        if sample_count < min_samples:
             return {
                 'success': False,
-                'error': f'Not enough training data. Need {min_samples}, have {len(self.training_data)}'
+                'error': f'Not enough training data. Need {min_samples}, have {sample_count}'
             }
 
         try:
-            # Extract features and labels
+            # Extract features and labels, streaming records from the outcome log
+            progress('loading_data', 0.0)
             X = []
             y = []
+            sample_count = 0
 
-            for sample in self.training_data:
+            for sample in self.outcomes:
+                sample_count += 1
                 if sample['wasPaid']:  # Only train on paid invoices
                     features = self.extract_features(sample['features'])
                     X.append(features[0])
                     y.append(sample['actualDaysToPayment'])
+                if sample_count % 10000 == 0:
+                    progress('loading_data', 0.0, samplesRead=sample_count)
 
             X = np.array(X)
             y = np.array(y)
 
             # Fit scaler
-            self.scaler = StandardScaler()
-            X_scaled = self.scaler.fit_transform(X)
+            scaler = StandardScaler()
+            X_scaled = scaler.fit_transform(X)
 
             # Train XGBoost
-            self.xgboost_model = xgb.XGBRegressor(
+            progress('xgboost', 0.3, samplesRead=sample_count, paidSamples=len(y))
+            xgboost_model = xgb.XGBRegressor(
                 n_estimators=100,
                 max_depth=6,
                 learning_rate=0.1,
                 random_state=42
             )
-            self.xgboost_model.fit(X_scaled, y)
+            xgboost_model.fit(X_scaled, y)
 
             # Train Gradient Boosting
-            self.gb_model = GradientBoostingRegressor(
+            progress('gradient_boost', 0.6)
+            gb_model = GradientBoostingRegressor(
                 n_estimators=100,
                 max_depth=5,
                 learning_rate=0.1,
                 random_state=42
             )
-            self.gb_model.fit(X_scaled, y)
+            gb_model.fit(X_scaled, y)
 
             # Update metadata
-            self.metadata = {
+            metadata = {
                 'trainedAt': datetime.utcnow().isoformat(),
                 'sampleCount': len(X),
                 'paidInvoices': len(y),
-                'unpaidInvoices': len(self.training_data) - len(y),
+                'unpaidInvoices': sample_count - len(y),
                 'features': FEATURE_NAMES,
             }
 
-            # Save models
-            self.save_models()
+            # Publish as a new immutable version, then swap to it
+            progress('publishing', 0.9)
+            version = self.registry.publish({
+                'scaler': scaler,
+                'xgboost': xgboost_model,
+                'gradient_boost': gb_model,
+            }, metadata)
+            self.models = self.registry.load(version)
 
-            logging.info(f"Models trained successfully on {len(X)} samples")
-            return {'success': True, 'sampleCount': len(X)}
+            logging.info(f"Models trained successfully on {len(X)} samples (version {version})")
+            return {'success': True, 'sampleCount': len(X), 'version': version}
 
         except Exception as e:
             logging.error(f"Error training models: {e}")
@@ -412,6 +466,14 @@ class PaymentPredictor:
 # Global predictor instance
 predictor = PaymentPredictor()
 
+# Fits run in a separate process; results reach serving through the registry
+training_jobs = TrainingJobManager(TRAINING_JOBS_DIR)
+
+
+def run_training_job(progress, min_samples: int = 100) -> Dict[str, Any]:
+    """Process-pool entry point for background training jobs"""
+    return predictor.train_models(min_samples=min_samples, progress=progress)
+
 
 @app.route('/ml/predict-payment', methods=['POST'])
 def predict_payment():
@@ -445,7 +507,7 @@ def record_outcome():
 
         predictor.record_outcome(features, actual_days, was_paid)
 
-        return jsonify({'success': True, 'totalSamples': len(predictor.training_data)}), 200
+        return jsonify({'success': True, 'totalSamples': len(predictor.outcomes)}), 200
 
     except Exception as e:
         logging.error(f"Record outcome error: {e}")
@@ -454,26 +516,44 @@ def record_outcome():
 
 @app.route('/ml/train', methods=['POST'])
 def train_models():
-    """Trigger model retraining"""
+    """Start model retraining in the background and return its job id"""
     try:
-        result = predictor.train_models()
+        active = training_jobs.active_job()
+        if active:
+            return jsonify({'error': 'Training already in progress', 'jobId': active['jobId']}), 409
+
+        data = request.get_json(silent=True) or {}
+        job_id = training_jobs.submit(
+            run_training_job,
+            # Swap this worker right away; other workers follow on their next poll
+            on_complete=lambda result: predictor.refresh_models(force=True),
+            min_samples=int(data.get('minSamples', 100)),
+        )
 
-        if result['success']:
-            return jsonify(result), 200
-        else:
-            return jsonify(result), 400
+        return jsonify({'jobId': job_id, 'status': 'queued', 'statusUrl': f'/ml/train/{job_id}'}), 202
 
     except Exception as e:
         logging.error(f"Training error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/ml/train/<job_id>', methods=['GET'])
+def training_job_status(job_id):
+    """Progress, metrics and result of a training job"""
+    status = training_jobs.get(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown training job'}), 404
+    return jsonify(status), 200
+
+
 @app.route('/ml/model-info', methods=['GET'])
 def model_info():
     """Get model metadata"""
+    predictor.refresh_models()
     return jsonify({
         'metadata': predictor.metadata,
-        'trainingSamples': len(predictor.training_data),
+        'activeVersion': predictor.models.version,
+        'trainingSamples': len(predictor.outcomes),
         'modelsLoaded': {
             'scaler': predictor.scaler is not None,
             'xgboost': predictor.xgboost_model is not None,
@@ -483,6 +563,38 @@ def model_info():
     }), 200
 
 
+@app.route('/ml/model-versions', methods=['GET'])
+def model_versions():
+    """List published model versions"""
+    return jsonify({
+        'activeVersion': predictor.registry.active_version(),
+        'servingVersion': predictor.models.version,
+        'versions': predictor.registry.versions(),
+    }), 200
+
+
+@app.route('/ml/model-versions/<version>/activate', methods=['POST'])
+def activate_model_version(version):
+    """Promote a published version; serving swaps without a restart"""
+    try:
+        predictor.registry.activate(version)
+        predictor.refresh_models(force=True)
+        return jsonify({'success': True, 'activeVersion': version}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+
+@app.route('/ml/model-versions/rollback', methods=['POST'])
+def rollback_model_version():
+    """Re-activate the version published before the current one"""
+    version = predictor.registry.rollback()
+    if version is None:
+        return jsonify({'error': 'No earlier version to roll back to'}), 400
+
+    predictor.refresh_models(force=True)
+    return jsonify({'success': True, 'activeVersion': version}), 200
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -491,12 +603,11 @@ def health_check():
 
 if __name__ == '__main__':
     # Generate synthetic training data on first run
-    if len(predictor.training_data) == 0:
+    if len(predictor.outcomes) == 0:
         logging.info("Generating synthetic training data...")
         from generate_training_data import generate_synthetic_data
         synthetic_data = generate_synthetic_data(500)
-        predictor.training_data = synthetic_data
-        predictor.save_models()
+        predictor.outcomes.extend(synthetic_data)
         logging.info(f"Generated {len(synthetic_data)} synthetic training samples")
 
         # Train initial models
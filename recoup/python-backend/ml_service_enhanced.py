@@ -13,16 +13,24 @@ Improvements:
 """
 
 import os
+import copy
 import json
 import pickle
 import hashlib
+import threading
+import time
 import numpy as np
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
 
+from forest_inference import compile_model
+from model_registry import ModelRegistry, ModelSet
+from outcome_log import OutcomeLog
+from training_jobs import TrainingJobManager
+
 # ML libraries
 try:
     import xgboost as xgb
@@ -58,10 +66,49 @@ SCALER_PATH = os.path.join(MODEL_DIR, 'scaler.pkl')
 XGBOOST_PATH = os.path.join(MODEL_DIR, 'xgboost_model.pkl')
 GB_PATH = os.path.join(MODEL_DIR, 'gradient_boost_model.pkl')
 RF_PATH = os.path.join(MODEL_DIR, 'random_forest_model.pkl')
+# Pre-outcome-log training data; imported into OUTCOME_LOG_DIR on startup
 TRAINING_DATA_PATH = os.path.join(MODEL_DIR, 'training_data.json')
+OUTCOME_LOG_DIR = os.path.join(MODEL_DIR, 'outcomes')
+# Status files for background training jobs
+TRAINING_JOBS_DIR = os.path.join(MODEL_DIR, 'jobs')
 MODEL_METADATA_PATH = os.path.join(MODEL_DIR, 'model_metadata.json')
 PRETRAINED_WEIGHTS_PATH = os.path.join(MODEL_DIR, 'pretrained_base.pkl')
 
+# Versioned artifact sets for this service (see model_registry.py)
+REGISTRY_DIR = os.path.join(MODEL_DIR, 'enhanced')
+# Seconds between checks of the registry's active version pointer
+MODEL_POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', 5))
+# Seconds a prediction waits for the startup load before using the fallback
+MODEL_LOAD_TIMEOUT = float(os.environ.get('MODEL_LOAD_TIMEOUT', 30))
+
+# Tree ensemble members, served from compiled engines when available
+ENSEMBLE_MEMBERS = ('xgboost', 'gradient_boost', 'random_forest')
+# Largest batch each member's compiled engine serves; bigger batches go to
+# the native model, whose C/Cython predict wins once per-call overhead is
+# amortised. Measured with benchmark_inference.py: the engine is ~4x faster
+# on one row for XGBoost and GradientBoosting but falls behind past about
+# 24 and 64 rows; for RandomForest it is still ~2x faster at 512 rows.
+ENGINE_MAX_BATCH = {
+    'xgboost': int(os.environ.get('ENGINE_MAX_BATCH_XGBOOST', 24)),
+    'gradient_boost': int(os.environ.get('ENGINE_MAX_BATCH_GRADIENT_BOOST', 64)),
+    'random_forest': int(os.environ.get('ENGINE_MAX_BATCH_RANDOM_FOREST', 4096)),
+}
+
+# Incremental retraining (see train_models)
+TRAINING_MODES = ('auto', 'full', 'incremental')
+# New outcomes needed before an incremental update is worth running
+INCREMENTAL_MIN_SAMPLES = 50
+# Boosting rounds added to XGBoost and GradientBoosting per incremental update
+INCREMENTAL_ROUNDS = 20
+# Incremental updates allowed before a full refit, bounding ensemble growth
+MAX_INCREMENTAL_UPDATES = 10
+# Mean shift of the new outcomes' features, in standard deviations of all data seen
+FEATURE_DRIFT_THRESHOLD = 0.25
+# XGBoost MAE on the new outcomes relative to its cross-validated MAE
+ERROR_DRIFT_THRESHOLD = 1.5
+# Records converted to a feature matrix at a time while reading the outcome log
+TRAINING_READ_CHUNK = 10000
+
 os.makedirs(MODEL_DIR, exist_ok=True)
 
 # Feature names (must match TypeScript interface)
@@ -84,6 +131,7 @@ FEATURE_NAMES = [
 request_counts = defaultdict(lambda: {'count': 0, 'reset_time': time.time()})
 RATE_LIMIT = 100  # requests per minute
 RATE_WINDOW = 60  # seconds
+MAX_BATCH_SIZE = 500  # rows per /ml/predict-payment/batch request
 
 
 def rate_limit_check(client_id: str) -> bool:
@@ -122,6 +170,8 @@ def validate_features(features: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
         for feature_name in FEATURE_NAMES:
             if feature_name not in features:
                 return False, f"Missing required feature: {feature_name}"
+            if not isinstance(features[feature_name], (int, float)):
+                return False, f"{feature_name} must be numeric"
 
         # Validate numeric ranges
         if not isinstance(features.get('invoiceAmount'), (int, float)):
@@ -165,22 +215,139 @@ def validate_features(features: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
         return False, str(e)
 
 
+def update_feature_stats(stats: Optional[Dict[str, Any]], X: np.ndarray) -> Dict[str, Any]:
+    """Merge a batch into running per-feature count/mean/M2 (Chan et al. parallel update)"""
+    count_b = len(X)
+    mean_b = X.mean(axis=0)
+    m2_b = ((X - mean_b) ** 2).sum(axis=0)
+
+    if not stats or not stats.get('count'):
+        return {'count': count_b, 'mean': mean_b.tolist(), 'm2': m2_b.tolist()}
+
+    count_a = stats['count']
+    mean_a = np.asarray(stats['mean'])
+    m2_a = np.asarray(stats['m2'])
+
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return {'count': count, 'mean': mean.tolist(), 'm2': m2.tolist()}
+
+
+def feature_drift(stats: Dict[str, Any], X: np.ndarray) -> float:
+    """Average absolute mean shift of a batch, in standard deviations of the running stats"""
+    mean = np.asarray(stats['mean'])
+    std = np.sqrt(np.asarray(stats['m2']) / max(stats['count'] - 1, 1))
+    shift = np.abs(X.mean(axis=0) - mean) / np.maximum(std, 1e-9)
+    # Constant features (e.g. a flag never set so far) carry no drift signal
+    return float(np.mean(shift[std > 1e-9])) if np.any(std > 1e-9) else 0.0
+
+
 class EnhancedPaymentPredictor:
     """ML-powered payment predictor with transfer learning and security"""
 
     def __init__(self):
-        self.scaler: Optional[RobustScaler] = None
-        self.xgboost_model: Optional[Any] = None
-        self.gb_model: Optional[Any] = None
-        self.rf_model: Optional[Any] = None
-        self.metadata: Dict[str, Any] = {}
-        self.training_data: List[Dict[str, Any]] = []
+        self.registry = ModelRegistry(REGISTRY_DIR, poll_interval=MODEL_POLL_INTERVAL)
+        # Live models; replaced as a whole so requests always see one version
+        self.models = ModelSet(version=None)
+        # Recorded outcomes used for retraining
+        self.outcomes = OutcomeLog(OUTCOME_LOG_DIR)
+
+        # Models load in the background so /health answers immediately
+        self._loaded = threading.Event()
+        self._loader_lock = threading.Lock()
+        self._loader_pid: Optional[int] = None
+        self.start_loading()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    def start_loading(self):
+        """Start the background model load for this process, once
+
+        Re-started after a fork (e.g. gunicorn --preload) when the parent had
+        not finished loading, since the loader thread does not survive it.
+        """
+        with self._loader_lock:
+            if self._loaded.is_set() or self._loader_pid == os.getpid():
+                return
+            self._loader_pid = os.getpid()
+
+        threading.Thread(target=self._load_in_background, name='model-loader', daemon=True).start()
 
-        # Load models
-        self.load_models()
+    def wait_until_loaded(self, timeout: Optional[float] = None) -> bool:
+        """Block until the background load finishes; False on timeout"""
+        self.start_loading()
+        return self._loaded.wait(timeout)
 
-        # Initialize with pre-trained weights if available
-        self.load_pretrained_base()
+    def _load_in_background(self):
+        started = time.monotonic()
+        try:
+            # Load models
+            self.load_models()
+
+            # Initialize with pre-trained weights if available
+            self.load_pretrained_base()
+        finally:
+            self._loaded.set()
+            logger.info(f"Models ready in {time.monotonic() - started:.2f}s")
+
+    @property
+    def scaler(self) -> Optional[RobustScaler]:
+        return self.models.get('scaler')
+
+    @property
+    def xgboost_model(self) -> Optional[Any]:
+        return self.models.get('xgboost') if HAS_ML else None
+
+    @property
+    def gb_model(self) -> Optional[Any]:
+        return self.models.get('gradient_boost')
+
+    @property
+    def rf_model(self) -> Optional[Any]:
+        return self.models.get('random_forest')
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.models.metadata
+
+    def compile_engines(self, model_set: ModelSet) -> Dict[str, Any]:
+        """Compile ensemble members that do not have a stored engine yet"""
+        engines = dict(model_set.engines)
+        for name in ENSEMBLE_MEMBERS:
+            if name in engines or not model_set.has(name) or (name == 'xgboost' and not HAS_ML):
+                continue
+            try:
+                # Flatten tree ensembles for fast inference
+                engines[name] = compile_model(model_set.get(name))
+            except Exception as e:
+                logger.warning(f"Could not compile {name} model, using native predict: {e}")
+        return engines
+
+    def swap_models(self, model_set: ModelSet):
+        """Make a loaded version live in one assignment"""
+        # Versions published with engines are served from the memory-mapped
+        # arrays; only older ones need their pickles loaded and compiled here
+        model_set.engines = self.compile_engines(model_set)
+        self.models = model_set
+        logger.info(f"Serving model version {model_set.version}")
+
+    def refresh_models(self, force: bool = False):
+        """Pick up a newly activated registry version, if any"""
+        model_set = self.registry.poll(self.models.version, force=force)
+        if model_set is not None:
+            self.swap_models(model_set)
+
+    def _predict_member(self, models: ModelSet, name: str, features: np.ndarray) -> np.ndarray:
+        """Predict with whichever of the compiled engine and native model is faster for this batch"""
+        engine = models.engines.get(name)
+        native_faster = len(features) > ENGINE_MAX_BATCH.get(name, 0) and models.has(name)
+        if engine is not None and not native_faster:
+            return engine.predict(features)
+        return models.get(name).predict(features)
 
     def load_pretrained_base(self):
         """
@@ -196,93 +363,97 @@ class EnhancedPaymentPredictor:
         - Kaggle Give Me Some Credit
         - LendingClub Loan Data
         """
-        if os.path.exists(PRETRAINED_WEIGHTS_PATH):
+        if HAS_ML and not self.models.has('xgboost') and os.path.exists(PRETRAINED_WEIGHTS_PATH):
             try:
                 pretrained = joblib.load(PRETRAINED_WEIGHTS_PATH)
                 logger.info("Loaded pre-trained base model")
 
                 # Use as initialization for XGBoost
-                if HAS_ML and self.xgboost_model is None:
-                    self.xgboost_model = pretrained
-                    logger.info("Initialized XGBoost with pre-trained weights")
+                self.swap_models(ModelSet(
+                    version=self.models.version,
+                    artifacts=dict(self.models.artifacts, xgboost=pretrained),
+                    metadata=self.models.metadata,
+                    engines=dict(self.models.engines),
+                    paths=self.models.paths,
+                ))
+                logger.info("Initialized XGBoost with pre-trained weights")
 
             except Exception as e:
                 logger.error(f"Error loading pre-trained weights: {e}")
 
     def load_models(self):
-        """Load pre-trained models from disk"""
+        """Load the active model version from the registry"""
         try:
-            if os.path.exists(SCALER_PATH):
-                self.scaler = joblib.load(SCALER_PATH)
-                logger.info("Loaded scaler")
+            model_set = self.registry.load_active()
+            if model_set is not None:
+                self.swap_models(model_set)
+            else:
+                self.import_legacy_models()
 
-            if os.path.exists(XGBOOST_PATH) and HAS_ML:
-                self.xgboost_model = joblib.load(XGBOOST_PATH)
-                logger.info("Loaded XGBoost model")
-
-            if os.path.exists(GB_PATH):
-                self.gb_model = joblib.load(GB_PATH)
-                logger.info("Loaded Gradient Boosting model")
-
-            if os.path.exists(RF_PATH):
-                self.rf_model = joblib.load(RF_PATH)
-                logger.info("Loaded Random Forest model")
-
-            if os.path.exists(MODEL_METADATA_PATH):
-                with open(MODEL_METADATA_PATH, 'r') as f:
-                    self.metadata = json.load(f)
-                logger.info("Loaded model metadata")
-
-            if os.path.exists(TRAINING_DATA_PATH):
-                with open(TRAINING_DATA_PATH, 'r') as f:
-                    self.training_data = json.load(f)
-                logger.info(f"Loaded {len(self.training_data)} training samples")
+            # Move a pre-log training_data.json into the outcome log
+            self.outcomes.import_json(TRAINING_DATA_PATH)
 
         except Exception as e:
             logger.error(f"Error loading models: {e}")
 
-    def save_models(self):
-        """Save trained models to disk"""
-        try:
-            if self.scaler:
-                joblib.dump(self.scaler, SCALER_PATH)
-
-            if self.xgboost_model and HAS_ML:
-                joblib.dump(self.xgboost_model, XGBOOST_PATH)
+    def import_legacy_models(self) -> Optional[str]:
+        """Publish pickles from the pre-registry flat layout as the first version"""
+        legacy_paths = {
+            'scaler': SCALER_PATH,
+            'xgboost': XGBOOST_PATH,
+            'gradient_boost': GB_PATH,
+            'random_forest': RF_PATH,
+        }
+        artifacts = {
+            name: joblib.load(path)
+            for name, path in legacy_paths.items()
+            if os.path.exists(path)
+        }
+        if not artifacts:
+            return None
 
-            if self.gb_model:
-                joblib.dump(self.gb_model, GB_PATH)
+        metadata = {}
+        if os.path.exists(MODEL_METADATA_PATH):
+            with open(MODEL_METADATA_PATH, 'r') as f:
+                metadata = json.load(f)
 
-            if self.rf_model:
-                joblib.dump(self.rf_model, RF_PATH)
+        logger.info("Importing legacy models into the model registry")
+        return self.publish_models(artifacts, metadata)
 
-            with open(MODEL_METADATA_PATH, 'w') as f:
-                json.dump(self.metadata, f, indent=2)
+    def publish_models(
+        self, artifacts: Dict[str, Any], metadata: Dict[str, Any], engines: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Store a trained artifact set and its compiled engines as a new version and serve it
 
-            with open(TRAINING_DATA_PATH, 'w') as f:
-                json.dump(self.training_data, f, indent=2)
+        `engines` may carry already compiled engines for unchanged members.
+        """
+        engines = self.compile_engines(ModelSet(version=None, artifacts=artifacts, engines=engines or {}))
 
-            logger.info("Models saved successfully")
+        xgboost_model = artifacts.get('xgboost')
+        if xgboost_model is not None and hasattr(xgboost_model, 'feature_importances_'):
+            # Kept in metadata so explanations never need the pickled model
+            metadata = dict(metadata, featureImportances=[float(v) for v in xgboost_model.feature_importances_])
 
-        except Exception as e:
-            logger.error(f"Error saving models: {e}")
+        version = self.registry.publish(artifacts, metadata, engines=engines)
+        self.swap_models(self.registry.load(version))
+        return version
 
     def extract_features(self, data: Dict[str, Any]) -> np.ndarray:
         """Extract and engineer features from input data"""
-        features = []
-        for feature_name in FEATURE_NAMES:
-            value = data.get(feature_name, 0)
-            if isinstance(value, bool):
-                value = 1 if value else 0
-            features.append(float(value))
+        return self.extract_features_batch([data])
 
-        # Advanced feature engineering
-        feature_array = np.array([features])
+    def extract_features_batch(self, rows: List[Dict[str, Any]]) -> np.ndarray:
+        """Extract and engineer features for many inputs into one matrix"""
+        # Booleans become 0/1 through float()
+        feature_array = np.array(
+            [[float(row.get(name, 0)) for name in FEATURE_NAMES] for row in rows],
+            dtype=float,
+        ).reshape(len(rows), len(FEATURE_NAMES))
 
         # Add interaction features
-        invoice_amount = data.get('invoiceAmount', 0)
-        days_overdue = data.get('daysOverdue', 0)
-        client_payment_rate = data.get('clientPaymentRate', 0.8)
+        invoice_amount = feature_array[:, FEATURE_NAMES.index('invoiceAmount')]
+        days_overdue = feature_array[:, FEATURE_NAMES.index('daysOverdue')]
+        client_payment_rate = np.array([row.get('clientPaymentRate', 0.8) for row in rows], dtype=float)
 
         # Interaction: amount * overdue (large overdue invoices are riskier)
         interaction_1 = invoice_amount * days_overdue / 10000
@@ -291,11 +462,11 @@ class EnhancedPaymentPredictor:
         interaction_2 = client_payment_rate * days_overdue
 
         # Ratio features
-        avg_invoice = data.get('clientAverageInvoiceAmount', 1000)
-        invoice_ratio = invoice_amount / max(avg_invoice, 1)
+        avg_invoice = np.array([row.get('clientAverageInvoiceAmount', 1000) for row in rows], dtype=float)
+        invoice_ratio = invoice_amount / np.maximum(avg_invoice, 1)
 
         # Add engineered features
-        engineered = np.array([[interaction_1, interaction_2, invoice_ratio]])
+        engineered = np.column_stack([interaction_1, interaction_2, invoice_ratio])
 
         return np.hstack([feature_array, engineered])
 
@@ -310,15 +481,50 @@ class EnhancedPaymentPredictor:
         if not is_valid:
             raise ValueError(f"Invalid features: {error_msg}")
 
-        features = self.extract_features(features_dict)
+        return self._predict_rows([features_dict])[0]
+
+    def predict_batch(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Predict many invoices at once
+
+        Valid rows are scored together, one call per ensemble member. Invalid
+        rows get an `error` entry at their position instead of failing the batch.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(rows)
+        valid_indices = []
+        for index, row in enumerate(rows):
+            is_valid, error_msg = validate_features(row) if isinstance(row, dict) else (False, 'Row must be an object')
+            if is_valid:
+                valid_indices.append(index)
+            else:
+                results[index] = {'error': f"Invalid features: {error_msg}"}
+
+        if valid_indices:
+            predictions = self._predict_rows([rows[index] for index in valid_indices])
+            for index, prediction in zip(valid_indices, predictions):
+                results[index] = prediction
+
+        return results
+
+    def _predict_rows(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Score validated rows with a single pass of each ensemble member"""
+        features = self.extract_features_batch(rows)
+
+        if not self.wait_until_loaded(MODEL_LOAD_TIMEOUT):
+            logger.warning("Models still loading, using fallback prediction")
+            return [self._fallback_prediction(row) for row in rows]
+
+        # Snapshot the live version so a concurrent swap cannot mix models
+        self.refresh_models()
+        models = self.models
 
         # Fallback if no models
-        if not self.xgboost_model and not self.gb_model and not self.rf_model:
-            return self._fallback_prediction(features_dict)
+        if not any(models.has(name) for name in ENSEMBLE_MEMBERS):
+            return [self._fallback_prediction(row) for row in rows]
 
         # Scale features (use RobustScaler for outlier resistance)
-        if self.scaler:
-            features_scaled = self.scaler.transform(features)
+        if models.has('scaler'):
+            features_scaled = models.get('scaler').transform(features)
         else:
             features_scaled = features
 
@@ -326,66 +532,73 @@ class EnhancedPaymentPredictor:
         predictions = []
         weights = []
 
-        if self.xgboost_model and HAS_ML:
-            xgb_pred = self.xgboost_model.predict(features_scaled)[0]
-            predictions.append(xgb_pred)
+        if models.has('xgboost') and HAS_ML:
+            predictions.append(self._predict_member(models, 'xgboost', features_scaled))
             weights.append(0.5)  # XGBoost gets highest weight
 
-        if self.gb_model:
-            gb_pred = self.gb_model.predict(features_scaled)[0]
-            predictions.append(gb_pred)
+        if models.has('gradient_boost'):
+            predictions.append(self._predict_member(models, 'gradient_boost', features_scaled))
             weights.append(0.3)
 
-        if self.rf_model:
-            rf_pred = self.rf_model.predict(features_scaled)[0]
-            predictions.append(rf_pred)
+        if models.has('random_forest'):
+            predictions.append(self._predict_member(models, 'random_forest', features_scaled))
             weights.append(0.2)
 
+        # One column per ensemble member
+        predictions = np.column_stack(predictions)
+        ensemble_size = predictions.shape[1]
+
         # Weighted ensemble
-        if weights:
-            weights = np.array(weights) / sum(weights)
-            predicted_days = int(np.average(predictions, weights=weights))
-        else:
-            predicted_days = int(np.mean(predictions))
+        weights = np.array(weights) / sum(weights)
+        predicted_days = np.average(predictions, axis=1, weights=weights).astype(int)
 
         # Calculate confidence intervals (std of ensemble)
-        confidence_std = np.std(predictions) if len(predictions) > 1 else 5
-        confidence_lower = max(0, predicted_days - int(1.96 * confidence_std))
-        confidence_upper = predicted_days + int(1.96 * confidence_std)
+        if ensemble_size > 1:
+            confidence_std = np.std(predictions, axis=1)
+        else:
+            confidence_std = np.full(len(rows), 5.0)
+        margin = (1.96 * confidence_std).astype(int)
+        confidence_lower = np.maximum(0, predicted_days - margin)
+        confidence_upper = predicted_days + margin
 
         # Payment probability (inverse sigmoid)
         payment_probability = 1 / (1 + np.exp((predicted_days - 30) / 10))
 
         # Confidence score (ensemble agreement)
-        if len(predictions) > 1:
-            confidence = 1 - (confidence_std / max(predicted_days, 1))
+        if ensemble_size > 1:
+            confidence = 1 - confidence_std / np.maximum(predicted_days, 1)
         else:
-            confidence = 0.7
+            confidence = np.full(len(rows), 0.7)
 
-        confidence = max(0.0, min(1.0, confidence))
+        confidence = np.clip(confidence, 0.0, 1.0)
 
-        # Risk and strategy
-        risk_level, strategy = self._determine_risk_and_strategy(
-            predicted_days, payment_probability, features_dict
-        )
+        results = []
+        for i, features_dict in enumerate(rows):
+            days = int(predicted_days[i])
 
-        # Feature importance
-        factors = self._get_feature_importance(features_dict)
+            # Risk and strategy
+            risk_level, strategy = self._determine_risk_and_strategy(
+                days, payment_probability[i], features_dict
+            )
 
-        return {
-            'predictedDaysUntilPayment': max(0, predicted_days),
-            'confidenceInterval': {
-                'lower': confidence_lower,
-                'upper': confidence_upper,
-            },
-            'paymentProbability': float(payment_probability),
-            'confidenceScore': float(confidence),
-            'recommendedStrategy': strategy,
-            'riskLevel': risk_level,
-            'factors': factors,
-            'modelVersion': self.metadata.get('version', '1.0'),
-            'ensembleSize': len(predictions),
-        }
+            results.append({
+                'predictedDaysUntilPayment': max(0, days),
+                'confidenceInterval': {
+                    'lower': int(confidence_lower[i]),
+                    'upper': int(confidence_upper[i]),
+                },
+                'paymentProbability': float(payment_probability[i]),
+                'confidenceScore': float(confidence[i]),
+                'recommendedStrategy': strategy,
+                'riskLevel': risk_level,
+                # Feature importance
+                'factors': self._get_feature_importance(features_dict, models),
+                'modelVersion': models.metadata.get('version', '1.0'),
+                'registryVersion': models.version,
+                'ensembleSize': ensemble_size,
+            })
+
+        return results
 
     def _fallback_prediction(self, features_dict: Dict[str, Any]) -> Dict[str, Any]:
         """Rule-based fallback with domain knowledge"""
@@ -446,10 +659,18 @@ class EnhancedPaymentPredictor:
         else:
             return 'critical', 'escalate'
 
-    def _get_feature_importance(self, features_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _get_feature_importance(
+        self, features_dict: Dict[str, Any], models: Optional[ModelSet] = None
+    ) -> List[Dict[str, Any]]:
         """Get top 5 feature importances"""
-        if self.xgboost_model and HAS_ML and hasattr(self.xgboost_model, 'feature_importances_'):
-            importances = self.xgboost_model.feature_importances_
+        models = models or self.models
+        importances = models.metadata.get('featureImportances')
+        if importances is None and HAS_ML and models.has('xgboost'):
+            # Versions published before importances were stored in metadata
+            importances = getattr(models.get('xgboost'), 'feature_importances_', None)
+
+        if importances is not None:
+            importances = np.asarray(importances)
             top_indices = np.argsort(importances)[-5:][::-1]
 
             return [
@@ -484,96 +705,280 @@ class EnhancedPaymentPredictor:
             'timestamp': datetime.utcnow().isoformat(),
         }
 
-        self.training_data.append(sample)
-
         try:
-            with open(TRAINING_DATA_PATH, 'w') as f:
-                json.dump(self.training_data, f, indent=2)
-            logger.info(f"Recorded outcome. Total: {len(self.training_data)}")
+            # Single-line append; cost does not grow with the log
+            self.outcomes.append(sample)
+            logger.info("Recorded outcome")
         except Exception as e:
             logger.error(f"Error saving training data: {e}")
 
-    def train_models(self, min_samples: int = 100):
-        """Train/retrain models with cross-validation"""
+    def train_models(
+        self,
+        min_samples: int = 100,
+        progress: Optional[Callable[..., None]] = None,
+        mode: str = 'auto',
+    ):
+        """Train/retrain models
+
+        Modes:
+        - full: refit the scaler and every ensemble member on all outcomes,
+          with cross-validation
+        - incremental: continue boosting XGBoost and GradientBoosting on the
+          outcomes recorded since the active version was trained
+        - auto: incremental when the active version supports it, falling back
+          to a full refit when drift metrics cross their thresholds
+
+        `progress(stage, fraction, **metrics)` is called as the fit advances;
+        background jobs use it to report status (see training_jobs.py).
+        """
         if not HAS_ML:
             return {'success': False, 'error': 'ML libraries not available'}
 
-        if len(self.training_data) < min_samples:
+        if mode not in TRAINING_MODES:
+            return {'success': False, 'error': f'Unknown training mode: {mode}'}
+
+        if progress is None:
+            progress = lambda stage, fraction, **metrics: None
+
+        self.wait_until_loaded()
+
+        # Continue from the latest published version, not whatever this process last polled
+        self.refresh_models(force=True)
+        models = self.models
+
+        try:
+            if mode != 'full':
+                if 'trainedThrough' in models.metadata and all(models.has(name) for name in ('scaler',) + ENSEMBLE_MEMBERS):
+                    result = self._train_incremental(models, progress)
+                    if result.get('refitReason') is None:
+                        return result
+                    refit_reason = result['refitReason']
+                elif mode == 'incremental':
+                    return {'success': False, 'error': 'Active model version does not support incremental training'}
+                else:
+                    refit_reason = 'no incremental base'
+            else:
+                refit_reason = 'requested'
+
+            return self._train_full(min_samples, progress, refit_reason)
+
+        except Exception as e:
+            logger.error(f"Training error: {e}")
+            return {'success': False, 'error': str(e)}
+
+    def _read_training_data(
+        self, start: int, stop: int, progress: Callable[..., None]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Features and labels of paid outcomes at log positions [start, stop)"""
+        X_chunks, y = [], []
+        rows = []
+        read = 0
+        for sample in self.outcomes.records(start, stop):
+            read += 1
+            if sample['wasPaid']:
+                rows.append(sample['features'])
+                y.append(sample['actualDaysToPayment'])
+            if len(rows) >= TRAINING_READ_CHUNK:
+                X_chunks.append(self.extract_features_batch(rows))
+                rows = []
+                progress('loading_data', 0.0, samplesRead=read)
+
+        if rows:
+            X_chunks.append(self.extract_features_batch(rows))
+
+        X = np.vstack(X_chunks) if X_chunks else np.empty((0, len(FEATURE_NAMES) + 3))
+        return X, np.array(y, dtype=float)
+
+    def _train_full(self, min_samples: int, progress: Callable[..., None], refit_reason: str):
+        """Refit the scaler and all ensemble members on the whole outcome history"""
+        # Records appended from here on are left for the next incremental update
+        trained_through = len(self.outcomes)
+        if trained_through < min_samples:
             return {
                 'success': False,
-                'error': f'Need {min_samples} samples, have {len(self.training_data)}'
+                'error': f'Need {min_samples} samples, have {trained_through}'
             }
 
-        try:
-            # Extract features and labels
-            X, y = [], []
-            for sample in self.training_data:
-                if sample['wasPaid']:
-                    features = self.extract_features(sample['features'])
-                    X.append(features[0])
-                    y.append(sample['actualDaysToPayment'])
-
-            X = np.array(X)
-            y = np.array(y)
-
-            # Use RobustScaler (resistant to outliers)
-            self.scaler = RobustScaler()
-            X_scaled = self.scaler.fit_transform(X)
-
-            # Train XGBoost with regularization
-            self.xgboost_model = xgb.XGBRegressor(
-                n_estimators=150,
-                max_depth=6,
-                learning_rate=0.05,
-                subsample=0.8,
-                colsample_bytree=0.8,
-                reg_alpha=0.1,  # L1 regularization
-                reg_lambda=1.0,  # L2 regularization
-                random_state=42
-            )
+        # Extract features and labels, streaming records from the outcome log
+        progress('loading_data', 0.0, mode='full', refitReason=refit_reason)
+        X, y = self._read_training_data(0, trained_through, progress)
+        progress('cross_validation', 0.2, samplesRead=trained_through, paidSamples=len(y))
+
+        # Use RobustScaler (resistant to outliers)
+        scaler = RobustScaler()
+        X_scaled = scaler.fit_transform(X)
+
+        # Train XGBoost with regularization
+        xgboost_model = xgb.XGBRegressor(
+            n_estimators=150,
+            max_depth=6,
+            learning_rate=0.05,
+            subsample=0.8,
+            colsample_bytree=0.8,
+            reg_alpha=0.1,  # L1 regularization
+            reg_lambda=1.0,  # L2 regularization
+            random_state=42
+        )
 
-            # Cross-validation
-            cv_scores = cross_val_score(self.xgboost_model, X_scaled, y, cv=5,
-                                       scoring='neg_mean_absolute_error')
+        # Cross-validation
+        cv_scores = cross_val_score(xgboost_model, X_scaled, y, cv=5,
+                                   scoring='neg_mean_absolute_error')
 
-            self.xgboost_model.fit(X_scaled, y)
+        progress('xgboost', 0.5, cvMAE=float(-np.mean(cv_scores)), cvStd=float(np.std(cv_scores)))
+        xgboost_model.fit(X_scaled, y)
 
-            # Train ensemble models
-            self.gb_model = GradientBoostingRegressor(
-                n_estimators=100, max_depth=5, learning_rate=0.1, random_state=42
-            )
-            self.gb_model.fit(X_scaled, y)
+        # Train ensemble models
+        progress('gradient_boost', 0.6)
+        gb_model = GradientBoostingRegressor(
+            n_estimators=100, max_depth=5, learning_rate=0.1, random_state=42
+        )
+        gb_model.fit(X_scaled, y)
 
-            self.rf_model = RandomForestRegressor(
-                n_estimators=100, max_depth=10, random_state=42
-            )
-            self.rf_model.fit(X_scaled, y)
-
-            # Metadata
-            self.metadata = {
-                'trainedAt': datetime.utcnow().isoformat(),
-                'sampleCount': len(X),
-                'paidInvoices': len(y),
-                'unpaidInvoices': len(self.training_data) - len(y),
-                'features': FEATURE_NAMES,
-                'version': '2.0',
-                'cvMAE': -np.mean(cv_scores),
-                'cvStd': np.std(cv_scores),
-            }
+        progress('random_forest', 0.75)
+        rf_model = RandomForestRegressor(
+            n_estimators=100, max_depth=10, random_state=42
+        )
+        rf_model.fit(X_scaled, y)
+
+        # Metadata
+        metadata = {
+            'trainedAt': datetime.utcnow().isoformat(),
+            'sampleCount': len(X),
+            'paidInvoices': len(y),
+            'unpaidInvoices': trained_through - len(y),
+            'features': FEATURE_NAMES,
+            'version': '2.0',
+            'cvMAE': float(-np.mean(cv_scores)),
+            'cvStd': float(np.std(cv_scores)),
+            # Incremental training state
+            'trainingMode': 'full',
+            'refitReason': refit_reason,
+            'trainedThrough': trained_through,
+            'incrementalUpdates': 0,
+            'featureStats': update_feature_stats(None, X),
+        }
 
-            self.save_models()
+        # Publish as a new immutable version; serving swaps to it atomically
+        progress('publishing', 0.9)
+        version = self.publish_models({
+            'scaler': scaler,
+            'xgboost': xgboost_model,
+            'gradient_boost': gb_model,
+            'random_forest': rf_model,
+        }, metadata)
 
-            logger.info(f"Models trained on {len(X)} samples. CV MAE: {-np.mean(cv_scores):.2f}")
-            return {'success': True, 'sampleCount': len(X), 'cvMAE': -np.mean(cv_scores)}
+        logger.info(f"Models trained on {len(X)} samples. CV MAE: {-np.mean(cv_scores):.2f}")
+        return {
+            'success': True,
+            'mode': 'full',
+            'refitReason': refit_reason,
+            'sampleCount': len(X),
+            'cvMAE': -np.mean(cv_scores),
+            'version': version,
+        }
 
-        except Exception as e:
-            logger.error(f"Training error: {e}")
-            return {'success': False, 'error': str(e)}
+    def _train_incremental(self, models: ModelSet, progress: Callable[..., None]):
+        """Continue boosting on the outcomes recorded since `models` was trained
+
+        Returns a result with `refitReason` set when drift or accumulated
+        updates call for a full refit instead; nothing is published then.
+        """
+        metadata = models.metadata
+        start = metadata['trainedThrough']
+        trained_through = len(self.outcomes)
+        if trained_through - start < INCREMENTAL_MIN_SAMPLES:
+            return {
+                'success': False,
+                'error': f'Need {INCREMENTAL_MIN_SAMPLES} new samples, have {trained_through - start}'
+            }
+
+        updates = metadata.get('incrementalUpdates', 0)
+        if updates >= MAX_INCREMENTAL_UPDATES:
+            return {'refitReason': f'{updates} incremental updates since last full refit'}
+
+        progress('loading_data', 0.0, mode='incremental', newSamples=trained_through - start)
+        X, y = self._read_training_data(start, trained_through, progress)
+        if len(y) == 0:
+            return {'success': False, 'error': 'No paid outcomes since last training'}
+
+        # Drift: score the new outcomes before the models have seen them
+        progress('drift_check', 0.2)
+        scaler = models.get('scaler')
+        X_scaled = scaler.transform(X)
+        previous_xgb = models.get('xgboost')
+        holdout_mae = float(np.mean(np.abs(previous_xgb.predict(X_scaled) - y)))
+        drift = {
+            'featureDrift': feature_drift(metadata['featureStats'], X),
+            'errorRatio': holdout_mae / max(metadata.get('cvMAE', holdout_mae), 1e-9),
+        }
+        progress('drift_check', 0.3, holdoutMAE=holdout_mae, **drift)
+
+        if drift['featureDrift'] > FEATURE_DRIFT_THRESHOLD:
+            return {'refitReason': f"feature drift {drift['featureDrift']:.2f}"}
+        if drift['errorRatio'] > ERROR_DRIFT_THRESHOLD:
+            return {'refitReason': f"error ratio {drift['errorRatio']:.2f}"}
+
+        # The scaler keeps the transform the existing trees were split on;
+        # its running statistics are refreshed from the new outcomes and
+        # a full refit refits the scaler itself
+        progress('xgboost', 0.4)
+        xgboost_model = xgb.XGBRegressor(**dict(previous_xgb.get_params(), n_estimators=INCREMENTAL_ROUNDS))
+        xgboost_model.fit(X_scaled, y, xgb_model=previous_xgb.get_booster())
+
+        progress('gradient_boost', 0.6)
+        # Copied: the loaded model may be the one this process is serving
+        gb_model = copy.deepcopy(models.get('gradient_boost'))
+        gb_model.set_params(warm_start=True, n_estimators=gb_model.n_estimators + INCREMENTAL_ROUNDS)
+        gb_model.fit(X_scaled, y)
+
+        metadata = dict(
+            {key: value for key, value in metadata.items() if key not in ('registryVersion', 'artifacts', 'engines')},
+            trainedAt=datetime.utcnow().isoformat(),
+            sampleCount=metadata.get('sampleCount', 0) + len(X),
+            paidInvoices=metadata.get('paidInvoices', 0) + len(y),
+            unpaidInvoices=metadata.get('unpaidInvoices', 0) + (trained_through - start - len(y)),
+            trainingMode='incremental',
+            refitReason=None,
+            trainedThrough=trained_through,
+            incrementalUpdates=updates + 1,
+            featureStats=update_feature_stats(metadata['featureStats'], X),
+            holdoutMAE=holdout_mae,
+            drift=drift,
+        )
+
+        # RandomForest is refreshed by full refits only; reuse its compiled engine
+        progress('publishing', 0.9)
+        reused = {name: models.engines[name] for name in ('random_forest',) if name in models.engines}
+        version = self.publish_models({
+            'scaler': scaler,
+            'xgboost': xgboost_model,
+            'gradient_boost': gb_model,
+            'random_forest': models.get('random_forest'),
+        }, metadata, engines=reused)
+
+        logger.info(f"Models updated incrementally on {len(X)} new samples. Holdout MAE: {holdout_mae:.2f}")
+        return {
+            'success': True,
+            'mode': 'incremental',
+            'refitReason': None,
+            'sampleCount': len(X),
+            'holdoutMAE': holdout_mae,
+            'drift': drift,
+            'version': version,
+        }
 
 
 # Global predictor
 predictor = EnhancedPaymentPredictor()
 
+# Fits run in a separate process; results reach serving through the registry
+training_jobs = TrainingJobManager(TRAINING_JOBS_DIR)
+
+
+def run_training_job(progress, min_samples: int = 100, mode: str = 'auto') -> Dict[str, Any]:
+    """Process-pool entry point for background training jobs"""
+    return predictor.train_models(min_samples=min_samples, progress=progress, mode=mode)
+
 
 @app.route('/ml/predict-payment', methods=['POST'])
 def predict_payment():
@@ -599,6 +1004,35 @@ def predict_payment():
         return jsonify({'error': 'Internal server error'}), 500
 
 
+@app.route('/ml/predict-payment/batch', methods=['POST'])
+def predict_payment_batch():
+    """Predict payment time for many invoices in one request"""
+    try:
+        # Rate limiting (a batch counts as one request)
+        client_id = request.remote_addr or 'unknown'
+        if not rate_limit_check(client_id):
+            return jsonify({'error': 'Rate limit exceeded'}), 429
+
+        data = request.get_json()
+        rows = data.get('invoices') if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not rows:
+            return jsonify({'error': 'Expected a non-empty list of feature objects'}), 400
+
+        if len(rows) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Batch too large (max {MAX_BATCH_SIZE})'}), 400
+
+        predictions = predictor.predict_batch(rows)
+        return jsonify({
+            'predictions': predictions,
+            'count': len(predictions),
+            'errors': sum(1 for prediction in predictions if 'error' in prediction),
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Batch prediction error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 @app.route('/ml/record-outcome', methods=['POST'])
 def record_outcome():
     """Record outcome for learning"""
@@ -613,7 +1047,7 @@ def record_outcome():
             data.get('wasPaid', False)
         )
 
-        return jsonify({'success': True, 'totalSamples': len(predictor.training_data)}), 200
+        return jsonify({'success': True, 'totalSamples': len(predictor.outcomes)}), 200
 
     except Exception as e:
         logger.error(f"Record error: {e}")
@@ -622,31 +1056,89 @@ def record_outcome():
 
 @app.route('/ml/train', methods=['POST'])
 def train_models():
-    """Trigger retraining"""
+    """Start retraining in the background and return its job id"""
     try:
-        result = predictor.train_models()
-        return jsonify(result), 200 if result['success'] else 400
+        active = training_jobs.active_job()
+        if active:
+            return jsonify({'error': 'Training already in progress', 'jobId': active['jobId']}), 409
+
+        data = request.get_json(silent=True) or {}
+        mode = data.get('mode', 'auto')
+        if mode not in TRAINING_MODES:
+            return jsonify({'error': f"mode must be one of {', '.join(TRAINING_MODES)}"}), 400
+
+        job_id = training_jobs.submit(
+            run_training_job,
+            # Swap this worker right away; other workers follow on their next poll
+            on_complete=lambda result: predictor.refresh_models(force=True),
+            min_samples=int(data.get('minSamples', 100)),
+            mode=mode,
+        )
+        return jsonify({'jobId': job_id, 'status': 'queued', 'statusUrl': f'/ml/train/{job_id}'}), 202
     except Exception as e:
         logger.error(f"Training error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/ml/train/<job_id>', methods=['GET'])
+def training_job_status(job_id):
+    """Progress, metrics and result of a training job"""
+    status = training_jobs.get(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown training job'}), 404
+    return jsonify(status), 200
+
+
 @app.route('/ml/model-info', methods=['GET'])
 def model_info():
     """Get model metadata"""
+    predictor.refresh_models()
     return jsonify({
         'metadata': predictor.metadata,
-        'trainingSamples': len(predictor.training_data),
+        'activeVersion': predictor.models.version,
+        'trainingSamples': len(predictor.outcomes),
         'modelsLoaded': {
-            'scaler': predictor.scaler is not None,
-            'xgboost': predictor.xgboost_model is not None,
-            'gradientBoosting': predictor.gb_model is not None,
-            'randomForest': predictor.rf_model is not None,
+            'scaler': predictor.models.has('scaler'),
+            'xgboost': HAS_ML and predictor.models.has('xgboost'),
+            'gradientBoosting': predictor.models.has('gradient_boost'),
+            'randomForest': predictor.models.has('random_forest'),
         },
         'hasMLLibraries': HAS_ML,
     }), 200
 
 
+@app.route('/ml/model-versions', methods=['GET'])
+def model_versions():
+    """List published model versions"""
+    return jsonify({
+        'activeVersion': predictor.registry.active_version(),
+        'servingVersion': predictor.models.version,
+        'versions': predictor.registry.versions(),
+    }), 200
+
+
+@app.route('/ml/model-versions/<version>/activate', methods=['POST'])
+def activate_model_version(version):
+    """Promote a published version; serving swaps without a restart"""
+    try:
+        predictor.registry.activate(version)
+        predictor.refresh_models(force=True)
+        return jsonify({'success': True, 'activeVersion': version}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+
+@app.route('/ml/model-versions/rollback', methods=['POST'])
+def rollback_model_version():
+    """Re-activate the version published before the current one"""
+    version = predictor.registry.rollback()
+    if version is None:
+        return jsonify({'error': 'No earlier version to roll back to'}), 400
+
+    predictor.refresh_models(force=True)
+    return jsonify({'success': True, 'activeVersion': version}), 200
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check"""
@@ -654,18 +1146,19 @@ def health_check():
         'status': 'healthy',
         'service': 'enhanced-ml-payment-predictor',
         'version': '2.0',
-        'models': predictor.metadata.get('version', 'not-trained'),
+        'models': predictor.metadata.get('version', 'not-trained') if predictor.is_loaded else 'loading',
+        'modelsLoaded': predictor.is_loaded,
     }), 200
 
 
 if __name__ == '__main__':
     # Generate synthetic data if needed
-    if len(predictor.training_data) == 0:
+    predictor.wait_until_loaded()
+    if len(predictor.outcomes) == 0:
         logger.info("Generating synthetic training data...")
         from generate_training_data import generate_synthetic_data
         synthetic_data = generate_synthetic_data(1000)
-        predictor.training_data = synthetic_data
-        predictor.save_models()
+        predictor.outcomes.extend(synthetic_data)
         predictor.train_models(min_samples=100)
 
     app.run(host='0.0.0.0', port=5001, debug=False)
@@ -0,0 +1,216 @@
+"""
+Versioned Model Registry
+
+Stores each trained artifact set (scaler, ensemble members, metadata) in its
+own immutable version directory and tracks which one is live through an
+"active version" pointer file. Serving processes poll the pointer and swap
+to a new version between requests, so retraining, promotion and rollback
+never require a restart.
+
+**Layout:**
+```
+<registry root>/
+├── ACTIVE                             # id of the live version
+└── versions/
+    ├── 20250114T093000123456-1a2b3c/  # immutable once published
+    │   ├── scaler.pkl
+    │   ├── xgboost.pkl
+    │   ├── engines/xgboost/*.npy      # compiled forest, memory-mapped
+    │   └── metadata.json
+    └── ...
+```
+
+Both version directories and the pointer are written to a temporary path and
+renamed into place, so readers never observe a partially written version.
+
+Loading a version memory-maps its compiled engines and defers unpickling the
+native artifacts until something asks for them, so serving straight from the
+engines keeps worker startup fast and shares model memory across processes.
+"""
+
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import logging
+
+import joblib
+
+from forest_inference import CompiledForest
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_POINTER = 'ACTIVE'
+VERSIONS_DIR = 'versions'
+ENGINES_DIR = 'engines'
+METADATA_FILE = 'metadata.json'
+
+
+@dataclass
+class ModelSet:
+    """One loaded, immutable version of the serving models"""
+    version: Optional[str]
+    artifacts: Dict[str, Any] = field(default_factory=dict)
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    # Objects derived from the artifacts (e.g. compiled forests)
+    engines: Dict[str, Any] = field(default_factory=dict)
+    # Pickles not loaded yet; get() unpickles them on first use
+    paths: Dict[str, str] = field(default_factory=dict)
+
+    def has(self, name: str) -> bool:
+        """Whether the artifact exists, without loading it"""
+        return name in self.artifacts or name in self.paths
+
+    def get(self, name: str) -> Any:
+        if name not in self.artifacts and name in self.paths:
+            # A concurrent first access may load twice; both results are identical
+            self.artifacts[name] = joblib.load(self.paths[name])
+        return self.artifacts.get(name)
+
+
+class ModelRegistry:
+    """Immutable model versions plus an atomically swapped active pointer"""
+
+    def __init__(self, root: str, poll_interval: float = 5.0):
+        self.root = root
+        self.versions_dir = os.path.join(root, VERSIONS_DIR)
+        self.pointer_path = os.path.join(root, ACTIVE_POINTER)
+        self.poll_interval = poll_interval
+        self._last_poll = 0.0
+        self._load_lock = threading.Lock()
+        os.makedirs(self.versions_dir, exist_ok=True)
+
+    def publish(
+        self,
+        artifacts: Dict[str, Any],
+        metadata: Dict[str, Any],
+        activate: bool = True,
+        engines: Optional[Dict[str, CompiledForest]] = None,
+    ) -> str:
+        """Write an artifact set (plus any compiled engines) as a new version"""
+        version = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:6]}"
+        staging = os.path.join(self.versions_dir, f'.staging-{version}')
+        os.makedirs(staging)
+
+        try:
+            stored = {}
+            for name, artifact in artifacts.items():
+                if artifact is None:
+                    continue
+                joblib.dump(artifact, os.path.join(staging, f'{name}.pkl'))
+                stored[name] = f'{name}.pkl'
+
+            stored_engines = {}
+            for name, engine in (engines or {}).items():
+                engine.save(os.path.join(staging, ENGINES_DIR, name))
+                stored_engines[name] = os.path.join(ENGINES_DIR, name)
+
+            manifest = dict(metadata, registryVersion=version, artifacts=stored, engines=stored_engines)
+            with open(os.path.join(staging, METADATA_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2, default=str)
+
+            os.rename(staging, self.version_path(version))
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        logger.info(f"Published model version {version}")
+        if activate:
+            self.activate(version)
+        return version
+
+    def activate(self, version: str):
+        """Atomically point serving processes at an existing version"""
+        if not os.path.isdir(self.version_path(version)):
+            raise ValueError(f"Unknown model version: {version}")
+
+        tmp_path = f'{self.pointer_path}.{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, self.pointer_path)
+        logger.info(f"Activated model version {version}")
+
+    def rollback(self) -> Optional[str]:
+        """Re-activate the version published before the current one"""
+        versions = self.versions()
+        current = self.active_version()
+        if current not in versions:
+            return None
+
+        index = versions.index(current)
+        if index == 0:
+            return None
+
+        previous = versions[index - 1]
+        self.activate(previous)
+        return previous
+
+    def active_version(self) -> Optional[str]:
+        try:
+            with open(self.pointer_path, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self) -> List[str]:
+        """Published versions, oldest first"""
+        return sorted(
+            name for name in os.listdir(self.versions_dir)
+            if not name.startswith('.') and os.path.isdir(self.version_path(name))
+        )
+
+    def version_path(self, version: str) -> str:
+        return os.path.join(self.versions_dir, version)
+
+    def read_metadata(self, version: str) -> Dict[str, Any]:
+        with open(os.path.join(self.version_path(version), METADATA_FILE), 'r') as f:
+            return json.load(f)
+
+    def load(self, version: str) -> ModelSet:
+        """Memory-map a version's engines; artifacts are unpickled lazily"""
+        path = self.version_path(version)
+        metadata = self.read_metadata(version)
+        engines = {
+            name: CompiledForest.load(os.path.join(path, engine_dir))
+            for name, engine_dir in metadata.get('engines', {}).items()
+        }
+        paths = {
+            name: os.path.join(path, filename)
+            for name, filename in metadata.get('artifacts', {}).items()
+        }
+        return ModelSet(version=version, metadata=metadata, engines=engines, paths=paths)
+
+    def load_active(self) -> Optional[ModelSet]:
+        version = self.active_version()
+        return self.load(version) if version else None
+
+    def poll(self, current_version: Optional[str], force: bool = False) -> Optional[ModelSet]:
+        """Return the newly active ModelSet if the pointer moved, else None
+
+        Cheap enough to call on every request: the pointer file is read at
+        most once per poll_interval, and only one thread loads a new version
+        while the others keep serving the current one.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_poll < self.poll_interval:
+            return None
+        self._last_poll = now
+
+        version = self.active_version()
+        if not version or version == current_version:
+            return None
+
+        if not self._load_lock.acquire(blocking=False):
+            return None
+        try:
+            return self.load(version)
+        except Exception as e:
+            logger.error(f"Failed to load model version {version}: {e}")
+            return None
+        finally:
+            self._load_lock.release()
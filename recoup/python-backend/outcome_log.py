@@ -0,0 +1,356 @@
+"""
+Append-Only Outcome Log
+
+Stores recorded payment outcomes as newline-delimited JSON segments instead
+of one JSON array that is rewritten on every call. Recording an outcome
+appends a single line, so its cost does not depend on how much data has
+already been collected. Training streams the records back segment by
+segment, so the full dataset never has to sit in memory as Python dicts.
+
+**Layout:**
+```
+models/outcomes/
+├── CURRENT                                # sequence number of the active segment
+├── COUNT                                  # running record count (see below)
+├── segment-00000001-00000008.ndjson.gz    # compacted, sealed segments 1-8
+├── segment-00000009.ndjson                # sealed
+└── segment-00000010.ndjson                # active, appended to
+```
+
+**Compaction:**
+When a segment reaches `segment_max_bytes`, the writer moves to a new one.
+Once `compact_min_segments` sealed plain segments exist, a background thread
+merges them into one gzip segment. It writes the result to a temporary file
+and renames it into place before deleting the inputs. If a crash leaves an
+input behind, it is skipped because a compacted range already covers it.
+
+Writers in different processes (e.g. gunicorn workers) coordinate through an
+advisory file lock, so appends and segment rotation stay consistent.
+
+**Counting:**
+Each append also rewrites `COUNT` under the lock: the active segment's
+sequence, its size after the append, and the records up to that offset.
+`len(log)` adds any lines past the offset (only present if a writer died
+between appending and updating `COUNT`) instead of reading the segments.
+It falls back to counting every segment if `COUNT` is missing or names an
+older segment, e.g. for a log written before `COUNT` existed.
+"""
+
+import fcntl
+import gzip
+import json
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+CURRENT_POINTER = 'CURRENT'
+COUNT_FILE = 'COUNT'
+LOCK_FILE = '.lock'
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})(?:-(\d{8}))?\.ndjson(\.gz)?$')
+
+
+class OutcomeLog:
+    """Segmented NDJSON log of outcome records with background compaction"""
+
+    def __init__(self, root: str, segment_max_bytes: int = 4 * 1024 * 1024, compact_min_segments: int = 8):
+        self.root = root
+        self.segment_max_bytes = segment_max_bytes
+        self.compact_min_segments = compact_min_segments
+        self._lock = threading.Lock()
+        self._compacting = threading.Lock()
+        self._active: Optional[Tuple[int, Any]] = None  # (sequence, open file)
+        # Record counts of sealed segments, which never change once written
+        self._sealed_counts: Dict[str, int] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, record: Dict[str, Any]):
+        """Append one record; constant time regardless of log size"""
+        self.extend([record])
+
+    def extend(self, records: Iterable[Dict[str, Any]]):
+        """Append records in order under a single lock"""
+        lines = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n' for record in records)
+        if not lines:
+            return
+
+        rotated = False
+        with self._locked():
+            handle = self._active_handle()
+            total = len(self) + lines.count('\n')
+            handle.write(lines)
+            handle.flush()
+            size = os.fstat(handle.fileno()).st_size
+            self._write_count(self._active[0], size, total)
+            if size >= self.segment_max_bytes:
+                sequence = self._rotate()
+                self._write_count(sequence, 0, total)
+                rotated = True
+
+        if rotated:
+            self.maybe_compact()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Stream every record, oldest first"""
+        return self.records()
+
+    def records(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Stream the records at positions [start, stop), oldest first
+
+        Positions are line numbers across the whole log, so `len(log)` taken
+        now is a cursor for reading only what is appended later. Sealed
+        segments before `start` are skipped by their line counts without
+        being parsed.
+        """
+        handles = self._open_segments()
+        try:
+            position = 0
+            current = self._current_sequence()
+            for path, handle in handles:
+                if stop is not None and position >= stop:
+                    break
+
+                count = self._sealed_counts.get(path) if self._is_sealed(path, current) else None
+                if count is not None and position + count <= start:
+                    position += count
+                    continue
+
+                lines = 0
+                for line in handle:
+                    if stop is not None and position >= stop:
+                        break
+                    lines += 1
+                    position += 1
+                    if position > start:
+                        record = self._parse_record(path, line)
+                        if record is not None:
+                            yield record
+                else:
+                    if self._is_sealed(path, current):
+                        self._sealed_counts[path] = lines
+        finally:
+            for _, handle in handles:
+                handle.close()
+
+    def __len__(self) -> int:
+        count = self._running_count()
+        if count is not None:
+            return count
+        while True:
+            try:
+                return self._count()
+            except FileNotFoundError:
+                # A segment was compacted away while counting; recount from the new listing
+                continue
+
+    def _running_count(self) -> Optional[int]:
+        """Record count from `COUNT`, or None if it cannot be trusted"""
+        try:
+            with open(os.path.join(self.root, COUNT_FILE), 'r') as f:
+                sequence, offset, count = (int(value) for value in f.read().split())
+        except (FileNotFoundError, ValueError):
+            return None
+        if sequence != self._current_sequence():
+            # Rotated since, without COUNT following (a crash mid-rotation)
+            return None
+        try:
+            return count + self._count_lines(self._segment_path(sequence), offset)
+        except FileNotFoundError:
+            return count if offset == 0 else None
+
+    def _count(self) -> int:
+        total = 0
+        current = self._current_sequence()
+        for path in self.segments():
+            if not self._is_sealed(path, current):
+                # The active segment is bounded by segment_max_bytes
+                total += self._count_lines(path)
+                continue
+            if path not in self._sealed_counts:
+                self._sealed_counts[path] = self._count_lines(path)
+            total += self._sealed_counts[path]
+        return total
+
+    def segments(self) -> List[str]:
+        """Segment paths in record order, skipping inputs already covered by a compaction"""
+        plain, compacted = {}, []
+        for name in os.listdir(self.root):
+            match = SEGMENT_PATTERN.match(name)
+            if not match:
+                continue
+            first = int(match.group(1))
+            if match.group(2):
+                compacted.append((first, int(match.group(2)), name))
+            else:
+                plain[first] = name
+
+        ordered = [(first, name) for first, _, name in compacted]
+        for seq, name in plain.items():
+            if not any(first <= seq <= last for first, last, _ in compacted):
+                ordered.append((seq, name))
+
+        return [os.path.join(self.root, name) for _, name in sorted(ordered)]
+
+    def import_json(self, path: str) -> int:
+        """Move records from a legacy JSON array file into the log, once"""
+        with self._locked():
+            if not os.path.exists(path):
+                return 0
+            with open(path, 'r') as f:
+                records = json.load(f)
+            # Renamed before appending so a concurrent importer cannot pick it up twice
+            os.replace(path, f'{path}.imported')
+
+        self.extend(records)
+        logger.info(f"Imported {len(records)} outcomes from {path}")
+        return len(records)
+
+    def maybe_compact(self):
+        """Compact in the background once enough sealed segments have piled up"""
+        if len(self._sealed_plain_segments()) < self.compact_min_segments:
+            return
+        if self._compacting.locked():
+            return
+        threading.Thread(target=self.compact, name='outcome-log-compaction', daemon=True).start()
+
+    def compact(self) -> Optional[str]:
+        """Merge sealed plain segments into a single gzip segment"""
+        if not self._compacting.acquire(blocking=False):
+            return None
+        try:
+            inputs = self._sealed_plain_segments()
+            if len(inputs) < 2:
+                return None
+
+            first, last = inputs[0][0], inputs[-1][0]
+            target = os.path.join(self.root, f'segment-{first:08d}-{last:08d}.ndjson.gz')
+            staging = f'{target}.tmp-{uuid.uuid4().hex}'
+
+            # Sealed segments are immutable, so the merge runs without the writer lock
+            try:
+                with gzip.open(staging, 'wt') as out:
+                    for _, path in inputs:
+                        with open(path, 'r') as f:
+                            for line in f:
+                                out.write(line)
+            except FileNotFoundError:
+                # Another writer compacted these segments first
+                os.remove(staging)
+                return None
+
+            with self._locked():
+                if not all(os.path.exists(path) for _, path in inputs):
+                    # Another process compacted these segments first
+                    os.remove(staging)
+                    return None
+                os.rename(staging, target)
+                for _, path in inputs:
+                    os.remove(path)
+                    self._sealed_counts.pop(path, None)
+
+            logger.info(f"Compacted {len(inputs)} outcome segments into {os.path.basename(target)}")
+            return target
+
+        except Exception as e:
+            logger.error(f"Outcome log compaction failed: {e}")
+            return None
+        finally:
+            self._compacting.release()
+
+    def _is_sealed(self, path: str, current: int) -> bool:
+        """Whether a segment can no longer be appended to"""
+        match = SEGMENT_PATTERN.match(os.path.basename(path))
+        return bool(match.group(2)) or int(match.group(1)) < current
+
+    def _sealed_plain_segments(self) -> List[Tuple[int, str]]:
+        current = self._current_sequence()
+        sealed = []
+        for path in self.segments():
+            match = SEGMENT_PATTERN.match(os.path.basename(path))
+            if not match.group(2) and int(match.group(1)) < current:
+                sealed.append((int(match.group(1)), path))
+        return sealed
+
+    @contextmanager
+    def _locked(self):
+        """Serialize writers within this process and across processes"""
+        with self._lock:
+            with open(os.path.join(self.root, LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _current_sequence(self) -> int:
+        try:
+            with open(os.path.join(self.root, CURRENT_POINTER), 'r') as f:
+                return int(f.read().strip() or 1)
+        except FileNotFoundError:
+            return 1
+
+    def _segment_path(self, sequence: int) -> str:
+        return os.path.join(self.root, f'segment-{sequence:08d}.ndjson')
+
+    def _active_handle(self):
+        """Open file for the active segment, following rotations by other processes"""
+        sequence = self._current_sequence()
+        if self._active is None or self._active[0] != sequence:
+            if self._active is not None:
+                self._active[1].close()
+            self._active = (sequence, open(self._segment_path(sequence), 'a'))
+        return self._active[1]
+
+    def _rotate(self) -> int:
+        """Seal the active segment and start the next one (caller holds the lock)"""
+        sequence = self._current_sequence() + 1
+        self._replace_file(CURRENT_POINTER, str(sequence))
+        return sequence
+
+    def _write_count(self, sequence: int, offset: int, count: int):
+        """Record that segment `sequence` holds `count` records in total by `offset` (caller holds the lock)"""
+        self._replace_file(COUNT_FILE, f'{sequence} {offset} {count}')
+
+    def _replace_file(self, name: str, content: str):
+        tmp_path = os.path.join(self.root, f'{name}.{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, os.path.join(self.root, name))
+
+    def _open_segments(self) -> List[Tuple[str, Any]]:
+        """Open every segment up front; open files stay readable if compaction deletes them"""
+        while True:
+            handles = []
+            try:
+                for path in self.segments():
+                    opener = gzip.open if path.endswith('.gz') else open
+                    handles.append((path, opener(path, 'rt')))
+                return handles
+            except FileNotFoundError:
+                # Compacted between listing and opening; retry with the new listing
+                for _, handle in handles:
+                    handle.close()
+
+    def _parse_record(self, path: str, line: str) -> Optional[Dict[str, Any]]:
+        if not line.strip():
+            return None
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            # A torn final line from a crash mid-append
+            logger.warning(f"Skipping unreadable outcome record in {path}")
+            return None
+
+    def _count_lines(self, path: str, offset: int = 0) -> int:
+        opener = gzip.open if path.endswith('.gz') else open
+        count = 0
+        with opener(path, 'rb') as f:
+            f.seek(offset)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                count += block.count(b'\n')
+        return count
@@ -0,0 +1,85 @@
+# tests/test_forest_inference.py
+"""
+Compiled ensembles predict exactly what the native models they came from do
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ensemble = pytest.importorskip("sklearn.ensemble")
+xgb = pytest.importorskip("xgboost")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from forest_inference import CompiledForest, compile_model
+
+N_FEATURES = 28  # 25 base + 3 engineered features, as in ml_service_enhanced
+
+MODELS = {
+    'random_forest': lambda: ensemble.RandomForestRegressor(n_estimators=20, max_depth=8, random_state=0),
+    'random_forest_classifier': lambda: ensemble.RandomForestClassifier(
+        n_estimators=20, max_depth=8, min_samples_split=5, random_state=0),
+    'gradient_boost': lambda: ensemble.GradientBoostingRegressor(
+        n_estimators=30, max_depth=4, learning_rate=0.1, random_state=0),
+    'xgboost': lambda: xgb.XGBRegressor(n_estimators=30, max_depth=5, learning_rate=0.1, random_state=0),
+    'xgboost_classifier': lambda: xgb.XGBClassifier(n_estimators=30, max_depth=5, random_state=0),
+}
+
+
+def training_data(n_samples=500, seed=42):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_samples, N_FEATURES))
+    y = 30 + 8 * X[:, 0] - 5 * X[:, 1] + 3 * X[:, 2] * X[:, 3] + rng.normal(scale=4, size=n_samples)
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def X_eval():
+    X = np.random.default_rng(7).normal(size=(300, N_FEATURES))
+    # Rows sitting exactly on split thresholds exercise the <= vs < handling
+    X[:20] = training_data()[0][:20]
+    return X
+
+
+@pytest.fixture(scope='module', params=list(MODELS))
+def trained(request):
+    X, y = training_data()
+    model = MODELS[request.param]()
+    classifier = request.param.endswith('classifier')
+    model.fit(X, (y > 30).astype(int) if classifier else y)
+    return model, classifier
+
+
+def test_predict_matches_native(trained, X_eval):
+    model, _ = trained
+    np.testing.assert_allclose(compile_model(model).predict(X_eval), model.predict(X_eval), rtol=1e-5, atol=1e-4)
+
+
+def test_predict_proba_matches_native(trained, X_eval):
+    model, classifier = trained
+    if not classifier:
+        pytest.skip("regressor")
+    np.testing.assert_allclose(compile_model(model).predict_proba(X_eval), model.predict_proba(X_eval),
+                               rtol=1e-5, atol=1e-4)
+
+
+def test_single_rows_match_batch(trained, X_eval):
+    model, _ = trained
+    compiled = compile_model(model)
+    single = np.concatenate([compiled.predict(X_eval[i:i + 1]) for i in range(20)])
+    np.testing.assert_array_equal(single, compiled.predict(X_eval[:20]))
+
+
+def test_saved_engine_matches_native(trained, X_eval, tmp_path):
+    model, _ = trained
+    compile_model(model).save(str(tmp_path / 'engine'))
+    loaded = CompiledForest.load(str(tmp_path / 'engine'), mmap=True)
+    np.testing.assert_allclose(loaded.predict(X_eval), model.predict(X_eval), rtol=1e-5, atol=1e-4)
+
+
+def test_unsupported_models_are_rejected():
+    with pytest.raises(ValueError):
+        compile_model(object())
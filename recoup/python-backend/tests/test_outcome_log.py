@@ -0,0 +1,75 @@
+# tests/test_outcome_log.py
+"""
+The outcome log's running count matches its records without rereading them
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from outcome_log import COUNT_FILE, OutcomeLog
+
+
+def make_log(tmp_path):
+    # Small segments so a few hundred records rotate and compact
+    return OutcomeLog(str(tmp_path), segment_max_bytes=512, compact_min_segments=2)
+
+
+def fill(log, records):
+    for i in range(records):
+        log.append({'daysToPayment': i, 'wasPaid': True})
+
+
+def test_count_follows_rotation_and_compaction(tmp_path):
+    log = make_log(tmp_path)
+    fill(log, 300)
+    log.compact()
+
+    assert any(path.endswith('.gz') for path in log.segments())
+    assert len(log) == 300
+    assert len(log) == log._count() == sum(1 for _ in log)
+
+
+def test_count_does_not_read_sealed_segments(tmp_path, monkeypatch):
+    log = make_log(tmp_path)
+    fill(log, 300)
+    log.compact()
+
+    reads = []
+    original = OutcomeLog._count_lines
+
+    def counting(self, path, offset=0):
+        reads.append((path, offset))
+        return original(self, path, offset)
+
+    monkeypatch.setattr(OutcomeLog, '_count_lines', counting)
+
+    # A fresh process has no cached segment counts
+    assert len(OutcomeLog(str(tmp_path))) == 300
+    # Only the active segment, from the offset COUNT recorded
+    assert [path for path, _ in reads] == [log._segment_path(log._current_sequence())]
+
+
+def test_count_includes_lines_appended_without_updating_it(tmp_path):
+    log = make_log(tmp_path)
+    fill(log, 3)
+
+    # A writer that died between appending and rewriting COUNT
+    with open(log._segment_path(log._current_sequence()), 'a') as f:
+        f.write('{"daysToPayment":3}\n')
+
+    assert len(log) == 4
+    fill(log, 1)
+    assert len(log) == 5 == sum(1 for _ in log)
+
+
+def test_log_without_count_is_counted_then_tracked(tmp_path):
+    log = make_log(tmp_path)
+    fill(log, 50)
+    os.remove(os.path.join(str(tmp_path), COUNT_FILE))
+
+    assert len(log) == 50
+    fill(log, 1)
+    assert os.path.exists(os.path.join(str(tmp_path), COUNT_FILE))
+    assert log._running_count() == 51
@@ -0,0 +1,227 @@
+"""
+Background Training Jobs
+
+Runs model training in a separate process so the fit never blocks a request
+thread or competes with prediction traffic for the GIL. `POST /ml/train`
+submits a job and returns its id immediately; `GET /ml/train/<job_id>` reads
+its status.
+
+**Job status:**
+Each job's status lives in `<jobs_dir>/<job_id>.json` and is rewritten
+atomically as the job moves through its stages. Any worker process can
+answer a status request, not only the one that accepted the job.
+
+```json
+{
+  "jobId": "3f2a...",
+  "status": "running",          // queued | running | succeeded | failed
+  "stage": "gradient_boost",
+  "progress": 0.6,
+  "metrics": {"cvMAE": 4.2},
+  "result": null,
+  "error": null
+}
+```
+
+**Publishing:**
+The training function publishes its models to the model registry only after
+the fit completes. Serving processes then swap to the new version between
+requests (see model_registry.py), so a failed or abandoned job never touches
+the live models.
+"""
+
+import fcntl
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRAINING_LOCK_FILE = '.training.lock'
+ACTIVE_STATES = ('queued', 'running')
+# Queued jobs older than this are treated as orphaned
+QUEUED_JOB_TIMEOUT = 60 * 60
+# Job status files older than this are removed when new jobs are submitted
+JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+
+class JobStatus:
+    """Reads and atomically rewrites one job's status file"""
+
+    def __init__(self, jobs_dir: str, job_id: str):
+        self.path = os.path.join(jobs_dir, f'{job_id}.json')
+        self.job_id = job_id
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def update(self, **fields):
+        status = self.read() or {'jobId': self.job_id}
+        metrics = fields.pop('metrics', None)
+        if metrics is not None:
+            status['metrics'] = dict(status.get('metrics') or {}, **metrics)
+        status.update(fields)
+        status['updatedAt'] = datetime.utcnow().isoformat()
+
+        tmp_path = f'{self.path}.{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, default=str)
+        os.replace(tmp_path, self.path)
+
+    def progress(self, stage: str, fraction: float, **metrics):
+        """Progress callback handed to the training function"""
+        self.update(stage=stage, progress=round(fraction, 3), metrics=metrics)
+
+
+def _run_job(jobs_dir: str, job_id: str, train_fn: Callable[..., Dict[str, Any]], kwargs: Dict[str, Any]):
+    """Process-pool entry point: run one training function and record the outcome"""
+    status = JobStatus(jobs_dir, job_id)
+
+    with open(os.path.join(jobs_dir, TRAINING_LOCK_FILE), 'a') as lock_file:
+        try:
+            # One fit at a time per host, even across service workers
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            status.update(status='failed', error='Another training job is already running',
+                          finishedAt=datetime.utcnow().isoformat())
+            return None
+
+        status.update(status='running', stage='starting', progress=0.0, startedAt=datetime.utcnow().isoformat())
+        try:
+            result = train_fn(progress=status.progress, **kwargs)
+        except Exception as e:
+            logger.error(f"Training job {job_id} failed: {e}")
+            status.update(status='failed', error=str(e), finishedAt=datetime.utcnow().isoformat())
+            return None
+
+        if not result.get('success'):
+            status.update(status='failed', error=result.get('error'), result=result,
+                          finishedAt=datetime.utcnow().isoformat())
+        else:
+            status.update(status='succeeded', stage='done', progress=1.0, result=result,
+                          finishedAt=datetime.utcnow().isoformat())
+        return result
+
+
+class TrainingJobManager:
+    """Submits training functions to a process pool and tracks them by job id"""
+
+    def __init__(self, jobs_dir: str, max_workers: int = 1, nice: int = 10):
+        self.jobs_dir = jobs_dir
+        self.max_workers = max_workers
+        self.nice = nice
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def submit(
+        self,
+        train_fn: Callable[..., Dict[str, Any]],
+        on_complete: Optional[Callable[[Optional[Dict[str, Any]]], None]] = None,
+        **kwargs,
+    ) -> str:
+        """Queue a training run; `train_fn` must be a module-level function accepting `progress`"""
+        self._prune()
+
+        job_id = uuid.uuid4().hex
+        status = JobStatus(self.jobs_dir, job_id)
+        status.update(status='queued', stage=None, progress=0.0, metrics={},
+                      result=None, error=None, submittedAt=datetime.utcnow().isoformat())
+
+        with self._lock:
+            try:
+                future = self._executor().submit(_run_job, self.jobs_dir, job_id, train_fn, kwargs)
+            except BrokenProcessPool:
+                # A previous child died (e.g. OOM kill); start a fresh pool
+                self._pool = None
+                future = self._executor().submit(_run_job, self.jobs_dir, job_id, train_fn, kwargs)
+
+        future.add_done_callback(lambda f: self._finished(job_id, f, on_complete))
+        logger.info(f"Queued training job {job_id}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        return JobStatus(self.jobs_dir, job_id).read()
+
+    def active_job(self) -> Optional[Dict[str, Any]]:
+        """A queued or running job, if any, so callers can avoid duplicate fits"""
+        training = self._training_in_progress()
+        cutoff = (datetime.utcnow() - timedelta(seconds=QUEUED_JOB_TIMEOUT)).isoformat()
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith('.json'):
+                continue
+            status = JobStatus(self.jobs_dir, name[:-len('.json')]).read()
+            if not status:
+                continue
+            # Ignore jobs orphaned by a worker that died: "running" without the
+            # training lock held, or "queued" for longer than any real backlog
+            if status.get('status') == 'running' and training:
+                return status
+            if status.get('status') == 'queued' and status.get('submittedAt', '') > cutoff:
+                return status
+        return None
+
+    def _training_in_progress(self) -> bool:
+        with open(os.path.join(self.jobs_dir, TRAINING_LOCK_FILE), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: the service process runs threads, which fork does not copy safely
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                # Leave CPU priority to the serving processes on the same host
+                initializer=os.nice,
+                initargs=(self.nice,),
+            )
+        return self._pool
+
+    def _finished(self, job_id: str, future: Future, on_complete):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Training job {job_id} crashed: {error}")
+            status = JobStatus(self.jobs_dir, job_id)
+            current = status.read() or {}
+            if current.get('status') in ACTIVE_STATES:
+                status.update(status='failed', error=f'Training process crashed: {error}',
+                              finishedAt=datetime.utcnow().isoformat())
+            if isinstance(error, BrokenProcessPool):
+                with self._lock:
+                    self._pool = None
+            return
+
+        if on_complete is not None:
+            try:
+                on_complete(future.result())
+            except Exception as e:
+                logger.error(f"Training job {job_id} completion hook failed: {e}")
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass